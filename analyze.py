@@ -8,21 +8,49 @@ import collections
 import logging
 import os
 import simplejson as json
-import time
+import struct
+
+import bson
+import numpy
 
 from dominioncards import EVERY_SET_CARDS
-from game import Game
 from primitive_util import PrimitiveConversion, ConvertibleDefaultDict
 from stats import MeanVarStat
+import dominioncards
 import dominionstats.utils.log
-import incremental_scanner
+import game
+import mergeable
+import scan_engine
 import utils
 
 # Module-level logging instance
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
-class CardStatistic(PrimitiveConversion):
+# The binary snapshot of a CardStatistic is a header of its available count
+# and its numbers of turn and diff stats, followed by a record per MeanVarStat:
+# win_any_accum, win_weighted_accum, then the turn and diff stats in key order.
+SNAPSHOT_HEADER = struct.Struct('<qii')
+SNAPSHOT_RECORD = numpy.dtype([('key', '<i4'), ('freq', '<i8'),
+                               ('sum', '<f8'), ('sum_sq', '<f8')])
+
+class MergeableDefaultDict(ConvertibleDefaultDict, mergeable.MergeableDict):
+    pass
+
+def _snapshot_records(records, stats_by_key):
+    for key in sorted(stats_by_key):
+        mvs = stats_by_key[key]
+        records.append((key, mvs.freq, mvs.sum, mvs.sum_sq))
+
+def _snapshot_stat(record):
+    """ The MeanVarStat of a snapshot record.  Stats with no outcomes get
+    their integer zero sums back. """
+    key, freq, stat_sum, sum_sq = record
+    if not freq:
+        return MeanVarStat()
+    return MeanVarStat(freq, stat_sum, sum_sq)
+
+class CardStatistic(PrimitiveConversion, mergeable.MergeableObject):
     """ Per card statistics.
 
         win_weighted_accum_turn:  Dictionary keyed by turn that correlates
@@ -40,21 +68,54 @@ class CardStatistic(PrimitiveConversion):
         self.available = 0
         self.win_any_accum = MeanVarStat()
         self.win_weighted_accum = MeanVarStat()
-        self.win_weighted_accum_turn = ConvertibleDefaultDict(MeanVarStat, int)
-        self.win_diff_accum = ConvertibleDefaultDict(MeanVarStat, int)
+        self.win_weighted_accum_turn = MergeableDefaultDict(MeanVarStat, int)
+        self.win_diff_accum = MergeableDefaultDict(MeanVarStat, int)
+
+    def to_snapshot(self):
+        """ Return this in the binary snapshot format, as a string. """
+        records = []
+        _snapshot_records(records, {0: self.win_any_accum,
+                                    1: self.win_weighted_accum})
+        _snapshot_records(records, self.win_weighted_accum_turn)
+        _snapshot_records(records, self.win_diff_accum)
+        return (SNAPSHOT_HEADER.pack(self.available,
+                                     len(self.win_weighted_accum_turn),
+                                     len(self.win_diff_accum)) +
+                numpy.array(records, dtype=SNAPSHOT_RECORD).tostring())
+
+    def from_snapshot(self, data):
+        """ Set this to the snapshot data made by to_snapshot(). """
+        self.available, num_turns, num_diffs = SNAPSHOT_HEADER.unpack_from(
+            data)
+        records = numpy.frombuffer(data, dtype=SNAPSHOT_RECORD,
+                                   offset=SNAPSHOT_HEADER.size).tolist()
+        assert len(records) == 2 + num_turns + num_diffs
+        self.win_any_accum = _snapshot_stat(records[0])
+        self.win_weighted_accum = _snapshot_stat(records[1])
+        for record in records[2:2 + num_turns]:
+            self.win_weighted_accum_turn[record[0]] = _snapshot_stat(record)
+        for record in records[2 + num_turns:]:
+            self.win_diff_accum[record[0]] = _snapshot_stat(record)
         
 class GamesAnalysis(PrimitiveConversion):
     """ A collection of CardStatistics for every card in the deck. """
 
     def __init__(self):
-        self.card_stats = ConvertibleDefaultDict(CardStatistic)
+        self.card_stats = MergeableDefaultDict(CardStatistic,
+                                               dominioncards.get_card)
         self.num_games = 0
         self.max_game_id = ''
+
+    def merge(self, other):
+        self.card_stats.merge(other.card_stats)
+        self.num_games += other.num_games
+        self.max_game_id = max(self.max_game_id, other.max_game_id)
         
-    def analyze_game(self, game):
+    def analyze_game(self, game, changed_cards=None):
         """ Aggregate information about game into this object.
 
         game: game.Game object to analyze.
+        changed_cards: if given, a set to add the cards whose stats change to.
         """
         self.num_games += 1
         seen_cards_players = set()
@@ -66,6 +127,8 @@ class GamesAnalysis(PrimitiveConversion):
         for turn in game.get_turns():
             deck = turn.get_player()
             turnno = turn.get_turn_no()
+            if changed_cards is not None:
+                changed_cards.update(turn.player_accumulates())
             for card in turn.player_accumulates():
                 per_card_stat = self.card_stats[card]
                 if (deck, card) not in seen_cards_players:
@@ -92,69 +155,110 @@ class GamesAnalysis(PrimitiveConversion):
                 per_card_stat.win_diff_accum[card_diff_index].add_outcome(
                     deck.WinPoints())
 
-def main(args):
-    """ Update analysis statistics.  By default, do so incrementally, unless
-    --noincremental argument is given."""
-
-    commit_after = 25000
+        if changed_cards is not None:
+            changed_cards.update(game.get_supply() + EVERY_SET_CARDS)
 
-    database = utils.get_mongo_database()
-    games = database.games
-
-    output_collection_name = 'analysis'
-    output_collection = database[output_collection_name]
-    game_analysis = GamesAnalysis()
+    def write_snapshot(self, checkpoint, collection, cards):
+        """ Write the stats of cards, and the game counts, to collection as
+        part of checkpoint, in the sharded snapshot layout: a document per
+        card holding its binary snapshot, and a header document with _id ''.
+        """
+        for card in cards:
+            checkpoint.replace(collection, {
+                    '_id': str(card),
+                    'stats': bson.Binary(self.card_stats[card].to_snapshot())})
+        checkpoint.replace(collection, {'_id': '',
+                                        'num_games': self.num_games,
+                                        'max_game_id': self.max_game_id})
 
-    scanner = incremental_scanner.IncrementalScanner(output_collection_name,
-                                                     database)
- 
-    if args.incremental:
-        utils.read_object_from_db(game_analysis, output_collection, '')
-    else:
-        log.warning('resetting scanner and db')
-        scanner.reset()
+    def read_snapshot(self, collection, cards=None):
+        """ Read the game counts and the stats of cards (all of them by
+        default) from a snapshot written by write_snapshot(). """
+        header = collection.find_one({'_id': ''})
+        if not header:
+            return
+        self.num_games = header['num_games']
+        self.max_game_id = header['max_game_id']
+        spec = {}
+        if cards is not None:
+            spec = {'_id': {'$in': [str(card) for card in cards]}}
+        for doc in collection.find(spec):
+            if doc['_id'] == '':
+                continue
+            card_stat = CardStatistic()
+            card_stat.from_snapshot(str(doc['stats']))
+            self.card_stats[dominioncards.get_card(doc['_id'])] = card_stat
 
+class AnalysisPlugin(scan_engine.AnalyzerPlugin):
+    """ Keeps the GamesAnalysis in the analysis collection up to date, as a
+    snapshot that each commit rewrites the changed cards of, and writes it
+    out to static/output/all_games_card_stats.js."""
+    scan_name = 'analysis'
+    mergeable = True
+    fields = game.GAME_FIELDS
     output_file_name = 'static/output/all_games_card_stats.js'
 
-    if not os.path.exists('static/output'):
-        os.makedirs('static/output')
+    def __init__(self, db):
+        scan_engine.AnalyzerPlugin.__init__(self, db)
+        self.output_collection = db[self.scan_name]
+        self.game_analysis = GamesAnalysis()
+        self.changed_cards = set()
 
-    log.info("Starting run: %s", scanner.status_msg())
+    def reset(self):
+        scan_engine.AnalyzerPlugin.reset(self)
+        self.output_collection.drop()
 
-    for idx, raw_game in enumerate(utils.progress_meter(scanner.scan(games, {}))):
-        try:
-            game_analysis.analyze_game(Game(raw_game))
+    def start(self):
+        header = self.output_collection.find_one({'_id': ''})
+        if header and 'card_stats' in header:
+            # Saved as one document by an older version; the next commit
+            # writes all of it out as a snapshot.
+            self.game_analysis.from_primitive_object(header)
+            self.changed_cards.update(self.game_analysis.card_stats)
+        else:
+            self.game_analysis.read_snapshot(self.output_collection)
 
-            if args.max_games >= 0 and idx >= args.max_games:
-                log.info("Reached max_games of %d", args.max_games)
-                break
+    def analyze_game(self, game_obj):
+        self.game_analysis.analyze_game(game_obj, self.changed_cards)
 
-            if idx % commit_after == 0 and idx > 0:
-                start = time.time()
-                game_analysis.max_game_id = scanner.get_max_game_id()
-                game_analysis.num_games = scanner.get_num_games()
-                utils.write_object_to_db(game_analysis, output_collection, '')
-                scanner.save()
-                log.info("Committed calculations to the DB in %5.2fs", time.time() - start)
+    def partial_result(self):
+        return self.game_analysis.to_primitive_object()
 
-        except exception:
-            log.exception('Exception occurred for %s in raw game %s', Game(raw_game).isotropic_url(), raw_game)
-            raise 
+    def merge_partial_result(self, partial):
+        game_analysis = GamesAnalysis()
+        game_analysis.from_primitive_object(partial)
+        self.game_analysis.merge(game_analysis)
+        self.changed_cards.update(game_analysis.card_stats)
 
-    game_analysis.max_game_id = scanner.get_max_game_id()
-    game_analysis.num_games = scanner.get_num_games()
-    utils.write_object_to_db(game_analysis, output_collection, '')
+    def commit(self):
+        self.game_analysis.max_game_id = self.scanner.get_max_game_id()
+        self.game_analysis.num_games = self.scanner.get_num_games()
+        checkpoint = self.scanner.checkpoint()
+        self.game_analysis.write_snapshot(checkpoint, self.output_collection,
+                                          self.changed_cards)
+        checkpoint.write()
+        self.changed_cards = set()
 
-    output_file = open(output_file_name, 'w')
-    output_file.write('var all_card_data = ')
+    def finish(self):
+        self.commit()
+        utils.ensure_exists(os.path.dirname(self.output_file_name))
+        output_file = open(self.output_file_name, 'w')
+        output_file.write('var all_card_data = ')
+        json.dump(self.game_analysis.to_primitive_object(), output_file)
+        output_file.close()
 
-    json.dump(game_analysis.to_primitive_object(), output_file)
-    log.info("Ending run: %s", scanner.status_msg())
-    scanner.save()
+
+def main(args):
+    """ Update analysis statistics.  By default, do so incrementally, unless
+    --noincremental argument is given."""
+    database = utils.get_mongo_database()
+    scan_engine.run_plugins(database, [AnalysisPlugin(database)], args,
+                            args.processes)
 
 
 if __name__ == '__main__':
     parser = utils.incremental_max_parser()
+    scan_engine.add_processes_argument(parser)
     args = parser.parse_args()
     dominionstats.utils.log.initialize_logging(args.debug)
     main(args)
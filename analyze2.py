@@ -3,13 +3,17 @@
 from __future__ import division
 
 import collections
+import io
 import logging
 
-from small_gain_stat import SmallGainStat
+import numpy
+
+from small_gain_stat import SmallGainStat, FLAT_FIELDS
 import analysis_util
+import dominioncards
 import dominionstats.utils.log
 import game
-import incremental_scanner
+import scan_engine
 import utils
 
 # Module-level logging instance
@@ -42,20 +46,121 @@ event_detectors = [(g[:-len(events_func_label)], eval(g))
                    for g in locals().keys() if g.endswith(events_func_label)]
 
 
-def detect_events(game_obj):
+# The card_supply events are accumulated by CardSupplyStats rather than
+# through detect_events(), since there are so many of them.
+CARD_SUPPLY = 'card_supply'
+sparse_event_detectors = [(name, detector) for name, detector
+                          in event_detectors if name != CARD_SUPPLY]
+
+
+def detect_events(game_obj, detectors=sparse_event_detectors):
     """ Return a dict of lists, where the keys are event names, and the
     values are events of those type that occured in game_obj."""
     ret = collections.defaultdict(list)
-    for event_detector_name, detector in event_detectors:
+    for event_detector_name, detector in detectors:
         for event in detector(game_obj):
             ret[event_detector_name].append(event)
     return ret
 
+NUM_CARDS = max(dominioncards.indexes(dominioncards.all_cards())) + 1
+
+def _supply_event_key(condition):
+    """ Return the card_supply event for condition, a tuple of at most two
+    card indexes, as card_supply_events() makes it. """
+    return ','.join(sorted(map(str, condition), reverse=True))
+
+def _pair_condition(index1, index2):
+    high, low = max(index1, index2), min(index1, index2)
+    return 1 + NUM_CARDS + high * (high - 1) // 2 + low
+
+# The conditions of the card_supply events, as indexes into the second axis
+# of CardSupplyStats.stats: no condition, then each card, then each pair.
+SUPPLY_CONDITIONS = [()] + [(index,) for index in range(NUM_CARDS)] + [
+    (high, low) for high in range(NUM_CARDS) for low in range(high)]
+SUPPLY_EVENT_KEYS = [_supply_event_key(c) for c in SUPPLY_CONDITIONS]
+
+# Positions in FLAT_FIELDS of the frequencies, which are stored as ints.
+FREQ_FIELDS = [FLAT_FIELDS.index(name) for name in FLAT_FIELDS
+               if name.endswith('_freq')]
+
+class CardSupplyStats(object):
+    """ The SmallGainStats of the card_supply events, kept dense.
+
+    stats is indexed by the target card's index, the SUPPLY_CONDITIONS
+    index of the event and the FLAT_FIELDS index of the number.  numpy.zeros
+    leaves the pages of cards that never show up unallocated, so only the
+    cells in use take memory, and used marks those cells so that finding
+    them doesn't read the rest.  Each cell gets exactly the additions its
+    SmallGainStat would, in the same order, so the numbers are the same.
+    """
+    def __init__(self):
+        self.stats = numpy.zeros(
+            (NUM_CARDS, len(SUPPLY_CONDITIONS), len(FLAT_FIELDS)))
+        self.used = numpy.zeros((NUM_CARDS, len(SUPPLY_CONDITIONS)),
+                                dtype=bool)
+
+    @staticmethod
+    def game_conditions(game_obj):
+        """ Return the conditions of the card_supply events of game_obj. """
+        indexes = dominioncards.indexes(game_obj.get_supply())
+        conditions = [0] + [1 + index for index in indexes]
+        for pos, index1 in enumerate(indexes):
+            for index2 in indexes[:pos]:
+                conditions.append(_pair_condition(index1, index2))
+        return numpy.array(conditions)
+
+    def add_player(self, conditions, targets, counts, win_points):
+        """ Add a player's gains of the cards in targets, counts of each,
+        under all of the conditions of their game. """
+        counts = numpy.array(counts, dtype=float)
+        gained = counts > 0
+        outcome = [1, win_points, win_points * win_points]
+        vals = numpy.zeros((len(targets), len(FLAT_FIELDS)))
+        vals[gained, 0:3] = outcome
+        vals[~gained, 3:6] = outcome
+        vals[:, 6] = counts
+        vals[:, 7] = win_points * counts
+        vals[:, 8] = win_points * win_points * counts
+        cells = numpy.ix_(targets, conditions)
+        self.stats[cells] += vals[:, numpy.newaxis]
+        self.used[cells] = True
+
+    def used_cells(self):
+        """ Return the (target, condition) indexes of the cells in use. """
+        return numpy.nonzero(self.used)
+
+    def iter_flat_dicts(self):
+        """ Yield (full key, SmallGainStat.to_flat_dict()) for each cell in
+        use, as EventAccumulator keeps them for the other events. """
+        targets, conditions = self.used_cells()
+        for target, condition, vals in zip(targets, conditions,
+                                           self.stats[targets, conditions]):
+            flat = dict(zip(FLAT_FIELDS, vals.tolist()))
+            for field in FREQ_FIELDS:
+                flat[FLAT_FIELDS[field]] = int(vals[field])
+            yield '%d;%s' % (target, SUPPLY_EVENT_KEYS[condition]), flat
+
+    def to_blob(self):
+        """ Return the cells in use, compressed, as a string. """
+        targets, conditions = self.used_cells()
+        blob = io.BytesIO()
+        numpy.savez_compressed(blob, targets=targets, conditions=conditions,
+                               values=self.stats[targets, conditions])
+        return blob.getvalue()
+
+    def merge_blob(self, blob):
+        """ Add in the cells of a to_blob() string. """
+        arrays = numpy.load(io.BytesIO(blob))
+        self.stats[arrays['targets'], arrays['conditions']] += arrays['values']
+        self.used[arrays['targets'], arrays['conditions']] = True
+
+
 class EventAccumulator:
     """ A class for accumulating and serializing SmallGainStat for events."""
     def __init__(self):
         self.event_stats = collections.defaultdict(
             lambda: collections.defaultdict(SmallGainStat))
+        self.card_supply = CardSupplyStats()
         
     def merge_stats(self, event_lists, key, gain_stat):
         for event_type_name, event_list in event_lists.iteritems():
@@ -65,79 +170,157 @@ class EventAccumulator:
                 per_card_stat = event_stats_collection[full_key]
                 per_card_stat.merge(gain_stat)
 
-    def update_db(self, mongo_db_inst):
+    def partial_result(self):
+        """ Return the accumulated stats as primitives, with the card_supply
+        stats as a CardSupplyStats.to_blob() string. """
+        return {'events': dict(
+                (event_type_name, dict(
+                        (full_key, stat.to_primitive_object())
+                        for full_key, stat in stats_dict.iteritems()))
+                for event_type_name, stats_dict in self.event_stats.iteritems()),
+                CARD_SUPPLY: self.card_supply.to_blob()}
+
+    def merge_partial_result(self, partial):
+        for event_type_name, stats_dict in partial['events'].iteritems():
+            event_stats_collection = self.event_stats[event_type_name]
+            for full_key, prim in stats_dict.iteritems():
+                stat = SmallGainStat()
+                stat.from_primitive_object(prim)
+                event_stats_collection[full_key].merge(stat)
+        self.card_supply.merge_blob(partial[CARD_SUPPLY])
+
+    def iter_flat_stats(self):
+        """ Yield the name of each event collection, with an iterator of
+        (key, SmallGainStat.to_flat_dict()) of its accumulated stats. """
         for event_type_name, stats_dict in self.event_stats.iteritems():
-            log.debug('Updating database for event type %s, %d stats',
-                      event_type_name, len(stats_dict))
-            mongo_collection = mongo_db_inst[event_type_name]
-            inserts = 0
-            updates = 0
-            for full_key, gain_stats_obj in sorted(stats_dict.iteritems()):
-                existing_raw_obj = mongo_collection.find_one(
-                    {'_id': full_key})
-                if existing_raw_obj:
-                    updates += 1
-                    existing_stat = SmallGainStat()
-                    existing_stat.from_primitive_object(
-                        existing_raw_obj['vals'])
-                    gain_stats_obj.merge(existing_stat)
-                else:
-                    inserts += 1
-                key_wrap_obj = {'vals': gain_stats_obj.to_primitive_object()}
-                utils.write_object_to_db(key_wrap_obj, mongo_collection,
-                                         full_key)
-            log.debug('Database update results for %s: %d inserts, %d updates',
-                      event_type_name, inserts, updates)
+            yield event_type_name, (
+                (full_key, gain_stats_obj.to_flat_dict())
+                for full_key, gain_stats_obj in sorted(stats_dict.iteritems()))
+        yield CARD_SUPPLY, self.card_supply.iter_flat_dicts()
+
+    def update_db(self, mongo_db_inst):
+        """ Add the accumulated stats into the stored ones.
+
+        Each stat is stored flat, as SmallGainStat.to_flat_dict(), so it is
+        added in with an upserted $inc, and the updates for a collection go
+        in one bulk operation rather than a read and a write per key.
+        """
+        for collection_name, flat_stats in self.iter_flat_stats():
+            self.update_collection(mongo_db_inst[collection_name], flat_stats)
+
+    def add_to_checkpoint(self, mongo_db_inst, checkpoint):
+        """ Like update_db(), but as part of checkpoint. """
+        for collection_name, flat_stats in self.iter_flat_stats():
+            collection = mongo_db_inst[collection_name]
+            for full_key, flat_dict in flat_stats:
+                checkpoint.increment(collection, '_id', full_key, flat_dict)
+
+    def update_collection(self, mongo_collection, flat_stats):
+        bulk = mongo_collection.initialize_unordered_bulk_op()
+        num_stats = 0
+        for full_key, flat_dict in flat_stats:
+            bulk.find({'_id': full_key}).upsert().update_one(
+                {'$inc': flat_dict})
+            num_stats += 1
+        if not num_stats:
+            return
+        result = bulk.execute()
+        log.debug('Database update results for %s: %d inserts, %d updates',
+                  mongo_collection.name, result['nUpserted'],
+                  result['nMatched'])
+
+class OldLayoutError(Exception):
+    """Indicates event stats stored as a list under 'vals', which can't be
+    added to with $inc."""
+    def __init__(self, reason):
+        self.args = reason,
+        self.reason = reason
+
+    def __str__(self):
+        return '<old layout error %s>' % self.reason
+
+def check_layout(mongo_db_inst):
+    """ Raise OldLayoutError if the event collections still hold stats in
+    the old layout. """
+    for event_type_name, _ in event_detectors:
+        if mongo_db_inst[event_type_name].find_one({'vals': {'$exists': True}}):
+            raise OldLayoutError('%s needs a rebuild with --noincremental' %
+                                 event_type_name)
+
+def accumulate_game_stats(game_obj, stats_accumulator):
+    detected_events = detect_events(game_obj)
+    supply_conditions = CardSupplyStats.game_conditions(game_obj)
+
+    per_player_accum = game_obj.cards_gained_per_player()[game.BOUGHT].iteritems()
+    for player, accum_dict in per_player_accum:
+        avail = list(analysis_util.available_cards(game_obj, accum_dict.keys()))
+        win_points = game_obj.get_player_deck(player).WinPoints()
+        stats_accumulator.card_supply.add_player(
+            supply_conditions, dominioncards.indexes(avail),
+            [accum_dict.get(card, 0) for card in avail], win_points)
+        for card in avail:
+            count = accum_dict.get(card, 0)
+            small_gain_stat = SmallGainStat()
+            if count:
+                small_gain_stat.win_given_any_gain.add_outcome(win_points)
+            else:
+                small_gain_stat.win_given_no_gain.add_outcome(win_points)
+            small_gain_stat.win_weighted_gain.add_many_outcomes(
+                win_points, count)
+            card_index = str(card.index)
+            stats_accumulator.merge_stats(detected_events, card_index,
+                                          small_gain_stat)
 
 def accumulate_card_stats(games_stream, stats_accumulator, max_games=-1):
     for game_obj in games_stream:
-        detected_events = detect_events(game_obj)
-
-        per_player_accum = game_obj.cards_gained_per_player()[game.BOUGHT].iteritems()
-        for player, accum_dict in per_player_accum:
-            avail = analysis_util.available_cards(game_obj, accum_dict.keys())
-            win_points = game_obj.get_player_deck(player).WinPoints()
-            for card in avail:
-                count = accum_dict.get(card, 0)
-                small_gain_stat = SmallGainStat()
-                if count:
-                    small_gain_stat.win_given_any_gain.add_outcome(win_points)
-                else:
-                    small_gain_stat.win_given_no_gain.add_outcome(win_points)
-                small_gain_stat.win_weighted_gain.add_many_outcomes(
-                    win_points, count)
-                card_index = str(card.index)
-                stats_accumulator.merge_stats(detected_events, card_index,
-                                              small_gain_stat)
+        accumulate_game_stats(game_obj, stats_accumulator)
         max_games -= 1
         if max_games == 0:
             break
 
-def main(args):
-    db = utils.get_mongo_database()
-    scanner = incremental_scanner.IncrementalScanner('analyze2', db)
+class EventStatsPlugin(scan_engine.AnalyzerPlugin):
+    """ Keeps the per event collections up to date. """
+    scan_name = 'analyze2'
+    mergeable = True
+    fields = game.GAME_FIELDS
 
-    if not args.incremental:
-        log.warning('resetting scanner and db')
-        scanner.reset()
+    def __init__(self, db):
+        scan_engine.AnalyzerPlugin.__init__(self, db)
+        self.accumulator = EventAccumulator()
+
+    def reset(self):
+        scan_engine.AnalyzerPlugin.reset(self)
         for collection_name, _ in event_detectors:
-            db[collection_name].drop()
+            self.db[collection_name].drop()
+
+    def start(self):
+        check_layout(self.db)
 
-    log.info("Starting run: %s", scanner.status_msg())
-    games_stream = analysis_util.games_stream(scanner, db.games)
-    accumulator = EventAccumulator()
-    accumulate_card_stats(games_stream, accumulator, args.max_games)
+    def analyze_game(self, game_obj):
+        accumulate_game_stats(game_obj, self.accumulator)
 
-    log.info('saving to database')
-    log.debug('saving accumulated stats')
-    accumulator.update_db(db)
-    log.info('saving the game scanner state')
-    scanner.save()
-    log.info("Ending run: %s", scanner.status_msg())
+    def partial_result(self):
+        return self.accumulator.partial_result()
+
+    def merge_partial_result(self, partial):
+        self.accumulator.merge_partial_result(partial)
+
+    def commit(self):
+        # The stats are added to what is already stored, so start a fresh
+        # accumulator rather than adding these games in again next time.
+        checkpoint = self.scanner.checkpoint()
+        self.accumulator.add_to_checkpoint(self.db, checkpoint)
+        checkpoint.write()
+        self.accumulator = EventAccumulator()
+
+def main(args):
+    db = utils.get_mongo_database()
+    scan_engine.run_plugins(db, [EventStatsPlugin(db)], args, args.processes)
 
 
 if __name__ == '__main__':
     parser = utils.incremental_max_parser()
+    scan_engine.add_processes_argument(parser)
     parsed_args = parser.parse_args()
     dominionstats.utils.log.initialize_logging(parsed_args.debug)
     main(parsed_args)
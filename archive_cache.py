@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Local disk cache for the daily raw game archives kept in S3.
+
+Archives are stored under names made of their date and their S3 checksum
+(the key's ETag), so a cached copy is only used while it matches what is
+in S3, and a replaced archive simply gets a new entry.  The total size of
+the cache is capped, and the least recently used archives are evicted to
+stay under it.
+"""
+
+import ConfigParser
+import hashlib
+import logging
+import os
+import os.path
+import re
+import tempfile
+
+import utils
+
+
+# Module-level logging instance
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# Size of the reads when copying an archive from S3 into the cache.
+COPY_CHUNK_SIZE = 1024 * 1024
+
+CACHE_FILE_RE = re.compile(r'^\d{8}-[0-9a-f-]+\.tar\.bz2$')
+
+
+class ArchiveCacheError(Exception):
+    """Indicates an archive that did not match its S3 checksum."""
+    def __init__(self, reason):
+        self.args = reason,
+        self.reason = reason
+
+    def __str__(self):
+        return '<archive cache error %s>' % self.reason
+
+
+def key_checksum(key):
+    """Return the checksum S3 keeps for key, its ETag without the quotes."""
+    return key.etag.strip('"')
+
+
+def archive_cache_from_config():
+    """Return the ArchiveCache configured in conf.ini, or None if there
+    isn't one.  It is configured like:
+
+    [archive_cache]
+    path = archive_cache
+    max_megabytes = 20000
+    """
+    config = ConfigParser.ConfigParser()
+    config.read('conf.ini')
+    if not config.has_section('archive_cache'):
+        return None
+    return ArchiveCache(config.get('archive_cache', 'path'),
+                        config.getint('archive_cache', 'max_megabytes') * 1024 * 1024)
+
+
+class ArchiveCache(object):
+    """Cache of archives in the directory path, holding at most max_bytes.
+
+    The modification time of each cached file records when it was last
+    used.  hits and misses count the lookups since the cache was created.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        utils.ensure_exists(path)
+
+    def cache_filename(self, yyyy_mm_dd, checksum):
+        return os.path.join(self.path, '%s-%s.tar.bz2' % (yyyy_mm_dd, checksum))
+
+    def open(self, yyyy_mm_dd, key):
+        """Return an open file of the archive for yyyy_mm_dd, whose S3 key
+        is key, copying it into the cache first if it is not there."""
+        filename = self.cache_filename(yyyy_mm_dd, key_checksum(key))
+        if os.path.exists(filename):
+            self.hits += 1
+            log.debug("Archive cache hit for %s", yyyy_mm_dd)
+            os.utime(filename, None)
+        else:
+            self.misses += 1
+            log.debug("Archive cache miss for %s", yyyy_mm_dd)
+            self.store(filename, key)
+            self.evict(keep=filename)
+        return open(filename, 'rb')
+
+    def store(self, filename, key):
+        """Stream key into filename, checking it against key's checksum.
+
+        The archive is written to a temporary file and renamed into place,
+        so an interrupted copy never leaves a bad entry behind.
+        """
+        checksum = key_checksum(key)
+        fd, temp_filename = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            md5 = hashlib.md5()
+            with os.fdopen(fd, 'wb') as temp_file:
+                key.open_read()
+                while True:
+                    chunk = key.read(COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    md5.update(chunk)
+                    temp_file.write(chunk)
+                key.close()
+            # Multipart uploads have ETags like '<md5 of md5s>-<parts>',
+            # which aren't the MD5 of the contents.
+            if '-' not in checksum and md5.hexdigest() != checksum:
+                raise ArchiveCacheError('%s does not match checksum %s' %
+                                        (key.name, checksum))
+            os.rename(temp_filename, filename)
+        except:
+            os.remove(temp_filename)
+            raise
+
+    def cached_files(self):
+        """Return a list of (last used time, size, filename) for the
+        cached archives."""
+        entries = []
+        for name in os.listdir(self.path):
+            if CACHE_FILE_RE.match(name):
+                filename = os.path.join(self.path, name)
+                stat = os.stat(filename)
+                entries.append((stat.st_mtime, stat.st_size, filename))
+        return entries
+
+    def evict(self, keep=None):
+        """Remove the least recently used archives other than keep until
+        the cache fits in max_bytes."""
+        entries = sorted(self.cached_files())
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in entries:
+            if total <= self.max_bytes:
+                break
+            if filename == keep:
+                continue
+            log.info("Evicting %s from the archive cache", filename)
+            os.remove(filename)
+            total -= size
+
+    def log_counters(self):
+        log.info("Archive cache: %d hits, %d misses", self.hits, self.misses)
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+
+""" Fill in newly added goals for the games already checked for goals.
+
+goals.py --goals rechecks the named goals by reading and rewriting the goal
+document of every game.  This instead runs the named goals as a scan_engine
+plugin, in a pool of processes with --processes, over just the game fields
+that Game reads.  Only the games where a goal fires are written, by adding
+the goals found to their goal documents' arrays, and numbering the documents
+again for goal_stats.py, in checkpoints that move the backfill's own scanner
+along.
+
+The backfill covers the games that the goals scanner had seen when it
+started; the goals scanner checks the later ones for every goal anyway.
+Goals already recorded for a game are kept, so a goal whose checker has
+changed should be rechecked with goals.py --goals instead.
+"""
+
+import logging
+
+from keys import *
+import dominionstats.utils.log
+import game
+import goals
+import incremental_scanner
+import ingest_sequence
+import scan_engine
+import utils
+
+# Module-level logging instance
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+class GoalBackfillPlugin(scan_engine.AnalyzerPlugin):
+    """ Adds the goals of goal_names found in the games up to sequence
+    number last_seq to the goals collection. """
+    mergeable = True
+    fields = game.GAME_FIELDS
+
+    def __init__(self, db, goal_names, last_seq):
+        self.goal_names = sorted(goal_names)
+        self.scan_name = 'goal_backfill_' + '_'.join(self.goal_names)
+        scan_engine.AnalyzerPlugin.__init__(self, db)
+        self.last_seq = last_seq
+        self.output_collection = db.goals
+        self.found = []
+        self.num_found = 0
+
+    def init_args(self):
+        return (self.goal_names, self.last_seq)
+
+    def analyze_game(self, game_obj):
+        found_goals = goals.check_goals(game_obj, self.goal_names)
+        if found_goals:
+            self.found.append((game_obj.get_id(), found_goals))
+
+    def partial_result(self):
+        return self.found
+
+    def merge_partial_result(self, partial):
+        self.found.extend(partial)
+
+    def commit(self):
+        checkpoint = self.scanner.checkpoint()
+        first_seq = None
+        if self.found:
+            first_seq = ingest_sequence.reserve(
+                self.db, len(self.found), ingest_sequence.GOALS_SEQUENCE)
+        try:
+            for ind, (game_id, found_goals) in enumerate(self.found):
+                checkpoint.add_to_set(self.output_collection, game_id,
+                                      'goals', found_goals,
+                                      {INGEST_SEQ: first_seq + ind})
+            checkpoint.write()
+        finally:
+            ingest_sequence.release(self.db, first_seq,
+                                    ingest_sequence.GOALS_SEQUENCE)
+        self.num_found += len(self.found)
+        self.found = []
+
+    def finish(self):
+        self.commit()
+        log.info("Goals %s found in %d games", ', '.join(self.goal_names),
+                 self.num_found)
+
+
+def main(args):
+    for goal_name in args.goal_names:
+        if goal_name not in goals.goal_check_funcs:
+            log.error("Unrecognized goal name '%s'", goal_name)
+            exit(-1)
+
+    db = utils.get_mongo_database()
+    last_seq = incremental_scanner.IncrementalScanner('goals',
+                                                      db).get_max_seq()
+    scan_engine.run_plugins(
+        db, [GoalBackfillPlugin(db, args.goal_names, last_seq)], args,
+        args.processes)
+
+
+if __name__ == '__main__':
+    parser = utils.incremental_max_parser()
+    parser.add_argument('goal_names', metavar='goal_name', nargs='+',
+                        help='the goals to fill in')
+    scan_engine.add_processes_argument(parser)
+    args = parser.parse_args()
+    dominionstats.utils.log.initialize_logging(args.debug)
+    main(args)
@@ -11,6 +11,7 @@ import datetime
 from background.celery import celery
 from goals import calculate_goals
 from parse_game import parse_and_insert
+import archive_cache
 import game_stats
 import isotropic
 import utils
@@ -103,11 +104,12 @@ def calc_goals(game_ids, day):
     goals_col = db.goals
     goals_error_col = db.goals_error
 
+    found = dict((game['_id'], game) for game in games_col.find(
+            {'_id': {'$in': game_ids}}))
     games = []
     for game_id in game_ids:
-        game = games_col.find_one({'_id': game_id})
-        if game:
-            games.append(game)
+        if game_id in found:
+            games.append(found[game_id])
         else:
             log.warning('Found nothing for game id %s', game_id)
 
@@ -146,33 +148,38 @@ def calc_goals_for_days(days):
 
         log.info('%s games to search for goals on %s', games_to_process.count(), day)
 
-        chunk = []
-        for game in games_to_process:
-            if len(chunk) >= CALC_GOALS_CHUNK_SIZE:
-                calc_goals.delay(chunk, day)
-                chunk = []
-
-            if goals_col.find({'_id': game['_id']}).count() == 0:
-                chunk.append(game['_id'])
-                game_count += 1
-
-        if len(chunk) > 0:
-            calc_goals.delay(chunk, day)
+        for chunk in utils.chunks(games_to_process, CALC_GOALS_CHUNK_SIZE):
+            game_ids = [game['_id'] for game in chunk]
+            done = set(doc['_id'] for doc in goals_col.find(
+                    {'_id': {'$in': game_ids}}, ['_id']))
+            game_ids = [game_id for game_id in game_ids
+                        if game_id not in done]
+            if game_ids:
+                calc_goals.delay(game_ids, day)
+                game_count += len(game_ids)
 
     return game_count
 
 
 @celery.task(rate_limit='2/m')
-def scrape_raw_games(date):
+def scrape_raw_games(date, fused=False):
     """Download the specified raw game archive, store it in S3, and load it into MongoDB.
 
     date is a datetime.date object
+
+    If fused is true, the games are parsed straight out of the archive
+    as they are loaded, rather than by a separate parse_days task.
     """
     db = utils.get_mongo_database()
 
-    scraper = isotropic.IsotropicScraper(db)
+    cache = archive_cache.archive_cache_from_config()
+    scraper = isotropic.IsotropicScraper(db, archive_cache=cache)
 
     try:
+        if fused:
+            return scraper.scrape_and_ingest_rawgames(date, db.games,
+                                                      db.parse_error)
+
         inserted = scraper.scrape_and_store_rawgames(date)
         if inserted > 0:
             # Also need to parse the raw games for the days where we
@@ -184,6 +191,10 @@ def scrape_raw_games(date):
         log.info("Data for %s is not yet available", date)
         return None
 
+    finally:
+        if cache is not None:
+            cache.log_counters()
+
 
 @celery.task
 def check_for_work():
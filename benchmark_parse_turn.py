@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" Measure per-line throughput of parse_game.parse_turn on the test data.
+
+This compares the parse_turn in the working tree against parse_turn from
+parse_game.py as of a git revision, by default the last one before
+parse_turn classified lines with the keyword trie, and checks that both
+produce identical turns.
+"""
+
+import codecs
+import glob
+import imp
+import subprocess
+import time
+
+import parse_game
+import utils
+
+# The parent of the commit that introduced the keyword trie.
+PRE_TRIE_REV = '115fd9a6b7b6d39c44acd762f3407c4f1790cf8f'
+
+
+def load_turns(data_glob):
+    """ Return a list of (turn text, names list) for every turn in the
+    isotropic logs matching data_glob. """
+    turns = []
+    for filename in sorted(glob.glob(data_glob)):
+        contents = codecs.open(filename, 'r', encoding='utf-8').read()
+        contents = contents.replace('&mdash;', '---')
+        header_str, decks_blob, trash_and_turns = \
+            parse_game.SECTION_SEP.split(contents)
+        names_list = [d[parse_game.NAME] for d in
+                      parse_game.parse_decks(decks_blob)]
+        turns_str = trash_and_turns.split('Game log')[1]
+        turns_str = turns_str[turns_str.find('---'):]
+        turns_str = parse_game.canonicalize_names(turns_str, names_list)
+        for turn_text in parse_game.split_turns(turns_str):
+            turns.append((turn_text, names_list))
+    return turns
+
+
+def load_module_at_rev(rev):
+    source = subprocess.check_output(['git', 'show', rev + ':parse_game.py'])
+    module = imp.new_module('parse_game_' + rev.replace('~', '_'))
+    exec source in module.__dict__
+    return module
+
+
+def time_parse_turns(parse_turn_funcs, turns, repeat):
+    """ Return a list of (best seconds per pass over turns, parsed turns), one
+    per function in parse_turn_funcs.  Passes alternate between the functions
+    so that they see the same machine load.
+    """
+    best = [None] * len(parse_turn_funcs)
+    parsed = [None] * len(parse_turn_funcs)
+    for _ in range(repeat):
+        for idx, parse_turn in enumerate(parse_turn_funcs):
+            start = time.time()
+            parsed[idx] = [parse_turn(text, names) for text, names in turns]
+            elapsed = time.time() - start
+            if best[idx] is None or elapsed < best[idx]:
+                best[idx] = elapsed
+    return zip(best, parsed)
+
+
+def main(args):
+    turns = load_turns(args.data)
+    num_lines = sum(len(text.strip().split('\n')) for text, _ in turns)
+    print 'Parsing %d turns, %d lines, best of %d' % (len(turns), num_lines,
+                                                     args.repeat)
+
+    # Hold on to the module, its globals are cleared when it is freed.
+    reference_module = load_module_at_rev(args.reference_rev)
+
+    timings = time_parse_turns(
+        [reference_module.parse_turn, parse_game.parse_turn], turns,
+        args.repeat)
+    (reference_time, expected), (current_time, current) = timings
+    assert current == expected, 'parse_turn output differs'
+
+    for label, elapsed in [('parse_game.py@%s' % args.reference_rev[:12],
+                            reference_time),
+                           ('working tree', current_time)]:
+        print '%-30s %8.3fs %10.0f lines/s' % (label, elapsed,
+                                               num_lines / elapsed)
+    print 'speedup: %.2fx' % (reference_time / current_time)
+
+
+if __name__ == '__main__':
+    parser = utils.base_parser()
+    parser.add_argument('--data', default='testing/testdata/game-*.html')
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--reference_rev', default=PRE_TRIE_REV,
+                        help='git revision of parse_game.py to compare with')
+    main(parser.parse_args())
@@ -7,7 +7,6 @@ update statistics for all games in the database.
 """
 
 import logging
-import time
 
 from keys import *
 from stats import MeanVarStat as MVS
@@ -15,9 +14,9 @@ import analysis_util
 import dominioncards
 import game
 import dominionstats.utils.log
-import incremental_scanner
 import mergeable
 import primitive_util
+import scan_engine
 import utils
 
 # Module-level logging instance
@@ -71,6 +70,16 @@ class DeckBuyStats(primitive_util.ConvertibleDefaultDict,
         primitive_util.ConvertibleDefaultDict.__init__(self, value_type=BuyStat,
                                                        key_type=dominioncards.get_card)
 
+    def merge_partial(self, other):
+        """ Like merge(), for other accumulated from a fresh DeckBuyStats,
+        but count the game length priors that both started from once."""
+        priors = BuyStat()
+        for card, buy_stat in other.iteritems():
+            card_stat = self[card]
+            card_stat.merge(buy_stat)
+            card_stat.game_length -= priors.game_length
+            card_stat.game_length_colony -= priors.game_length_colony
+
 def accum_buy_stats(games_stream, accum_stats, 
                     acceptable_deck_filter=lambda game, name: True,
                     max_games=-1):
@@ -139,51 +148,45 @@ def add_effectiveness(accum_stats, global_stats):
         stats_obj.effectiveness_gain = card_gain_eff.mean_diff(any_eff)
         stats_obj.effectiveness_skip = card_skip_eff.mean_diff(any_eff)
 
-def do_scan(scanner, games_col, accum_stats, max_games):
-    """ Use scanner to accumulate stats from games_col into accum_stats .
+class BuyStatsPlugin(scan_engine.AnalyzerPlugin):
+    """ Keeps the overall DeckBuyStats in the buys collection up to date. """
+    scan_name = BUYS_COL_NAME
+    mergeable = True
+    fields = game.GAME_FIELDS
 
-    scanner: incremental_scanner.Scanner to use for traversal.
-    games_col:  Mongo collection to scan.
-    accum_stats: DeckBuyStats instance to store results.
-    """
-    accum_buy_stats(analysis_util.games_stream(scanner, games_col),
-                    accum_stats, max_games=max_games)
+    def __init__(self, db):
+        scan_engine.AnalyzerPlugin.__init__(self, db)
+        self.buy_collection = db[BUYS_COL_NAME]
+        self.overall_stats = DeckBuyStats()
 
-def main(parsed_args):
-    """ Scan and update buy data"""
-    start = time.time()
-    db = utils.get_mongo_database()
-    games = db.games
-    output_db = db
+    def reset(self):
+        scan_engine.AnalyzerPlugin.reset(self)
+        self.buy_collection.drop()
 
-    overall_stats = DeckBuyStats()
+    def start(self):
+        utils.read_object_from_db(self.overall_stats, self.buy_collection, '')
 
-    scanner = incremental_scanner.IncrementalScanner(BUYS_COL_NAME, output_db)
-    buy_collection = output_db[BUYS_COL_NAME]
+    def analyze_game(self, game_obj):
+        accum_buy_stats([game_obj], self.overall_stats)
 
-    if not parsed_args.incremental:
-        log.warning('resetting scanner and db')
-        scanner.reset()
-        buy_collection.drop()
+    def partial_result(self):
+        return self.overall_stats.to_primitive_object()
 
-    start_size = scanner.get_num_games()
-    log.info("Starting run: %s", scanner.status_msg())
-    do_scan(scanner, games, overall_stats, parsed_args.max_games)
-    log.info("Ending run: %s", scanner.status_msg())
-    end_size = scanner.get_num_games()
+    def merge_partial_result(self, partial):
+        stats = DeckBuyStats()
+        stats.from_primitive_object(partial)
+        self.overall_stats.merge_partial(stats)
 
-    if parsed_args.incremental:
-        existing_overall_data = DeckBuyStats()
-        utils.read_object_from_db(existing_overall_data, buy_collection, '')
-        overall_stats.merge(existing_overall_data)
-        def deck_freq(data_set):
-            return data_set[dominioncards.Estate].available.frequency()
-        log.info('existing %s decks', deck_freq(existing_overall_data))
-        log.info('after merge %s decks', deck_freq(overall_stats))
+    def commit(self):
+        checkpoint = self.scanner.checkpoint()
+        checkpoint.save_object(self.overall_stats, self.buy_collection, '')
+        checkpoint.write()
 
-    utils.write_object_to_db(overall_stats, buy_collection, '')
-
-    scanner.save()
+def main(parsed_args):
+    """ Scan and update buy data"""
+    db = utils.get_mongo_database()
+    scan_engine.run_plugins(db, [BuyStatsPlugin(db)], parsed_args,
+                            parsed_args.processes)
 
 
 def profilemain():
@@ -199,6 +202,7 @@ def profilemain():
 
 if __name__ == '__main__':
     parser = utils.incremental_max_parser()
+    scan_engine.add_processes_argument(parser)
     args = parser.parse_args()
     dominionstats.utils.log.initialize_logging(args.debug)
     main(args)
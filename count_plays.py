@@ -1,83 +1,154 @@
-import pymongo
+#!/usr/bin/python
+
+""" Count how often combos of up to three cards are played on the same
+turn, and how well the players who play them do.
+
+Combos are counted in memory by PlayCounter and added into the plays
+collection in bulk, then compute_all_stats() adds rates and scores to every
+combo.  By default only the games that have not been counted yet are
+scanned, unless --noincremental is given.
+"""
+
+import logging
 from collections import defaultdict
+
 from keys import *
-#module-level things like this can break
-c = pymongo.Connection()
-games = c.test.games
+import dominioncards
+import dominionstats.utils.log
+import incremental_scanner
+import utils
+
+# Module-level logging instance
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+BASIC_CARDS = [dominioncards.Copper, dominioncards.Silver, dominioncards.Gold,
+               dominioncards.Potion, dominioncards.Platinum,
+               dominioncards.Estate, dominioncards.Duchy,
+               dominioncards.Province, dominioncards.Colony,
+               dominioncards.Curse]
+
+# The totals kept per combo, in the order PlayCounter keeps them.
+COUNTED_FIELDS = ['freq', 'win_points', 'victory_points', 'money']
+
+# The fields of the games that analyze_deck() reads.
+GAME_FIELDS = [DECKS + '.' + key for key in [WIN_POINTS, POINTS]] + [
+    DECKS + '.' + TURNS + '.' + key for key in [PLAYS, MONEY]]
+
+# PlayCounter flushes once it holds this many combos, which keeps it to a
+# few hundred megabytes.
+MAX_PENDING_COMBOS = 500000
+
+
+class PlayCounter(object):
+    """ Totals of COUNTED_FIELDS per combo, a sorted tuple of card names,
+    which haven't been added into collection yet, for the games scanner
+    has seen since it was last saved. """
+
+    def __init__(self, collection, scanner, max_pending=MAX_PENDING_COMBOS):
+        self.collection = collection
+        self.scanner = scanner
+        self.max_pending = max_pending
+        self.pending = {}
+        self.num_flushes = 0
+
+    def record_play(self, cards, win_points, victory_points, money,
+                    multiplicity):
+        occur = min(multiplicity[card] for card in cards)
+        counts = self.pending.get(cards)
+        if counts is None:
+            counts = self.pending[cards] = [0, 0, 0, 0]
+        counts[0] += occur
+        counts[1] += win_points * occur
+        counts[2] += victory_points * occur
+        counts[3] += money * occur
 
-plays = c.test.plays
-plays.ensure_index('key')
-plays.ensure_index('cards')
+    def is_full(self):
+        return len(self.pending) >= self.max_pending
 
-plays_by_turn = c.test.plays_by_turn
-plays_by_turn.ensure_index([('key', 1), ('turn', 1)])
-plays_by_turn.ensure_index('cards')
+    def flush(self):
+        """ Add the pending totals into collection, and save scanner, in
+        one checkpoint, and start over. """
+        checkpoint = self.scanner.checkpoint()
+        if self.pending:
+            log.info("Flushing %d combos", len(self.pending))
+            self.num_flushes += 1
+        for cards, counts in self.pending.iteritems():
+            checkpoint.increment(self.collection, 'key', '+'.join(cards),
+                                 dict(zip(COUNTED_FIELDS, counts)),
+                                 {'cards': list(cards), 'ncards': len(cards)})
+        checkpoint.write()
+        self.pending = {}
 
-BASIC_CARDS= ['Copper', 'Silver', 'Gold', 'Potion', 'Platinum',
-               'Estate', 'Duchy', 'Province', 'Colony', 'Curse']
 
-def analyze_plays():
+def analyze_plays(scanner, games, counter, max_games=-1):
     """
-    Analyze the card plays in all games.
+    Count the card plays in the games scanner hasn't seen into counter,
+    which flushes them with scanner whenever it is full.
     """
-    plays.remove()
-    plays_by_turn.remove()
-    counter = 0
-    for game in games.find():
-        counter += 1
-	# FIXME: Use game object instead
+    games = scanner.scan(games, {}, GAME_FIELDS)
+    for ind, game in enumerate(utils.progress_meter(games)):
+        # FIXME: Use game object instead
         for deck in game[DECKS]:
-            analyze_deck(deck)
-        if counter % 10 == 0:
-            print(counter)
-        if counter % 1000 == 100:
-            # instant gratification!
-            compute_all_stats()
-
-def compute_all_stats():
+            analyze_deck(deck, counter)
+        if counter.is_full():
+            counter.flush()
+        if ind + 1 == max_games:
+            log.info("Reached max_games of %d", max_games)
+            break
+
+
+def load_table(collection):
+    """ Return the totals of every combo in collection, in one pass, keyed
+    like PlayCounter.pending. """
+    table = {}
+    for combo in collection.find({}, ['cards'] + COUNTED_FIELDS):
+        table[tuple(combo['cards'])] = [combo[f] for f in COUNTED_FIELDS]
+    return table
+
+
+def compute_all_stats(collection, table):
     """
     After analyze_plays has been run, augment the combo data with interesting
-    statistics.
+    statistics.  table holds the totals of every combo in collection, as
+    load_table() returns them.
     """
-    print('Collecting stats...')
-    freqs = {}
+    log.info('Collecting stats for %d combos', len(table))
     total_freqs = defaultdict(float)
-    for combo in plays.find():
-        cards = tuple(combo['cards'])
-        freqs[cards] = combo['freq']
-        total_freqs[len(cards)] += combo['freq']
-    
+    for cards, counts in table.iteritems():
+        total_freqs[len(cards)] += counts[0]
+
     rates = {}
-    for cards in freqs:
-        rates[cards] = freqs[cards] / total_freqs[len(cards)]
-
-    for collection in (plays, plays_by_turn):
-        for combo in collection.find():
-            freq = float(combo['freq'])
-            cards = tuple(combo['cards'])
-            interestingness = _relative_rate(cards, rates)
-
-            # Interesting TODO: split the credit between multiple simultaneous
-            # combos, instead of giving all of them all the credit
-            combo['rate'] = rates[cards]
-            combo['interestingness'] = interestingness
-            combo['win_rate'] = combo['win_points'] / freq
-            combo['vp_rate'] = combo['victory_points'] / freq
-            combo['money_rate'] = combo['money'] / freq
-            combo['combo_score'] = combo['interestingness'] * combo['win_rate']
-            collection.save(combo)
-    
-def analyze_deck(deck):
+    for cards, counts in table.iteritems():
+        rates[cards] = counts[0] / total_freqs[len(cards)]
+
+    bulk = collection.initialize_unordered_bulk_op()
+    for cards, (freq, win_points, victory_points, money) in table.iteritems():
+        freq = float(freq)
+        interestingness = _relative_rate(cards, rates)
+        win_rate = win_points / freq
+
+        # Interesting TODO: split the credit between multiple simultaneous
+        # combos, instead of giving all of them all the credit
+        bulk.find({'key': '+'.join(cards)}).update_one(
+            {'$set': {'rate': rates[cards],
+                      'interestingness': interestingness,
+                      'win_rate': win_rate,
+                      'vp_rate': victory_points / freq,
+                      'money_rate': money / freq,
+                      'combo_score': interestingness * win_rate}})
+    if table:
+        bulk.execute()
+
+def analyze_deck(deck, counter):
     """
-    Analyze the card plays in a single recorded deck, adding results to the
-    `plays` and `plays_by_turn` collections.
+    Count the card plays in a single recorded deck into counter.
     """
     win_points = deck[WIN_POINTS]
     victory_points = deck[POINTS]
     for turn in deck[TURNS]:
         money = turn.get(MONEY, 0)
         plays = turn.get(PLAYS, [])
-        turn_number = turn['number']
 
         # Some bookkeeping to make sure we count repeated combos in a way
         # that matches intuition. For example:
@@ -85,51 +156,25 @@ def analyze_deck(deck):
         #   [Festival, Smithy, Smithy] also has 1 instance
         #   [Festival, Smithy, Festival, Smithy] has 2 instances
         multiplicity = defaultdict(int)
-        for card in plays:
+        for card in map(dominioncards.index_to_card, plays):
             if card not in BASIC_CARDS:
-                multiplicity[card] += 1
+                multiplicity[card.singular] += 1
         unique_plays = multiplicity.keys()
         unique_plays.sort()
 
         for i1, card1 in enumerate(unique_plays):
-            _record_play((card1,), win_points, victory_points,
-                         money, turn_number, multiplicity)
+            counter.record_play((card1,), win_points, victory_points,
+                                money, multiplicity)
             for i2, card2 in enumerate(unique_plays[i1+1:]):
-                _record_play((card1, card2),
-                             win_points, victory_points,
-                             money, turn_number, multiplicity)
+                counter.record_play((card1, card2),
+                                    win_points, victory_points,
+                                    money, multiplicity)
                 for i3, card3 in enumerate(unique_plays[i1+i2+2:]):
                     assert card3 != card1
                     assert card3 != card2
-                    _record_play((card1, card2, card3),
-                                 win_points, victory_points,
-                                 money, turn_number, multiplicity)
-
-def _record_play(cards, win_points, victory_points,
-                 money, turn_number, multiplicity):
-    occur = min(multiplicity[card] for card in cards)
-    key = '+'.join(cards)
-    
-    increases = {'freq': occur,
-                 'win_points': win_points * occur,
-                 'victory_points': victory_points * occur,
-                 'money': money * occur,
-                }
-
-    plays.update(
-        {'key': key},
-        {'$set': {'cards': list(cards), 'ncards': len(cards)},
-         '$inc': increases},
-        upsert=True,
-        safe=False
-    )
-    #plays_by_turn.update(
-    #    {'key': key, 'turn': turn_number},
-    #    {'$set': {'cards': list(cards), 'ncards': len(cards)},
-    #     '$inc': increases},
-    #    upsert=True,
-    #    safe=False
-    #)
+                    counter.record_play((card1, card2, card3),
+                                        win_points, victory_points,
+                                        money, multiplicity)
 
 def _relative_rate(combo, rates):
     """
@@ -151,7 +196,33 @@ def _relative_rate(combo, rates):
     #FIXME: this falls through if not 1/2/3
     return rates[combo] / expected
 
-if __name__ == '__main__':
-    print('Analyzing games...')
-    analyze_plays()
+def main(args):
+    db = utils.get_mongo_database()
+    plays = db.plays
+    scanner = incremental_scanner.IncrementalScanner('count_plays', db)
+    if not args.incremental:
+        log.warning('resetting scanner and db')
+        scanner.reset()
+        plays.drop()
+    plays.ensure_index('key')
+    plays.ensure_index('cards')
+
+    log.info("Starting run: %s", scanner.status_msg())
+    counter = PlayCounter(plays, scanner)
+    analyze_plays(scanner, db.games, counter, args.max_games)
 
+    # On a rebuild that never had to flush, the counter holds the whole
+    # table, so there is no need to read it back.
+    table = None
+    if not args.incremental and counter.num_flushes == 0:
+        table = counter.pending
+    counter.flush()
+    log.info("Ending run: %s", scanner.status_msg())
+
+    compute_all_stats(plays, table if table is not None else load_table(plays))
+
+if __name__ == '__main__':
+    parser = utils.incremental_max_parser()
+    args = parser.parse_args()
+    dominionstats.utils.log.initialize_logging(args.debug)
+    main(args)
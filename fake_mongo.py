@@ -0,0 +1,271 @@
+#!/usr/bin/python
+
+""" In-memory stand-ins for MongoDB collections, for the unit tests.
+
+They implement just the parts of the pymongo Collection API that the
+parsing and scraping code uses: save(), find() with equality and $in
+queries and a field list, and unordered bulk upserts, plus the find_one(),
+$gt/$lte queries, dotted field projections, cursor
+sort/skip/limit/count/batch_size, $inc and $addToSet bulk updates, bulk
+inserts, remove() and drop() that the analyzers use, and the $exists
+queries, find_and_modify() counters and $push and $pull updates of the
+ingest sequence.
+"""
+
+import codecs
+import bz2
+
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+
+# Isotropic logs under testing/testdata that parse cleanly.
+TEST_GAME_IDS = ['game-20101015-024842-a866e78a.html',
+                 'game-20101015-094051-95e0a59e.html',
+                 'game-20110803-135820-f9c87de6.html',
+                 'game-20130111-164348-84fd128e.html']
+
+
+def test_game_contents(game_id):
+    """ Return the contents of the isotropic log for game_id. """
+    return codecs.open('testing/testdata/' + game_id, encoding='utf-8').read()
+
+
+def raw_game_doc(game_id, contents):
+    """ Return a raw_games collection style document for contents. """
+    return {'_id': game_id,
+            'game_date': game_id.split('-')[1],
+            'text': bz2.compress(contents.encode('utf-8'))}
+
+
+def sample_raw_game_docs():
+    return [raw_game_doc(game_id, test_game_contents(game_id))
+            for game_id in TEST_GAME_IDS]
+
+
+def matches(doc, spec):
+    for key, value in spec.iteritems():
+        if isinstance(value, dict) and '$in' in value:
+            if doc.get(key) not in value['$in']:
+                return False
+        elif isinstance(value, dict) and '$exists' in value:
+            if (key in doc) != value['$exists']:
+                return False
+        elif isinstance(value, dict):
+            if key not in doc:
+                return False
+            if '$gt' in value and not doc[key] > value['$gt']:
+                return False
+            if '$lte' in value and not doc[key] <= value['$lte']:
+                return False
+        elif doc.get(key) != value:
+            return False
+    return True
+
+
+def update_doc(doc, update):
+    """ Apply the $inc, $set, $addToSet, $push and $pull of update to doc.
+    $pull only takes a query that the array's documents match. """
+    for key, value in update.get('$inc', {}).iteritems():
+        doc[key] = doc.get(key, 0) + value
+    doc.update(update.get('$set', {}))
+    for key, value in update.get('$addToSet', {}).iteritems():
+        array = doc.setdefault(key, [])
+        for item in value['$each']:
+            if item not in array:
+                array.append(item)
+    for key, value in update.get('$push', {}).iteritems():
+        doc.setdefault(key, []).append(value)
+    for key, spec in update.get('$pull', {}).iteritems():
+        doc[key] = [item for item in doc.get(key, [])
+                    if not matches(item, spec)]
+
+
+def project(value, paths):
+    """ Return the parts of value that the paths, lists of keys, select,
+    the way MongoDB projects fields: dotted paths reach into each document
+    in a list, and drop the list's other elements. """
+    if isinstance(value, list):
+        return [project(item, paths) for item in value
+                if isinstance(item, dict)]
+    ret = {}
+    for key in value:
+        sub_paths = [path[1:] for path in paths if path[0] == key]
+        if not sub_paths:
+            continue
+        if [] in sub_paths or not isinstance(value[key], (dict, list)):
+            ret[key] = value[key]
+        else:
+            ret[key] = project(value[key], sub_paths)
+    return ret
+
+
+class FakeCollection(object):
+    """ Keeps its documents in a list, in the order they were written.
+
+    Bulk upserts of documents whose _id is in failing_ids fail with a write
+    error, as a duplicate key would.
+    """
+
+    def __init__(self, docs=(), failing_ids=(), name=None, database=None):
+        self.name = name
+        # Collections made on their own get a database of their own, for
+        # the ingest sequence counters.
+        self.database = database if database is not None else FakeDatabase()
+        self.docs = list(docs)
+        self.failing_ids = set(failing_ids)
+        self.num_bulk_writes = 0
+
+    def ids(self):
+        return [doc.get('_id') for doc in self.docs]
+
+    def index(self, field):
+        """ Return a dict of the documents by their value of field. """
+        return dict((doc[field], doc) for doc in self.docs if field in doc)
+
+    def replace(self, doc):
+        if '_id' in doc:
+            self.docs = [d for d in self.docs if d.get('_id') != doc['_id']]
+        self.docs.append(doc)
+
+    def save(self, doc, **kwargs):
+        self.replace(doc)
+
+    def find(self, spec=None, fields=None):
+        found = [doc for doc in self.docs if matches(doc, spec or {})]
+        if fields is None:
+            return FakeCursor(found)
+        paths = [field.split('.') for field in ['_id'] + list(fields)]
+        return FakeCursor(project(doc, paths) for doc in found)
+
+    def find_one(self, spec=None, fields=None):
+        found = self.find(spec, fields)
+        return found[0] if found else None
+
+    def find_and_modify(self, query, update, upsert=False, new=False):
+        """ Returns the new version of the document. """
+        assert new
+        doc = self.find_one(query)
+        if doc is None:
+            if not upsert:
+                return None
+            if self.find_one({'_id': query['_id']}):
+                raise DuplicateKeyError('duplicate key error')
+            doc = dict(query)
+            self.docs.append(doc)
+        update_doc(doc, update)
+        return doc
+
+    def update(self, spec, update, upsert=False):
+        """ Only of a single document. """
+        doc = self.find_one(spec)
+        if doc is None:
+            if not upsert:
+                return
+            doc = dict(spec)
+            self.docs.append(doc)
+        update_doc(doc, update)
+
+    def remove(self, spec=None):
+        self.docs = [doc for doc in self.docs if not matches(doc, spec or {})]
+
+    def drop(self):
+        self.docs = []
+
+    def ensure_index(self, *args, **kwargs):
+        pass
+
+    def initialize_unordered_bulk_op(self):
+        return FakeBulkOp(self)
+
+
+class FakeCursor(list):
+    def count(self):
+        return len(self)
+
+    def sort(self, key, direction):
+        return FakeCursor(sorted(self, key=lambda doc: doc[key],
+                                 reverse=direction < 0))
+
+    def skip(self, num):
+        return FakeCursor(self[num:])
+
+    def limit(self, num):
+        return FakeCursor(self[:num])
+
+    def batch_size(self, num):
+        self.requested_batch_size = num
+        return self
+
+
+class FakeDatabase(object):
+    """ Makes a FakeCollection for each collection name on first use. """
+
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = FakeCollection(name=name, database=self)
+        return self.collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+
+class FakeBulkOp(object):
+    def __init__(self, collection):
+        self.collection = collection
+        self.ops = []
+        self.selector = None
+
+    def find(self, selector):
+        self.selector = selector
+        return self
+
+    def upsert(self):
+        return self
+
+    def replace_one(self, doc):
+        self.ops.append(('replace', doc))
+
+    def insert(self, doc):
+        self.ops.append(('replace', doc))
+
+    def update_one(self, update):
+        self.ops.append(('update', (self.selector, update)))
+
+    def execute(self):
+        self.collection.num_bulk_writes += 1
+        write_errors = []
+        result = {'nUpserted': 0, 'nMatched': 0}
+        indexes = {}
+        for index, (op, arg) in enumerate(self.ops):
+            if op == 'update':
+                self.apply_update(arg, indexes, result)
+            elif arg['_id'] in self.collection.failing_ids:
+                write_errors.append({'index': index, 'code': 11000,
+                                     'errmsg': 'duplicate key error'})
+            else:
+                self.collection.replace(arg)
+        if write_errors:
+            raise BulkWriteError({'writeErrors': write_errors})
+        return result
+
+    def apply_update(self, (selector, update), indexes, result):
+        """ Apply an upserted update whose selector is a single field,
+        looking documents up in indexes, a dict of index() by field. """
+        (field, value), = selector.items()
+        if field not in indexes:
+            indexes[field] = self.collection.index(field)
+        docs_by_value = indexes[field]
+        doc = docs_by_value.get(value)
+        if doc is not None:
+            result['nMatched'] += 1
+        else:
+            doc = dict(selector)
+            self.collection.docs.append(doc)
+            docs_by_value[value] = doc
+            result['nUpserted'] += 1
+        update_doc(doc, update)
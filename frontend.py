@@ -530,7 +530,7 @@ class GoalsPage(object):
             ret += '<th>%s<td align="right">%d<td align="right">%.2f<td align="center">%s' % (goal_name, g['count'], g['count']*100./n, goals.GetGoalDescription(goal_name))
             rank = 1
             ret += '<td>'
-            for (players, count) in g['top']:
+            for (players, count) in g.get('top', []):
                 if len(players)==1:
                     ret += "%d) %s (%d)<br />" % (rank, game.PlayerDeck.PlayerLink(players[0]), count)
                 else:
@@ -574,7 +574,7 @@ class SupplyWinApi(object):
                 db_val = db.card_supply.find_one({'_id': key})
                 if db_val:
                     small_gain_stat = SmallGainStat()
-                    small_gain_stat.from_primitive_object(db_val['vals'])
+                    small_gain_stat.from_flat_dict(db_val)
                     def name_getter(ind_str):
                         return dominioncards.index_to_card(int(ind_str)).singular
                     card_name = name_getter(target_ind)
@@ -19,6 +19,13 @@ WIN, LOSS, TIE = range(3)
 BOUGHT=0           # Player bought or gained in own turn
 GAINED=1           # Player bought or gained in any turn
 
+# The fields of a game document that Game reads, as a projection.  Of the
+# deck fields, only the name, points, turn order and turns are required;
+# the rest may be projected out by analyzers that don't need them.
+GAME_FIELDS = [SUPPLY, VETO, PLAYERS] + [
+    DECKS + '.' + key
+    for key in [NAME, WIN_POINTS, POINTS, DECK, ORDER, RESIGNED, TURNS]]
+
 
 class PlayerDeckChange(object):
     " This represents a change to a players deck in response to a game event."
@@ -169,10 +176,10 @@ class PlayerDeck(object):
         self.raw_player = player_deck_dict
         self.game = game
         self.player_name = player_deck_dict[NAME]
-        self.win_points = player_deck_dict[WIN_POINTS]
+        self.win_points = player_deck_dict.get(WIN_POINTS)
         self.points = player_deck_dict[POINTS]
         self.deck = {}
-        for (index, count) in player_deck_dict[DECK].iteritems():
+        for (index, count) in player_deck_dict.get(DECK, {}).iteritems():
             self.deck[ index_to_card(int(index)) ] = count
         self.turn_order = player_deck_dict[ORDER]
         self.num_real_turns = 0
@@ -228,7 +235,7 @@ class PlayerDeck(object):
 class Game(object):
     def __init__(self, game_dict):
         self.turns = []
-        self.supply = [index_to_card(i) for i in game_dict[SUPPLY]]
+        self.supply = [index_to_card(i) for i in game_dict.get(SUPPLY, [])]
         self.vetoes = game_dict.get(VETO, {})
         # pprint.pprint(game_dict)
 
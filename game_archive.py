@@ -0,0 +1,423 @@
+#!/usr/bin/python
+
+""" A columnar, memory-mapped copy of the games collection, for analyses
+that scan the whole history.
+
+export_games() writes every game to a directory of flat binary columns, one
+file per column, plus a columns.json manifest of their dtypes and lengths.
+There are four levels of rows -- games, player decks, turns and opponent
+changes (the gains, trashes, etc. that a turn causes for another player) --
+and each level points at its children with an offsets column: the decks of
+game i are rows game_decks_offsets[i] to game_decks_offsets[i + 1] of the
+deck columns,
+and so on.  Lists of cards, like a turn's buys, are stored the same way, as
+an offsets column into a column of card indexes.
+
+GameView memory-maps the columns, so whole-history aggregates can work on
+the arrays directly, and it can also rebuild each game's document, so
+anything that takes game.Game objects (like the scan_engine plugins) can
+run over it instead of over Mongo.
+"""
+
+import argparse
+import json
+import logging
+import os
+import os.path
+
+import numpy
+
+from keys import *
+import dominionstats.utils.log
+import utils
+
+# Module-level logging instance
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+MANIFEST_NAME = 'columns.json'
+
+# Items buffered per column before they are written out.
+WRITE_CHUNK_SIZE = 65536
+
+CARD_DTYPE = numpy.int16
+OFFSET_DTYPE = numpy.int64
+
+# The per turn lists of cards, and those of the opponent changes.
+TURN_CARD_LISTS = [PLAYS, BUYS, GAINS, TRASHES, RETURNS]
+OPP_CARD_LISTS = [BUYS, GAINS, TRASHES, RETURNS]
+
+# Bits of the turn_flags column.
+OUTPOST_FLAG = 1
+POSSESSION_FLAG = 2
+
+# Names of the columns of card lists, by key.
+LIST_NAMES = {PLAYS: 'plays', BUYS: 'buys', GAINS: 'gains',
+              TRASHES: 'trashes', RETURNS: 'returns'}
+
+
+class ColumnWriter(object):
+    """ Appends values of one dtype to a column file, in chunks. """
+
+    def __init__(self, path, name, dtype):
+        self.name = name
+        self.dtype = numpy.dtype(dtype)
+        self.out = open(os.path.join(path, name + '.bin'), 'wb')
+        self.chunk = []
+        self.length = 0
+
+    def append(self, value):
+        self.chunk.append(value)
+        if len(self.chunk) >= WRITE_CHUNK_SIZE:
+            self.flush()
+
+    def extend(self, values):
+        self.chunk.extend(values)
+        if len(self.chunk) >= WRITE_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        numpy.array(self.chunk, dtype=self.dtype).tofile(self.out)
+        self.length += len(self.chunk)
+        self.chunk = []
+
+    def close(self):
+        self.flush()
+        self.out.close()
+
+
+class OffsetsWriter(ColumnWriter):
+    """ Appends the end of each row's range of child rows, after a leading
+    0, so that row i's children are offsets[i] to offsets[i + 1]. """
+
+    def __init__(self, path, name):
+        ColumnWriter.__init__(self, path, name + '_offsets', OFFSET_DTYPE)
+        self.append(0)
+        self.end = 0
+
+    def add_row(self, num_children):
+        self.end += num_children
+        self.append(self.end)
+
+
+class RaggedWriter(object):
+    """ Appends lists of values, as an offsets column into a values column.
+    """
+
+    def __init__(self, path, name, dtype):
+        self.offsets = OffsetsWriter(path, name)
+        self.values = ColumnWriter(path, name, dtype)
+
+    def append(self, values):
+        self.values.extend(values)
+        self.offsets.add_row(len(values))
+
+    def columns(self):
+        return [self.offsets, self.values]
+
+
+class StringWriter(RaggedWriter):
+    """ Appends unicode strings, encoded as utf-8. """
+
+    def __init__(self, path, name):
+        RaggedWriter.__init__(self, path, name, numpy.uint8)
+
+    def append(self, value):
+        RaggedWriter.append(self, bytearray(value.encode('utf-8')))
+
+
+class ArchiveWriter(object):
+    """ Writes games, one at a time, to the columns in path. """
+
+    def __init__(self, path):
+        self.path = path
+        utils.ensure_exists(path)
+        self.columns = []
+        for name, dtype in [('game_ingest_seq', numpy.int64),
+                            ('game_resigned', numpy.bool_),
+                            ('veto_player', numpy.int8),
+                            ('veto_card', CARD_DTYPE),
+                            ('deck_order', numpy.int8),
+                            ('deck_points', numpy.int16),
+                            ('deck_win_points', numpy.float64),
+                            ('deck_vp_tokens', numpy.int16),
+                            ('deck_resigned', numpy.bool_),
+                            ('deck_card_counts', numpy.int16),
+                            ('turn_money', numpy.int16),
+                            ('turn_vp_tokens', numpy.int16),
+                            ('turn_pirate_tokens', numpy.int16),
+                            ('turn_flags', numpy.uint8),
+                            ('opp_player', numpy.int8),
+                            ('opp_vp_tokens', numpy.int16)]:
+            self.add(name, ColumnWriter(path, name, dtype))
+        for name in ['game_vetoes', 'game_decks', 'deck_turns', 'turn_opps']:
+            self.add(name, OffsetsWriter(path, name))
+        for name in ['supply', 'game_end', 'deck_cards'] + [
+            'turn_' + LIST_NAMES[key] for key in TURN_CARD_LISTS] + [
+            'opp_' + LIST_NAMES[key] for key in OPP_CARD_LISTS]:
+            self.add(name, RaggedWriter(path, name, CARD_DTYPE))
+        for name in ['game_id', 'deck_name']:
+            self.add(name, StringWriter(path, name))
+        self.num_games = 0
+
+    def add(self, name, writer):
+        setattr(self, name, writer)
+        if isinstance(writer, RaggedWriter):
+            self.columns.extend(writer.columns())
+        else:
+            self.columns.append(writer)
+
+    def write_game(self, game_dict):
+        self.num_games += 1
+        self.game_id.append(unicode(game_dict['_id']))
+        self.game_ingest_seq.append(game_dict[INGEST_SEQ])
+        self.supply.append(game_dict[SUPPLY])
+        self.game_end.append(game_dict.get(GAME_END, []))
+        self.game_resigned.append(game_dict.get(RESIGNED, False))
+
+        vetoes = sorted(game_dict.get(VETO, {}).iteritems())
+        for player, card in vetoes:
+            self.veto_player.append(int(player))
+            self.veto_card.append(card)
+        self.game_vetoes.add_row(len(vetoes))
+
+        for deck in game_dict[DECKS]:
+            self.write_deck(deck)
+        self.game_decks.add_row(len(game_dict[DECKS]))
+
+    def write_deck(self, deck):
+        self.deck_name.append(deck[NAME])
+        self.deck_order.append(deck[ORDER])
+        self.deck_points.append(deck[POINTS])
+        self.deck_win_points.append(deck[WIN_POINTS])
+        self.deck_vp_tokens.append(deck.get(VP_TOKENS, 0))
+        self.deck_resigned.append(deck.get(RESIGNED, False))
+        composition = sorted((int(card), count)
+                             for card, count in deck[DECK].iteritems())
+        self.deck_cards.append([card for card, _ in composition])
+        self.deck_card_counts.extend([count for _, count in composition])
+
+        for turn in deck[TURNS]:
+            self.write_turn(turn)
+        self.deck_turns.add_row(len(deck[TURNS]))
+
+    def write_turn(self, turn):
+        self.turn_money.append(turn.get(MONEY, 0))
+        self.turn_vp_tokens.append(turn.get(VP_TOKENS, 0))
+        self.turn_pirate_tokens.append(turn.get(PIRATE_TOKENS, 0))
+        self.turn_flags.append((OUTPOST_FLAG if turn.get(OUTPOST) else 0) |
+                               (POSSESSION_FLAG if turn.get(POSSESSION)
+                                else 0))
+        for key in TURN_CARD_LISTS:
+            getattr(self, 'turn_' + LIST_NAMES[key]).append(
+                turn.get(key, []))
+
+        opps = sorted(turn.get(OPP, {}).iteritems())
+        for player, changes in opps:
+            self.opp_player.append(int(player))
+            self.opp_vp_tokens.append(changes.get(VP_TOKENS, 0))
+            for key in OPP_CARD_LISTS:
+                getattr(self, 'opp_' + LIST_NAMES[key]).append(
+                    changes.get(key, []))
+        self.turn_opps.add_row(len(opps))
+
+    def close(self):
+        """ Write out the columns, and then the manifest, which marks the
+        archive as complete. """
+        manifest = {'num_games': self.num_games, 'columns': {}}
+        for column in self.columns:
+            column.close()
+            manifest['columns'][column.name] = [column.dtype.str,
+                                                column.length]
+        with open(os.path.join(self.path, MANIFEST_NAME), 'w') as out:
+            json.dump(manifest, out, indent=1, sort_keys=True)
+
+
+def export_games(games_col, path, query=None):
+    """ Write the games in games_col matching query to an archive in path,
+    in ingest sequence order.  Return the number of games written. """
+    if os.path.exists(os.path.join(path, MANIFEST_NAME)):
+        os.remove(os.path.join(path, MANIFEST_NAME))
+    writer = ArchiveWriter(path)
+    for game_dict in utils.progress_meter(
+        games_col.find(query or {}).sort(INGEST_SEQ, 1)):
+        writer.write_game(game_dict)
+    writer.close()
+    return writer.num_games
+
+
+class StringColumn(object):
+    """ A sequence of the strings in a StringWriter's columns. """
+
+    def __init__(self, offsets, chars):
+        self.offsets = offsets
+        self.chars = chars
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, ind):
+        return self.chars[self.offsets[ind]:self.offsets[ind + 1]
+                          ].tostring().decode('utf-8')
+
+
+class GameView(object):
+    """ Read-only view of an archive written by export_games().
+
+    column(name) returns a memory-mapped column.  game_dict(i) rebuilds the
+    document of the i'th game, and find() iterates over documents the way
+    a games collection cursor does, so a GameView can stand in for db.games
+    as the source of a scan.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_NAME)) as manifest_file:
+            manifest = json.load(manifest_file)
+        self.num_games = manifest['num_games']
+        self.columns = {}
+        for name, (dtype, length) in manifest['columns'].iteritems():
+            if length:
+                self.columns[name] = numpy.memmap(
+                    os.path.join(path, name + '.bin'), dtype=dtype, mode='r',
+                    shape=(length,))
+            else:
+                self.columns[name] = numpy.zeros(0, dtype=dtype)
+        self.game_ids = StringColumn(self.column('game_id_offsets'),
+                                     self.column('game_id'))
+        self.deck_names = StringColumn(self.column('deck_name_offsets'),
+                                       self.column('deck_name'))
+
+    def __len__(self):
+        return self.num_games
+
+    def column(self, name):
+        return self.columns[name]
+
+    def rows(self, name, ind):
+        """ Return the range of child rows of row ind, for the offsets
+        column name_offsets. """
+        offsets = self.columns[name + '_offsets']
+        return xrange(offsets[ind], offsets[ind + 1])
+
+    def cards(self, name, ind, offsets_name=None):
+        """ Return the list of row ind of the list name, which is indexed
+        by the offsets column of offsets_name, or else of name. """
+        offsets = self.columns[(offsets_name or name) + '_offsets']
+        return self.columns[name][offsets[ind]:offsets[ind + 1]].tolist()
+
+    def game_dict(self, ind):
+        """ Return the document of game ind, as parse_game made it, without
+        the parser version and hash. """
+        deck_rows = self.rows('game_decks', ind)
+        decks = [self.deck_dict(deck_row) for deck_row in deck_rows]
+        ret = {'_id': self.game_ids[ind],
+               INGEST_SEQ: int(self.columns['game_ingest_seq'][ind]),
+               SUPPLY: self.cards('supply', ind),
+               GAME_END: self.cards('game_end', ind),
+               RESIGNED: bool(self.columns['game_resigned'][ind]),
+               VETO: dict((str(self.columns['veto_player'][row]),
+                           int(self.columns['veto_card'][row]))
+                          for row in self.rows('game_vetoes', ind)),
+               DECKS: decks,
+               PLAYERS: [deck[NAME] for deck in decks]}
+        return ret
+
+    def deck_dict(self, row):
+        columns = self.columns
+        ret = {NAME: self.deck_names[row],
+               ORDER: int(columns['deck_order'][row]),
+               POINTS: int(columns['deck_points'][row]),
+               WIN_POINTS: float(columns['deck_win_points'][row]),
+               VP_TOKENS: int(columns['deck_vp_tokens'][row]),
+               RESIGNED: bool(columns['deck_resigned'][row]),
+               DECK: dict(zip(map(str, self.cards('deck_cards', row)),
+                              self.cards('deck_card_counts', row,
+                                         'deck_cards'))),
+               TURNS: [self.turn_dict(turn_row)
+                       for turn_row in self.rows('deck_turns', row)]}
+        return ret
+
+    def turn_dict(self, row):
+        columns = self.columns
+        ret = {}
+        flags = columns['turn_flags'][row]
+        for key, value in [
+            (MONEY, int(columns['turn_money'][row])),
+            (VP_TOKENS, int(columns['turn_vp_tokens'][row])),
+            (PIRATE_TOKENS, int(columns['turn_pirate_tokens'][row])),
+            (OUTPOST, bool(flags & OUTPOST_FLAG)),
+            (POSSESSION, bool(flags & POSSESSION_FLAG))] + [
+            (key, self.cards('turn_' + LIST_NAMES[key], row))
+            for key in TURN_CARD_LISTS]:
+            if value:
+                ret[key] = value
+
+        opps = {}
+        for opp_row in self.rows('turn_opps', row):
+            changes = {}
+            vp_tokens = int(columns['opp_vp_tokens'][opp_row])
+            if vp_tokens:
+                changes[VP_TOKENS] = vp_tokens
+            for key in OPP_CARD_LISTS:
+                cards = self.cards('opp_' + LIST_NAMES[key], opp_row)
+                if cards:
+                    changes[key] = cards
+            opps[str(columns['opp_player'][opp_row])] = changes
+        if opps:
+            ret[OPP] = opps
+        return ret
+
+    def find(self, spec=None, fields=None):
+        """ Return a cursor over the game documents in ingest sequence
+        order.  spec may only restrict INGEST_SEQ, with $gt and $lte.  The
+        documents are rebuilt whole, so fields is ignored. """
+        seq_spec = (spec or {}).get(INGEST_SEQ, {})
+        assert set(spec or {}) <= set([INGEST_SEQ])
+        assert set(seq_spec) <= set(['$gt', '$lte']), seq_spec
+        seqs = self.columns['game_ingest_seq']
+        start = 0
+        end = self.num_games
+        if '$gt' in seq_spec:
+            start = int(numpy.searchsorted(seqs, seq_spec['$gt'], 'right'))
+        if '$lte' in seq_spec:
+            end = int(numpy.searchsorted(seqs, seq_spec['$lte'], 'right'))
+        return GameViewCursor(self, start, end)
+
+
+class GameViewCursor(object):
+    """ Iterates over the games of a GameView from start up to end. """
+
+    def __init__(self, view, start, end):
+        self.view = view
+        self.start = start
+        self.end = end
+
+    def __iter__(self):
+        for ind in xrange(self.start, self.end):
+            yield self.view.game_dict(ind)
+
+    def sort(self, key, direction):
+        # The games are stored in ingest sequence order.
+        assert (key, direction) == (INGEST_SEQ, 1), (key, direction)
+        return self
+
+    def batch_size(self, num):
+        return self
+
+
+def main(args):
+    db = utils.get_mongo_database()
+    log.info("Exporting games to %s", args.path)
+    num_games = export_games(db.games, args.path)
+    log.info("Exported %d games", num_games)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--path', default='game_archive_data',
+                        help='directory to write the archive to')
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+    dominionstats.utils.log.initialize_logging(args.debug)
+    main(args)
@@ -1,77 +1,196 @@
 #!/usr/bin/python
 
-# Module-level logging instance
-import logging
-log = logging.getLogger(__name__)
-log.addHandler(logging.NullHandler())
+""" Count how often each goal was achieved, in all and by each player.
+
+The goal documents are read in one scan, counting every goal at once, and
+only the ones written since the last run, by following the goal ingest
+sequence that goals.py stamps them with, up to its last settled number
+(see ingest_sequence.py).  A game's
+goals are counted once per goal name, for the first player listed with it.
+
+The pairs of goal name and player counted for each goal document are kept,
+so that a document rewritten with other goals has its old pairs taken back
+out.  The per player counts are added to in checkpoints of the goal_counts
+scanner, which also add to the totals in goal_stats and mark them stale;
+the stale goals then have their leaders worked out again from the counts.
+"""
 
 import collections
-import operator
+import logging
 
+from keys import *
 import dominionstats.utils.log
 import goals
 import incremental_scanner
+import ingest_sequence
 import utils
 
+# Module-level logging instance
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+GOAL_STATS_COL_NAME = 'goal_stats'
+PLAYER_COUNTS_COL_NAME = 'goal_player_counts'
+COUNTED_COL_NAME = 'goal_stats_counted'
 
-def main(parsed_args):
-    db = utils.get_mongo_database()
-    goal_db = db.goals
-    gstats_db = db.goal_stats
-    all_goals = goals.goal_check_funcs.keys()
-    total_pcount = collections.defaultdict(int)
-    goal_scanner = incremental_scanner.IncrementalScanner('goals', db)
-    stat_scanner = incremental_scanner.IncrementalScanner('goal_stats', db)
-
-    if not parsed_args.incremental:
+# Goal documents whose counted pairs are fetched per round trip, and goal
+# documents counted per checkpoint.
+FETCH_BATCH_SIZE = 1000
+COMMIT_AFTER = 10000
+
+# Leaders listed per goal, ties included.
+NUM_LEADERS = 3
+
+
+def counted_goals(goal_doc):
+    """ Return the [goal name, player] pairs that goal_doc counts for. """
+    pairs = []
+    seen = set()
+    for goal in goal_doc.get('goals', []):
+        if goal['goal_name'] not in seen:
+            seen.add(goal['goal_name'])
+            pairs.append([goal['goal_name'], goal['player']])
+    return pairs
+
+
+def top_players(pcount):
+    """ Return the leaders of the dict of counts by player pcount, as a list
+    of ([players], count), most first, tied players together. """
+    psorted = sorted(((count, player) for player, count in pcount.iteritems()
+                      if count > 0), key=lambda item: (-item[0], item[1]))
+    top = []
+    leaders = 0
+    i = 0
+    while leaders < NUM_LEADERS and i < len(psorted):
+        (count, player) = psorted[i]
+        players = [player]
+        i += 1
+        while i < len(psorted) and psorted[i][0] == count:
+            players.append(psorted[i][1])
+            i += 1
+        leaders += len(players)
+        top.append((players, count))
+    return top
+
+
+class GoalCounter(object):
+    """ Adds the goal documents scanned by scanner to the goal counts. """
+
+    def __init__(self, db, scanner):
+        self.db = db
+        self.scanner = scanner
+        self.counted_col = db[COUNTED_COL_NAME]
+        self.player_counts_col = db[PLAYER_COUNTS_COL_NAME]
+        self.goal_stats_col = db[GOAL_STATS_COL_NAME]
+        self.deltas = collections.defaultdict(int)
+        # The pairs of the documents counted since the last commit.
+        self.pending = {}
+
+    def add_docs(self, goal_docs):
+        """ Count goal_docs, taking out what older versions of them were
+        counted for. """
+        previous = dict((doc['_id'], doc['goals']) for doc in
+                        self.counted_col.find(
+                {'_id': {'$in': [d['_id'] for d in goal_docs
+                                 if d['_id'] not in self.pending]}}))
+        previous.update(self.pending)
+        for goal_doc in goal_docs:
+            game_id = goal_doc['_id']
+            pairs = counted_goals(goal_doc)
+            old_pairs = previous.get(game_id, [])
+            for goal_name, player in old_pairs:
+                self.deltas[goal_name, player] -= 1
+            for goal_name, player in pairs:
+                self.deltas[goal_name, player] += 1
+            if pairs or old_pairs:
+                self.pending[game_id] = previous[game_id] = pairs
+
+    def commit(self):
+        checkpoint = self.scanner.checkpoint()
+        totals = collections.defaultdict(int)
+        for (goal_name, player), delta in self.deltas.iteritems():
+            if delta:
+                checkpoint.increment(
+                    self.player_counts_col, '_id',
+                    '%s:%s' % (goal_name, player), {'count': delta},
+                    {'goal': goal_name, 'player': player})
+                totals[goal_name] += delta
+        for goal_name, delta in totals.iteritems():
+            checkpoint.increment(self.goal_stats_col, '_id', goal_name,
+                                 {'count': delta}, {'stale': True})
+        for game_id, pairs in self.pending.iteritems():
+            checkpoint.replace(self.counted_col,
+                               {'_id': game_id, 'goals': pairs})
+        checkpoint.write()
+        self.deltas.clear()
+        self.pending = {}
+
+
+def update_leaders(db):
+    """ Work out the leaders again of the goals whose counts changed, or
+    that have no stats yet. """
+    gstats_db = db[GOAL_STATS_COL_NAME]
+    stale = set(doc['_id'] for doc in gstats_db.find({'stale': True}, []))
+    stale.update(set(goals.goal_check_funcs) - set(
+            doc['_id'] for doc in gstats_db.find({}, [])))
+    if not stale:
+        return
+
+    pcounts = dict((goal_name, {}) for goal_name in stale)
+    for doc in db[PLAYER_COUNTS_COL_NAME].find(
+        {'goal': {'$in': list(stale)}}, ['goal', 'player', 'count']):
+        pcounts[doc['goal']][doc['player']] = doc['count']
+
+    bulk = gstats_db.initialize_unordered_bulk_op()
+    for goal_name, pcount in pcounts.iteritems():
+        log.info("Found %d instances of %s", sum(pcount.values()), goal_name)
+        bulk.find({'_id': goal_name}).upsert().replace_one(
+            {'_id': goal_name, 'count': sum(pcount.values()),
+             'top': top_players(pcount)})
+    bulk.execute()
+
+
+def count_goals(db, incremental=True):
+    """ Count the goal documents in db written since the last run, or all
+    of them again unless incremental, and update the goal stats. """
+    stat_scanner = incremental_scanner.IncrementalScanner('goal_counts', db)
+
+    # Goal documents written before goals.py numbered them.
+    num_stamped = ingest_sequence.stamp_unsequenced_games(
+        db.goals, ingest_sequence.GOALS_SEQUENCE)
+    if num_stamped:
+        log.info('Numbered %d goal documents', num_stamped)
+
+    if not incremental or not stat_scanner.get_num_games():
         log.warning('resetting scanner and db')
         stat_scanner.reset()
-        gstats_db.remove()
+        for name in [GOAL_STATS_COL_NAME, PLAYER_COUNTS_COL_NAME,
+                     COUNTED_COL_NAME]:
+            db[name].drop()
 
     log.info("Starting run: %s", stat_scanner.status_msg())
+    counter = GoalCounter(db, stat_scanner)
+    num_counted = 0
+    for goal_docs in utils.chunks(
+        utils.progress_meter(stat_scanner.scan(
+                db.goals, {}, ['goals.goal_name', 'goals.player'],
+                sequence=ingest_sequence.GOALS_SEQUENCE)),
+        FETCH_BATCH_SIZE):
+        counter.add_docs(goal_docs)
+        num_counted += len(goal_docs)
+        if num_counted >= COMMIT_AFTER:
+            counter.commit()
+            num_counted = 0
+    counter.commit()
 
-    # TODO: The following logic doesn't work now that goal calculation doesn't happen with a scanner.
-    # if goal_scanner.get_max_game_id() == stat_scanner.get_max_game_id():
-    #     log.info("Stats already set! Skip")
-    #     exit(0)
-
-    log.info('all_goals %s', all_goals)
-    for goal_name in all_goals:
-        log.info("Working on %s", goal_name)
-        found_goals_cursor = goal_db.find({'goals.goal_name': goal_name},
-                                          {'goals.player': 1, '_id': 0})
-        total = found_goals_cursor.count()
-        log.info("Found %d instances of %s", total, goal_name)
-
-        pcount = collections.defaultdict(int)
-        for goal in found_goals_cursor:
-            player = goal['goals'][0]['player']
-            pcount[player] += 1
-            total_pcount[player] += 1
-
-        psorted = sorted(pcount.iteritems(), key=operator.itemgetter(1), 
-                         reverse=True)
-        top = []
-        leaders = 0
-        i = 0
-        while leaders < 3 and i < len(psorted):
-            (player, count) = psorted[i]
-            players = [player]
-            i += 1
-            while i < len(psorted) and psorted[i][1] == count:
-                players.append(psorted[i][0])
-                i += 1
-            leaders += len(players)
-            top.append((players, count))
-			
-        mongo_val = {'_id': goal_name, 'count': total, 'top': top}
-        gstats_db.save(mongo_val)
-
-    stat_scanner.set_max_game_id(goal_scanner.get_max_game_id())
-    stat_scanner.save()
+    update_leaders(db)
     log.info("Ending run: %s", stat_scanner.status_msg())
 
 
+def main(parsed_args):
+    count_goals(utils.get_mongo_database(), parsed_args.incremental)
+
+
 if __name__ == '__main__':
     parser = utils.incremental_max_parser()
     args = parser.parse_args()
@@ -4,10 +4,12 @@ import collections
 import logging
 import operator
 
+from keys import *
 import dominioncards
 import dominionstats.utils.log
 import game
 import incremental_scanner
+import ingest_sequence
 import utils
 
 
@@ -15,6 +17,9 @@ import utils
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
+# Games whose goal documents are fetched and written per round trip.
+GOALS_BATCH_SIZE = 100
+
 
 def GroupFuncs(funcs, group_name):
     """Attach group and priority to functions in funcs so they are sortable."""
@@ -31,10 +36,96 @@ def achievement(player, reason, sort_key=None):
         ach['sort_key'] = sort_key
     return ach
 
+TurnSummary = collections.namedtuple(
+    'TurnSummary', ['player', 'turn_no', 'new_cards', 'actions', 'attacked',
+                    'bank_worths', 'trashes'])
+
+class GoalSummary(object):
+    """ Aggregates of a game that the goal checkers share, found in one pass
+    over its turns.
+
+    bought, gained: like game.cards_gained_per_player().
+    piles_gained: dict of player to the cards they gained every copy of.
+    turns: a TurnSummary per turn, of the cards gained, the number of
+        actions played, whether an attack was played, the treasures in play
+        each time a Bank was played, and the number of cards trashed.
+    vp_gains: list, per player in all_player_names() order, of the score
+        changes over the turns from the player's index on.
+    final_decks: list of (player, deck) at the end of the game.
+    """
+
+    def __init__(self, g):
+        names = g.all_player_names()
+        self.bought = dict((name, collections.defaultdict(int))
+                           for name in names)
+        self.gained = dict((name, collections.defaultdict(int))
+                           for name in names)
+        self.turns = []
+        self.final_decks = [(pdeck.player_name, pdeck.deck)
+                            for pdeck in g.get_player_decks()]
+
+        states = iter(g.game_state_iterator())
+        state = states.next()
+        scores = [[state.player_score(name) for name in names]]
+        for turn in g.get_turns():
+            player = turn.player.name()
+            new_cards = turn.buys + turn.gains
+            for card in new_cards:
+                self.bought[player][card] += 1
+                self.gained[player][card] += 1
+            changed = set([player])
+            for name, change in turn.get_opp_info().iteritems():
+                for card in change.accumulates():
+                    self.gained[name][card] += 1
+                changed.add(change.name)
+
+            actions = 0
+            attacked = False
+            treasures = 0
+            bank_worths = []
+            for card in turn.plays:
+                if card.is_action():
+                    actions += 1
+                if card.is_attack():
+                    attacked = True
+                if card.is_treasure():
+                    treasures += 1
+                    if card == dominioncards.Bank:
+                        bank_worths.append(treasures)
+            self.turns.append(TurnSummary(
+                    player, turn.get_turn_no(), new_cards, actions, attacked,
+                    bank_worths, len(turn.trashes)))
+
+            # Only the players whose decks changed can have a new score.
+            state = states.next()
+            last_scores = scores[-1]
+            scores.append([state.player_score(name) if name in changed
+                           else last_scores[i]
+                           for i, name in enumerate(names)])
+
+        self.vp_gains = []
+        for i in range(len(names)):
+            self.vp_gains.append(
+                [scores[turn_no + 1][i] - scores[turn_no][i]
+                 for turn_no in range(i, len(scores) - 1)])
+
+        self.piles_gained = collections.defaultdict(list)
+        game_size = len(names)
+        for player, card_dict in self.gained.iteritems():
+            for card, quant in card_dict.iteritems():
+                if quant >= card.num_copies_per_game(game_size):
+                    self.piles_gained[player].append(card)
+
+def goal_summary(g):
+    """ Return the GoalSummary of game g, made on the first call. """
+    if 'goal_summary_cache' not in g.__dict__:
+        g.goal_summary_cache = GoalSummary(g)
+    return g.goal_summary_cache
+
 def CheckMatchBOM(g):
     """Bought only money and Victory."""
     ret = []
-    cards_per_player = g.cards_gained_per_player()[game.BOUGHT]
+    cards_per_player = goal_summary(g).bought
     for player, card_list in cards_per_player.iteritems():
         treasures = []
         bad = False
@@ -79,15 +170,7 @@ def CheckMatchGolfer(g):
 def CollectedAllCopies(g):
     """Return a dict mapping a player to a list of all the card
        names that the player gained all the copies of"""
-    accumed_per_player = g.cards_gained_per_player()[game.GAINED]
-    gain_map = collections.defaultdict(list)
-    game_size = len(g.get_player_decks())
-
-    for player, card_dict in accumed_per_player.iteritems():
-        for card, quant in card_dict.iteritems():
-            if quant >= card.num_copies_per_game(game_size):
-                gain_map[player].append(card)
-    return gain_map
+    return goal_summary(g).piles_gained
 
 def CheckMatchPileDriver(g):
     """Gained all copies of a card and won."""
@@ -148,7 +231,7 @@ def CheckMatchOneTrickPony(g):
     """Bought only one type of action"""
     if g.any_resigned():
         return []
-    accumed_per_player = g.cards_gained_per_player()[game.BOUGHT]
+    accumed_per_player = goal_summary(g).bought
     ret = []
     for player, card_dict in accumed_per_player.iteritems():
         if g.get_player_deck(player).WinPoints() > 1.0:
@@ -168,7 +251,7 @@ def CheckMatchOneTrickPony(g):
 
 def CheckMatchMrGreenGenes(g):
     """Bought 6 differently named Victory cards"""
-    accumed_per_player = g.cards_gained_per_player()[game.BOUGHT]
+    accumed_per_player = goal_summary(g).bought
     ret = []
     for player, card_dict in accumed_per_player.iteritems():
         victory_quants = [(c, q) for c, q in card_dict.iteritems() if
@@ -282,8 +365,7 @@ def CheckMatchTheFlash(g):
 def CheckMatchVintner(g):
     """Obtained at least 30 VP from Vineyards"""
     ret = []
-    for pdeck in g.get_player_decks():
-        (player, deck) = (pdeck.player_name, pdeck.deck)
+    for player, deck in goal_summary(g).final_decks:
         if dominioncards.Vineyard not in deck:
             continue
         vy_pts = game.score_vineyard(deck)
@@ -297,8 +379,7 @@ def CheckMatchCarny(g):
     # Original suggestion: Blue ribbon - ended game with a Fairgrounds worth
     # 8 VP
     ret = []
-    for pdeck in g.get_player_decks():
-        (player, deck) = (pdeck.player_name, pdeck.deck)
+    for player, deck in goal_summary(g).final_decks:
         if dominioncards.Fairgrounds not in deck:
             continue
         fg_pts = game.score_fairgrounds(deck)
@@ -311,8 +392,7 @@ def CheckMatchGardener(g):
     """Obtained at least 20 VP from Gardens"""
     # Original suggestion: ended game with a Gardens worth 6 VP
     ret = []
-    for pdeck in g.get_player_decks():
-        (player, deck) = (pdeck.player_name, pdeck.deck)
+    for player, deck in goal_summary(g).final_decks:
         if dominioncards.Gardens not in deck:
             continue
         g_pts = game.score_gardens(deck)
@@ -326,8 +406,7 @@ def CheckMatchDukeOfEarl(g):
     """Obtained at least 42 points from Dukes and Duchies"""
     # originally suggested as Duchebag
     ret = []
-    for pdeck in g.get_player_decks():
-        (player, deck) = (pdeck.player_name, pdeck.deck)
+    for player, deck in goal_summary(g).final_decks:
         if dominioncards.Duke not in deck:
             continue
         duke_pts = game.score_duke(deck)
@@ -341,8 +420,7 @@ def CheckMatchDukeOfEarl(g):
 def CheckMatchSilkTrader(g):
     """ Obtained at least 20 points from Silk Road"""
     ret = []
-    for pdeck in g.get_player_decks():
-        (player, deck) = (pdeck.player_name, pdeck.deck)
+    for player, deck in goal_summary(g).final_decks:
         if dominioncards.SilkRoad not in deck:
             continue
         g_pts = game.score_silk_road(deck)
@@ -377,18 +455,13 @@ def CheckMatchBully(g):
         return []
     players = set(g.all_player_names())
 
-    for turn in g.get_turns():
-        if turn.get_turn_no() <= 4:
+    for turn in goal_summary(g).turns:
+        if turn.turn_no <= 4:
             continue
-        player = turn.player.player_name
+        player = turn.player
         if player not in players:
             continue
-        attack = False
-        for play in turn.plays:
-            if play.is_attack():
-                attack = True
-                break
-        if not attack:
+        if not turn.attacked:
             players.remove(player)
             if len(players) == 0:
                 break
@@ -404,9 +477,9 @@ def CheckMatchBully(g):
 def one_turn(g, player, cardList):
     """Returns true if 'player' bought/gained the cards in the cardList only on one turn"""
     found = False
-    for turn in g.turns:
-        if turn.player.player_name==player:
-            buysgains = turn.buys + turn.gains
+    for turn in goal_summary(g).turns:
+        if turn.player==player:
+            buysgains = turn.new_cards
             for card in cardList:
                 if card in buysgains:
                     if found:
@@ -420,8 +493,7 @@ def prize_check(g):
     if dominioncards.Tournament not in g.supply:
         return (False, False)
 
-    for pdeck in g.get_player_decks():
-        (player, deck) = (pdeck.player_name, pdeck.deck)
+    for player, deck in goal_summary(g).final_decks:
         n_prizes = 0
         for prize in dominioncards.TOURNAMENT_WINNINGS:
             if prize in deck:
@@ -489,27 +561,19 @@ def CheckMatchBanker(g):
     if dominioncards.Bank not in g.supply:
         return ret
 
-    for turn in g.get_turns():
-        treasure_count = 0
-        for card in turn.plays:
-            if card.is_treasure():
-                treasure_count += 1
-                if card == dominioncards.Bank:
-                    if treasure_count >= 10:
-                        ret.append(achievement(turn.player.player_name,
-                                "Played a Bank worth $%d" % treasure_count))
+    for turn in goal_summary(g).turns:
+        for treasure_count in turn.bank_worths:
+            if treasure_count >= 10:
+                ret.append(achievement(turn.player,
+                        "Played a Bank worth $%d" % treasure_count))
     return ret
 
 def CheckActionsPerTurn(g, low, high=None):
     ret = []
-    for turn in g.get_turns():
-        action_count = 0
-        for card in turn.plays:
-            if card.is_action():
-                action_count += 1
-
+    for turn in goal_summary(g).turns:
+        action_count = turn.actions
         if action_count >= low and (high is None or action_count < high):
-            ret.append(achievement(turn.player.player_name,
+            ret.append(achievement(turn.player,
                     "Played %d or more actions in one turn" % low, action_count))
     return ret
 
@@ -530,17 +594,11 @@ GroupFuncs([CheckMatchActionStar, CheckMatchMegaActionStar, CheckMatchSuperActio
 
 def CheckPointsPerTurn(g, low, high=None):
     ret = []
-    scores = []
     players = g.all_player_names()
-    for state in g.game_state_iterator():
-        score = []
-        for p in players:
-            score.append(state.player_score(p))
-        scores.append(score)
+    vp_gains = goal_summary(g).vp_gains
 
     for (i,p) in enumerate(players):
-        for turn_no in range(i, len(scores)-1):
-            gain = scores[turn_no+1][i] - scores[turn_no][i]
+        for gain in vp_gains[i]:
             if gain >= low and (high is None or gain < high):
                 ret.append(achievement(p,
                         "Scored %d or more points in one turn" % low, gain))
@@ -582,13 +640,13 @@ def CheckMatchMegaTurn(g):
         biggest_victory = dominioncards.Province
 
     victory_copies = biggest_victory.num_copies_per_game(len(g.get_player_decks()))
-    for turn in g.get_turns():
-        new_cards = turn.buys + turn.gains
+    for turn in goal_summary(g).turns:
+        new_cards = turn.new_cards
         if len(new_cards) < victory_copies:
             continue
         if new_cards.count(biggest_victory) == victory_copies:
             ret.append(
-                achievement(turn.player.name(),
+                achievement(turn.player,
                  "Obtained all of the %s cards in one turn" %
                             biggest_victory, biggest_victory))
     return ret
@@ -596,10 +654,10 @@ def CheckMatchMegaTurn(g):
 def CheckMatchOscarTheGrouch(g):
     """Trash more than 7 cards in one turn"""
     ret = []
-    for turn in g.get_turns():
-        trashes = len(turn.trashes)
+    for turn in goal_summary(g).turns:
+        trashes = turn.trashes
         if trashes >= 7:
-            ret.append(achievement(turn.player.name(),
+            ret.append(achievement(turn.player,
                                    "Trashed %d cards in one turn" % trashes,
                                    trashes))
     return ret
@@ -737,36 +795,32 @@ def check_goals(game_val, goal_names=None):
     return goals
 
 
-def calculate_goals(games, goals_col, goals_error_col, year_month_day, goals_to_check=None):
-    """ Analyze games for goals and insert those found into the MongoDB.
+def update_goals(games, goals_col, checker_output, goals_to_check=None):
+    """ Check the games for goals, and write them to their documents in
+    goals_col, with one fetch of the existing documents and one bulk write.
+    The documents are stamped with new goal INGEST_SEQs as they are written.
 
     games: List of games to analyze, each in dict format
     goals_col: Destination MongoDB collection
-    goals_error_col: MongoDB collection for goals analysis errors (for
-        potential reflow later). This is a TODO for now.
-    year_month_day: string in yyyymmdd format encoding date
-    goals_to_check: List of goals to analyze for. If passed, only the
-        listed goals will be calculated or re-calculated. Otherwise, all
-        goals are calculated.
-
+    checker_output: dict of goal name to count, to add the goals found to
+    goals_to_check: List of goals to analyze for, replacing just those in
+        the existing documents, or None for all goals.
     """
-    log.debug('Beginning to analyze %d games for goals, from %s', len(games), year_month_day)
-
-    total_checked = 0
-    checker_output = collections.defaultdict(int)
+    if not games:
+        return
+    existing = dict((doc['_id'], doc) for doc in goals_col.find(
+            {'_id': {'$in': [g['_id'] for g in games]}}))
+    mongo_vals = []
 
     for g in games:
-        total_checked += 1
         game_val = game.Game(g)
 
         # Get existing goal set (if exists)
         game_id = game_val.get_id()
-        mongo_val = goals_col.find_one({'_id': game_id})
+        mongo_val = existing.get(game_id)
 
         if mongo_val is None:
-            mongo_val = collections.defaultdict( dict )
-            mongo_val['_id'] = game_id
-            mongo_val['goals'] = []
+            mongo_val = {'_id': game_id, 'goals': []}
 
         # If rechecking, delete old values
         if goals_to_check is not None:
@@ -785,8 +839,45 @@ def calculate_goals(games, goals_col, goals_error_col, year_month_day, goals_to_
             mongo_val['goals'].append(goal)
             checker_output[goal_name] += 1
 
-        mongo_val = dict(mongo_val)
-        goals_col.save(mongo_val)
+        mongo_vals.append(mongo_val)
+
+    first_seq = ingest_sequence.reserve(goals_col.database, len(mongo_vals),
+                                        ingest_sequence.GOALS_SEQUENCE)
+    try:
+        bulk = goals_col.initialize_unordered_bulk_op()
+        for seq, mongo_val in enumerate(mongo_vals, first_seq):
+            mongo_val[INGEST_SEQ] = seq
+            bulk.find({'_id': mongo_val['_id']}).upsert().replace_one(
+                mongo_val)
+        bulk.execute()
+    finally:
+        ingest_sequence.release(goals_col.database, first_seq,
+                                ingest_sequence.GOALS_SEQUENCE)
+
+
+def calculate_goals(games, goals_col, goals_error_col, year_month_day, goals_to_check=None):
+    """ Analyze games for goals and insert those found into the MongoDB.
+
+    games: List of games to analyze, each in dict format
+    goals_col: Destination MongoDB collection
+    goals_error_col: MongoDB collection for goals analysis errors (for
+        potential reflow later). This is a TODO for now.
+    year_month_day: string in yyyymmdd format encoding date
+    goals_to_check: List of goals to analyze for. If passed, only the
+        listed goals will be calculated or re-calculated. Otherwise, all
+        goals are calculated.
+
+    Goals are written with one bulk write per GOALS_BATCH_SIZE games; see
+    update_goals().
+    """
+    log.debug('Beginning to analyze %d games for goals, from %s', len(games), year_month_day)
+
+    total_checked = 0
+    checker_output = collections.defaultdict(int)
+
+    for batch in utils.segments(games, GOALS_BATCH_SIZE):
+        update_goals(batch, goals_col, checker_output, goals_to_check)
+        total_checked += len(batch)
 
     print_totals(checker_output, total_checked)
     return total_checked
@@ -813,7 +904,7 @@ def main(args):
         scanner = incremental_scanner.IncrementalScanner('subgoals', db)
         scanner.reset()
         main_scanner = incremental_scanner.IncrementalScanner('goals', db)
-        last = main_scanner.get_max_game_id()
+        last = main_scanner.get_max_seq()
     else:
         goals_to_check = None
         scanner = incremental_scanner.IncrementalScanner('goals', db)
@@ -826,43 +917,19 @@ def main(args):
 
     log.info("Starting run: %s", scanner.status_msg())
 
-    for g in utils.progress_meter(scanner.scan(games_collection, {})):
-        total_checked += 1
-        game_val = game.Game(g)
-
-        # Get existing goal set (if exists)
-        game_id = game_val.get_id()
-        mongo_val = output_collection.find_one({'_id': game_id})
-
-        if mongo_val is None:
-            mongo_val = collections.defaultdict( dict )
-            mongo_val['_id'] = game_id
-            mongo_val['goals'] = []
-
-        # If rechecking, delete old values
-        if goals_to_check is not None:
-            goals = mongo_val['goals']
-            for ind in range(len(goals) - 1, -1, -1):
-                goal = goals[ind]
-                if goal['goal_name'] in goals_to_check:
-                    del goals[ind]
-
-        # Get new values
-        goals = check_goals(game_val, goals_to_check)
-
-        # Write new values
-        for goal in goals:
-            goal_name = goal['goal_name']
-            mongo_val['goals'].append(goal)
-            checker_output[goal_name] += 1
-
-        mongo_val = dict(mongo_val)
-        output_collection.save(mongo_val)
+    def games_to_check():
+        num_games = 0
+        for g in utils.progress_meter(scanner.scan(games_collection, {})):
+            num_games += 1
+            yield g
+            if last and g[INGEST_SEQ] == last:
+                break
+            if args.max_games >= 0 and num_games >= args.max_games:
+                break
 
-        if last and game_id == last:
-            break
-        if args.max_games >= 0 and total_checked >= args.max_games:
-            break
+    for batch in utils.chunks(games_to_check(), GOALS_BATCH_SIZE):
+        update_goals(batch, output_collection, checker_output, goals_to_check)
+        total_checked += len(batch)
 
     log.info("Ending run: %s", scanner.status_msg())
     scanner.save()
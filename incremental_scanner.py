@@ -1,18 +1,75 @@
-""" Scan over a collection and remember which documents were seen.
+""" Scan over the games and remember which were seen.
 
 This is useful for implementing daily updates, so that we only scan where we
-left off."""
+left off.  Scanners follow the games' ingest sequence numbers (see
+ingest_sequence.py), and also keep the largest game id seen.
+
+Analyzers write their output with a Checkpoint, which makes the writes and
+the move of the scanner's position happen all or nothing, so that a crash
+never leaves games counted twice or not at all."""
+
+import logging
+
+from keys import *
+import ingest_sequence
+import primitive_util
+
+# Module-level logging instance
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# Where checkpoints keep their writes until they have all been applied.
+JOURNAL_COL_NAME = 'scanner_journal'
+
+# Documents that checkpoints add to are stamped with the version of the
+# last checkpoint that did, in this field.
+VERSION_FIELD = '_v'
+
+# Documents fetched per round trip.  The server caps each batch at a few
+# megabytes anyway; this is just high enough that the cap, rather than the
+# default of 101 documents, decides the batch size for small projected games.
+SCAN_BATCH_SIZE = 2000
+
+class UnconvertedScannerError(Exception):
+    """Indicates a scanner saved before games had ingest sequence numbers,
+    which ingest_sequence.py converts."""
+    def __init__(self, reason):
+        self.args = reason,
+        self.reason = reason
+
+    def __str__(self):
+        return '<unconverted scanner error %s>' % self.reason
+
+
+def seq_range(min_seq, max_seq=None):
+    """ Return the query for the sequence numbers after min_seq, up to
+    max_seq unless it is None. """
+    query = {'$gt': min_seq}
+    if max_seq is not None:
+        query['$lte'] = max_seq
+    return query
+
 
 class IncrementalScanner(object):
     def __init__(self, scan_name, db):
         self.num_games = 0
         self.max_game_id = ''
+        self.max_seq = 0
+        self.version = 0
         self.scan_name = scan_name
         self.db = db
         stored_info = db.scanner.find_one({'_id': scan_name})
         if stored_info:
             self.num_games = stored_info['num_games']
             self.max_game_id = stored_info['max_game_id']
+            self.version = stored_info.get('version', 0)
+            if 'max_seq' in stored_info:
+                self.max_seq = stored_info['max_seq']
+            elif self.max_game_id:
+                raise UnconvertedScannerError(
+                    '%s needs converting by ingest_sequence.py' % scan_name)
+            if stored_info.get('pending'):
+                self.recover(stored_info['pending'])
 
     def get_max_game_id(self):
         return self.max_game_id
@@ -20,27 +77,192 @@ class IncrementalScanner(object):
     def set_max_game_id(self, new_id):
         self.max_game_id = new_id
 
+    def get_max_seq(self):
+        return self.max_seq
+
+    def set_max_seq(self, new_seq):
+        self.max_seq = new_seq
+
     def get_num_games(self):
         return self.num_games
 
     def status_msg(self):
-        return 'Max game id %s, num games %s' % (self.max_game_id,
-                                                 self.num_games)
+        return 'Max game id %s, max seq %d, num games %s' % (
+            self.max_game_id, self.max_seq, self.num_games)
 
     def reset(self):
         self.num_games = 0
         self.max_game_id = ''
+        self.max_seq = 0
+        self.db[JOURNAL_COL_NAME].remove({'scan': self.scan_name})
         self.save()
 
-    def scan(self, collection, query):
-        assert not '_id' in query
-        query['_id'] = {'$gt': self.max_game_id}
-        for item in collection.find(query):
-            self.max_game_id = max(item['_id'], self.max_game_id)
-            self.num_games += 1
+    def record(self, item_id, seq, count=1):
+        """ Count count games, the largest of whose ids is item_id and of
+        whose sequence numbers is seq, as seen. """
+        self.max_game_id = max(item_id, self.max_game_id)
+        self.max_seq = max(seq, self.max_seq)
+        self.num_games += count
+
+    def scan(self, collection, query, fields=None,
+             batch_size=SCAN_BATCH_SIZE,
+             sequence=ingest_sequence.GAMES_SEQUENCE):
+        """ Iterate over the games in collection matching query that
+        haven't been seen yet, with only fields (all of them by default),
+        counting each as seen.  They come in order of their numbers of the
+        ingest sequence named sequence, up to the last one settled, so that
+        a checkpoint written partway through covers just the games before
+        it, and none is passed over before it is written.
+        """
+        assert not INGEST_SEQ in query
+        settled = ingest_sequence.settled_seq(self.db, sequence)
+        query[INGEST_SEQ] = seq_range(self.max_seq, settled)
+        if fields is not None:
+            fields = list(fields) + [INGEST_SEQ]
+        for item in collection.find(query, fields).sort(
+            INGEST_SEQ, 1).batch_size(batch_size):
+            self.record(item['_id'], item[INGEST_SEQ])
             yield item
 
-    def save(self):
-        self.db.scanner.save({'_id': self.scan_name,
-                              'num_games': self.num_games,
-                              'max_game_id': self.max_game_id})
+    def save(self, pending=None):
+        info = {'_id': self.scan_name,
+                'num_games': self.num_games,
+                'max_game_id': self.max_game_id,
+                'max_seq': self.max_seq,
+                'version': self.version}
+        if pending:
+            info['pending'] = pending
+        self.db.scanner.save(info)
+
+    def checkpoint(self):
+        """ Return a Checkpoint of the games seen so far. """
+        return Checkpoint(self)
+
+    def recover(self, pending):
+        """ Finish applying the checkpoint pending, left by a run that
+        stopped in the middle of Checkpoint.write(). """
+        log.warning('Recovering checkpoint %d of %s', pending['version'],
+                    self.scan_name)
+        journal = self.db[JOURNAL_COL_NAME]
+        ops = [entry['op'] for entry in journal.find(
+                {'scan': self.scan_name,
+                 'version': pending['version']}).sort('_id', 1)]
+        apply_ops(self.db, pending['version'], ops, recovering=True)
+        self.finish_checkpoint(pending)
+
+    def finish_checkpoint(self, pending):
+        self.num_games = pending['num_games']
+        self.max_game_id = pending['max_game_id']
+        self.max_seq = pending['max_seq']
+        self.version = pending['version']
+        self.save()
+        self.db[JOURNAL_COL_NAME].remove({'scan': self.scan_name})
+
+
+class Checkpoint(object):
+    """ Output writes of an analyzer, which are made together with saving
+    its scanner's position, under the next version number.
+
+    The writes are journaled, then the scanner is saved with the new
+    position marked as pending, which is when the checkpoint takes effect,
+    and then the writes are applied and the new position made current.  If
+    a run stops before the scanner is marked, the journal is thrown away,
+    and if it stops after, the next IncrementalScanner for the scan applies
+    the journal again.  That is safe because replaced documents come out
+    the same, values added to arrays aren't added twice, and documents that
+    are added to record the version that last added to them, so they are
+    skipped.
+    """
+
+    def __init__(self, scanner):
+        self.scanner = scanner
+        self.version = scanner.version + 1
+        self.ops = []
+
+    def replace(self, collection, doc):
+        """ Replace the document with doc's _id in collection by doc. """
+        self.ops.append({'collection': collection.name, 'field': '_id',
+                         'key': doc['_id'], 'doc': doc})
+
+    def save_object(self, obj, collection, _id):
+        """ Like utils.write_object_to_db(), as part of the checkpoint. """
+        prim = primitive_util.to_primitive(obj)
+        prim['_id'] = _id
+        self.replace(collection, prim)
+
+    def increment(self, collection, field, key, inc, set_fields=None):
+        """ Add the values of inc to the fields of the document in
+        collection whose field is key, creating it if needed, and set the
+        fields of set_fields. """
+        self.ops.append({'collection': collection.name, 'field': field,
+                         'key': key, 'inc': inc, 'set': set_fields or {}})
+
+    def add_to_set(self, collection, _id, array_field, values,
+                   set_fields=None):
+        """ Add those of values that aren't in it already to the array
+        array_field of the document with _id in collection, creating it if
+        needed, and set the fields of set_fields.  Applying this again
+        changes nothing. """
+        self.ops.append({'collection': collection.name, 'field': '_id',
+                         'key': _id, 'array': array_field, 'values': values,
+                         'set': set_fields or {}})
+
+    def write(self):
+        """ Apply the writes, and move the scanner to its position. """
+        scanner = self.scanner
+        journal = scanner.db[JOURNAL_COL_NAME]
+        journal.remove({'scan': scanner.scan_name})
+        if self.ops:
+            bulk = journal.initialize_unordered_bulk_op()
+            for ind, op in enumerate(self.ops):
+                bulk.insert({'_id': '%s:%d:%09d' % (scanner.scan_name,
+                                                    self.version, ind),
+                             'scan': scanner.scan_name,
+                             'version': self.version, 'op': op})
+            bulk.execute()
+
+        pending = {'version': self.version,
+                   'num_games': scanner.num_games,
+                   'max_game_id': scanner.max_game_id,
+                   'max_seq': scanner.max_seq}
+        scanner.save(pending)
+        apply_ops(scanner.db, self.version, self.ops)
+        scanner.finish_checkpoint(pending)
+
+
+def apply_ops(db, version, ops, recovering=False):
+    """ Apply the writes ops of the checkpoint version to db, skipping the
+    increments that were already applied if recovering. """
+    ops_by_collection = {}
+    for op in ops:
+        ops_by_collection.setdefault(op['collection'], []).append(op)
+
+    for collection_name, collection_ops in ops_by_collection.iteritems():
+        collection = db[collection_name]
+        applied = set()
+        if recovering:
+            for field in set(op['field'] for op in collection_ops
+                             if 'inc' in op):
+                applied.update((field, doc[field]) for doc in collection.find(
+                        {VERSION_FIELD: version}, [field]))
+
+        bulk = collection.initialize_unordered_bulk_op()
+        num_writes = 0
+        for op in collection_ops:
+            if 'doc' in op:
+                bulk.find({'_id': op['key']}).upsert().replace_one(op['doc'])
+            elif 'values' in op:
+                update = {'$addToSet': {op['array']: {'$each': op['values']}}}
+                if op.get('set'):
+                    update['$set'] = op['set']
+                bulk.find({'_id': op['key']}).upsert().update_one(update)
+            elif (op['field'], op['key']) not in applied:
+                set_fields = dict(op['set'])
+                set_fields[VERSION_FIELD] = version
+                bulk.find({op['field']: op['key']}).upsert().update_one(
+                    {'$inc': op['inc'], '$set': set_fields})
+            else:
+                continue
+            num_writes += 1
+        if num_writes:
+            bulk.execute()
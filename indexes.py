@@ -20,6 +20,7 @@ INDEXES = {
     'games': [
         PLAYERS,
         SUPPLY,
+        INGEST_SEQ,
         ],
     'raw_games': [
         'game_date',
@@ -27,6 +28,10 @@ INDEXES = {
     'goals': [
         'goals.player',
         'goals.goal_name',
+        INGEST_SEQ,
+        ],
+    'goal_player_counts': [
+        'goal',
         ],
     }
 
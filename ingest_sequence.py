@@ -0,0 +1,175 @@
+#!/usr/bin/python
+
+""" Ingest sequence numbers of parsed games.
+
+Every game is stamped with an INGEST_SEQ when it is first written to the
+games collection, counting up in the order games arrive.  Incremental
+scanners follow these numbers rather than game ids, so games that arrive
+late, with ids below ones already scanned, are still scanned.  A reparsed
+game keeps the number it had, since the analyzers add up each game's stats
+once and can't take the old version's back out.
+
+Numbers are reserved before the games are written, and several processes
+may be writing at once, so a game can show up before one with a lower
+number.  Each reservation stays open on the sequence's counter until its
+writer releases it, and scanners only go up to settled_seq(), below the
+lowest open reservation, so that they never move past a game still to be
+written.
+
+Goal documents are numbered the same way, from a sequence of their own,
+each time they are written, so that goal_stats.py can count just the ones
+written since its last run.
+
+Run this module once, before parsing any new games, to number the games
+that were loaded without a number (in _id order) and to move the saved
+scanner positions over to numbers.
+"""
+
+import logging
+import time
+
+from pymongo.errors import DuplicateKeyError
+
+from keys import *
+import dominionstats.utils.log
+import utils
+
+# Module-level logging instance
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+SEQUENCES_COL_NAME = 'sequences'
+GAMES_SEQUENCE = 'games'
+GOALS_SEQUENCE = 'goals'
+
+# Games numbered per bulk write by stamp_unsequenced_games().
+STAMP_BATCH_SIZE = 1000
+
+# Seconds after which a reservation that was never released, because its
+# writer died, no longer holds the scanners back.
+RESERVATION_TIMEOUT = 3600
+
+
+def reserve(db, count, name=GAMES_SEQUENCE):
+    """ Reserve count consecutive numbers of the sequence name, and return
+    the first of them.  Numbers start from 1.  The reservation stays open
+    until release() is called with the first number, once the documents
+    numbered with them have been written. """
+    sequences = db[SEQUENCES_COL_NAME]
+    while True:
+        counter = sequences.find_one({'_id': name})
+        last = counter['last'] if counter else 0
+        reservation = {'first': last + 1, 'time': time.time()}
+        try:
+            # Only if no other reservation came first, so that the open
+            # reservations are recorded along with the numbers they take.
+            if sequences.find_and_modify(
+                {'_id': name, 'last': last},
+                {'$inc': {'last': count}, '$push': {'open': reservation}},
+                upsert=counter is None, new=True):
+                return last + 1
+        except DuplicateKeyError:
+            pass
+
+
+def release(db, first, name=GAMES_SEQUENCE):
+    """ Close the reservation of the sequence name starting at first, or do
+    nothing if first is None. """
+    if first is not None:
+        db[SEQUENCES_COL_NAME].update({'_id': name},
+                                      {'$pull': {'open': {'first': first}}})
+
+
+def settled_seq(db, name=GAMES_SEQUENCE):
+    """ Return the largest number of the sequence name up to which all of
+    the numbers reserved have been written, or None if no number of it has
+    ever been reserved. """
+    counter = db[SEQUENCES_COL_NAME].find_one({'_id': name})
+    if counter is None:
+        return None
+    expired = time.time() - RESERVATION_TIMEOUT
+    stale = [r['first'] for r in counter.get('open', [])
+             if r['time'] < expired]
+    if stale:
+        log.warning('Dropping reservations of %s at %s that were never '
+                    'released', name, stale)
+        db[SEQUENCES_COL_NAME].update(
+            {'_id': name}, {'$pull': {'open': {'first': {'$in': stale}}}})
+    open_firsts = [r['first'] for r in counter.get('open', [])
+                   if r['time'] >= expired]
+    if open_firsts:
+        return min(open_firsts) - 1
+    return counter['last']
+
+
+def stamp_games(games_col, games):
+    """ Stamp each of the parsed games about to be written to games_col
+    with its INGEST_SEQ: the one it already has in games_col if it is being
+    reparsed, or else a new one.  Returns the first of the new numbers, to
+    release() once the games are written, or None if there are none. """
+    existing = dict(
+        (doc['_id'], doc[INGEST_SEQ]) for doc in games_col.find(
+            {'_id': {'$in': [game['_id'] for game in games]},
+             INGEST_SEQ: {'$exists': True}}, [INGEST_SEQ]))
+    new_games = [game for game in games if game['_id'] not in existing]
+    first = None
+    if new_games:
+        first = reserve(games_col.database, len(new_games))
+        for seq, game in enumerate(new_games, first):
+            game[INGEST_SEQ] = seq
+    for game in games:
+        if game['_id'] in existing:
+            game[INGEST_SEQ] = existing[game['_id']]
+    return first
+
+
+def stamp_unsequenced_games(games_col, name=GAMES_SEQUENCE):
+    """ Number the games in games_col that have no INGEST_SEQ, in _id
+    order, from the sequence name.  Returns the number of games stamped. """
+    unsequenced = games_col.find({INGEST_SEQ: {'$exists': False}},
+                                 ['_id']).sort('_id', 1)
+    num_stamped = 0
+    for batch in utils.chunks(utils.progress_meter(unsequenced),
+                              STAMP_BATCH_SIZE):
+        first = reserve(games_col.database, len(batch), name)
+        try:
+            bulk = games_col.initialize_unordered_bulk_op()
+            for seq, doc in enumerate(batch, first):
+                bulk.find({'_id': doc['_id']}).update_one(
+                    {'$set': {INGEST_SEQ: seq}})
+            bulk.execute()
+        finally:
+            release(games_col.database, first, name)
+        num_stamped += len(batch)
+    return num_stamped
+
+
+def convert_scanners(db, games_col):
+    """ Give the saved scanners that only have a max_game_id the max_seq
+    that covers the same games, assuming those were numbered in _id order
+    by stamp_unsequenced_games(). """
+    for info in db.scanner.find():
+        if 'max_seq' in info:
+            continue
+        info['max_seq'] = 0
+        if info['max_game_id']:
+            for game in games_col.find(
+                {'_id': {'$lte': info['max_game_id']}},
+                [INGEST_SEQ]).sort(INGEST_SEQ, -1).limit(1):
+                info['max_seq'] = game[INGEST_SEQ]
+        log.info('Scanner %s at %s is now at sequence number %d',
+                 info['_id'], info['max_game_id'], info['max_seq'])
+        db.scanner.save(info)
+
+
+def main():
+    db = utils.get_mongo_database()
+    db.games.ensure_index(INGEST_SEQ)
+    log.info('Numbered %d games', stamp_unsequenced_games(db.games))
+    convert_scanners(db, db.games)
+
+
+if __name__ == '__main__':
+    args = utils.base_parser().parse_args()
+    dominionstats.utils.log.initialize_logging(args.debug)
+    main()
@@ -9,7 +9,6 @@
 import boto.s3.connection
 import bson.binary
 import bz2
-import cStringIO
 import datetime
 import io
 import logging
@@ -17,12 +16,19 @@ import sys
 import tarfile
 import urllib2
 
+from pymongo.errors import BulkWriteError
+
+import parse_game
 import utils
 
 
 # Module-level logging instance
 log = logging.getLogger(__name__)
 
+# Archives are streamed up to S3 in parts of this size, so they are never
+# held in memory whole.  S3 wants every part but the last to be at least 5MB.
+S3_UPLOAD_PART_SIZE = 8 * 1024 * 1024
+
 
 class IsotropicProcessingDate(object):
     # TODO: This is a partial implementation
@@ -87,6 +93,19 @@ def dates_needing_scraping(db):
         raw_game_count = raw_games_col.find({'game_date': str_date}).count()
 
 
+def read_part(fileobj, size):
+    """Read size bytes from fileobj, or fewer at the end of it."""
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = fileobj.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return ''.join(chunks)
+
+
 class ScrapeError(Exception):
     """Indicates an error with the requested scrape."""
     def __init__(self, reason):
@@ -105,11 +124,15 @@ class IsotropicScraper:
     db = None
     rawgames_col = None
     s3conn = None
+    archive_cache = None
 
-    def __init__(self, db, rawgames_name='raw_games'):
+    def __init__(self, db, rawgames_name='raw_games', archive_cache=None):
+        """archive_cache is an optional archive_cache.ArchiveCache through
+        which archives are read from S3."""
         self.db = db
         if db:
             self.rawgames_col = db[rawgames_name]
+        self.archive_cache = archive_cache
 
 
     def our_gamelog_filename(self, gamedate):
@@ -156,23 +179,42 @@ class IsotropicScraper:
         except urllib2.HTTPError:
             raise ScrapeError("Unable to retrieve data from %s" % self.isotropic_rawgame_url(date))
 
-        # Upload the contents to s3 in the appropriate key
+        # Upload the contents to s3 in the appropriate key, a part at a time
         bucket = self.s3conn.get_bucket('static.councilroom.mccllstr.com')
         key = bucket.get_key(self.gamelog_s3_keyname(date))
         if not key:
-            log.debug("Creating new key")
-            key = bucket.new_key(self.gamelog_s3_keyname(date))
-            log.debug("Starting copy from isotropic")
-            contents = io.BytesIO(response.read())
-            log.debug("Starting upload to S3")
-            key.set_contents_from_file(contents,
-                                       cb=lambda sent, total: log.info('Transferred %d of %d', sent, total),
-                                       replace=False, policy='public-read')
+            log.debug("Starting streaming copy from isotropic to S3")
+            upload = bucket.initiate_multipart_upload(
+                self.gamelog_s3_keyname(date), policy='public-read')
+            try:
+                part_num = 0
+                sent = 0
+                while True:
+                    part = read_part(response, S3_UPLOAD_PART_SIZE)
+                    if not part and part_num > 0:
+                        break
+                    part_num += 1
+                    upload.upload_part_from_file(io.BytesIO(part), part_num)
+                    sent += len(part)
+                    log.info('Transferred %d bytes in %d parts', sent, part_num)
+                    if len(part) < S3_UPLOAD_PART_SIZE:
+                        break
+                upload.complete_upload()
+            except:
+                upload.cancel_upload()
+                raise
 
 
     def get_rawgames_from_s3(self, date):
         """Return the whole-day rawgame archive from our S3 bucket for
         the specified datetime.date"""
+        if self.archive_cache is not None:
+            archive = self.get_rawgames_from_s3_as_filelike(date)
+            try:
+                return archive.read()
+            finally:
+                archive.close()
+
         self.establish_s3_connection()
         bucket = self.s3conn.get_bucket('static.councilroom.mccllstr.com')
         key = bucket.get_key(self.gamelog_s3_keyname(date))
@@ -181,8 +223,16 @@ class IsotropicScraper:
 
     def get_rawgames_from_s3_as_filelike(self, date):
         """Return the whole-day rawgame archive from our S3 bucket for
-        the specified datetime.date, wrapped in a filelike object"""
-        return cStringIO.StringIO(self.get_rawgames_from_s3(date))
+        the specified datetime.date, as a filelike object that streams
+        it from S3 as it is read, or from the archive cache if there is
+        one"""
+        self.establish_s3_connection()
+        bucket = self.s3conn.get_bucket('static.councilroom.mccllstr.com')
+        key = bucket.get_key(self.gamelog_s3_keyname(date))
+        if self.archive_cache is not None:
+            return self.archive_cache.open(date.strftime('%Y%m%d'), key)
+        key.open_read()
+        return key
 
 
     def scrape_and_store_rawgames(self, date):
@@ -205,25 +255,111 @@ class IsotropicScraper:
         # Retrieve the game archive for the specified date
         rawgames_archive_contents = self.get_rawgames_from_s3_as_filelike(date)
 
-        # Insert the individual games into MongoDB
+        # Figure out which raw games are already in the database, as
+        # the streamed archive can only be read through once
+        loaded_ids = set(g[u'_id'] for g in self.rawgames_col.find(
+            {'game_date': yyyy_mm_dd}, [u'_id']))
+
+        # Insert the individual games that are missing into MongoDB
         insert_count = 0
-        with tarfile.open(fileobj=rawgames_archive_contents) as t:
-            # Figure out how many raw games are in the database,
-            # compared with how many are in the tarfile
-            database_count = self.rawgames_col.find({'game_date': yyyy_mm_dd}).count()
-            tarfile_count = len(t.getmembers())
-            if tarfile_count == database_count:
-                log.info("Raw games for %s have already been loaded", yyyy_mm_dd)
-            else:
-                # Insert all the games
-                for tarinfo in t:
-                    log.debug("Working on %s", tarinfo.name)
-                    g = { u'_id': tarinfo.name,
-                          u'game_date': yyyy_mm_dd,
-                          u'text': bson.Binary(bz2.compress(t.extractfile(tarinfo).read())) }
-                    self.rawgames_col.save(g, safe=True)
-                    insert_count += 1
+        with tarfile.open(fileobj=rawgames_archive_contents, mode='r|bz2') as t:
+            for g in self.rawgames_from_archive(t, yyyy_mm_dd, loaded_ids):
+                self.rawgames_col.save(g, safe=True)
+                insert_count += 1
 
         rawgames_archive_contents.close()
 
+        if insert_count == 0:
+            log.info("Raw games for %s have already been loaded", yyyy_mm_dd)
+
         return insert_count
+
+
+    def rawgames_from_archive(self, archive, yyyy_mm_dd, skip_ids=()):
+        """Yield a raw_games document for each game in archive, an
+        open tarfile of the games of yyyy_mm_dd, in a single pass, so
+        archive may be opened in streaming mode.
+
+        Games whose names are in skip_ids are left out.
+        """
+        for tarinfo in archive:
+            if tarinfo.name in skip_ids:
+                continue
+            log.debug("Working on %s", tarinfo.name)
+            yield { u'_id': tarinfo.name,
+                    u'game_date': yyyy_mm_dd,
+                    u'text': bson.Binary(bz2.compress(archive.extractfile(tarinfo).read())) }
+
+
+    def store_rawgames(self, raw_games):
+        """Store raw_games into the raw games collection as a single
+        unordered bulk upsert.
+
+        Returns the number of games stored.
+        """
+        if not raw_games:
+            return 0
+        bulk = self.rawgames_col.initialize_unordered_bulk_op()
+        for g in raw_games:
+            bulk.find({u'_id': g[u'_id']}).upsert().replace_one(g)
+        try:
+            bulk.execute()
+        except BulkWriteError as bwe:
+            write_errors = bwe.details['writeErrors']
+            for write_error in write_errors:
+                log.error("Got exception on trying to insert raw game %s: %s",
+                          raw_games[write_error['index']][u'_id'],
+                          write_error['errmsg'])
+            return len(raw_games) - len(write_errors)
+        return len(raw_games)
+
+
+    def scrape_and_ingest_rawgames(self, date, games_col, parse_error_col,
+                                   pool=None):
+        """Fused alternative to scrape_and_store_rawgames() followed by
+        parsing the day.
+
+        Streams the games of the archive for the datetime.date straight
+        into the parser, bulk writing the parsed games into games_col and
+        parse errors into parse_error_col, and then archives their raw
+        text into the raw games collection in one bulk batch.  The
+        archive is read once, and the raw games are never read back.
+
+        Games already in the raw games collection are skipped, so dates
+        that have already been loaded are a noop.  Returns the number of
+        games ingested.
+
+        Unlike parse_game.parse_and_insert on its own, whose memory use is
+        bounded by its chunk and batch sizes, this holds the compressed
+        raw text of the whole day until parsing finishes, so that it can
+        be archived in one batch.  That is a few tens of MB for a busy
+        day on isotropic.
+        """
+        yyyy_mm_dd = date.strftime('%Y%m%d')
+
+        if not self.is_rawgames_in_s3(date):
+            self.copy_rawgames_to_s3(date)
+
+        rawgames_archive_contents = self.get_rawgames_from_s3_as_filelike(date)
+
+        loaded_ids = set(g[u'_id'] for g in self.rawgames_col.find(
+            {'game_date': yyyy_mm_dd}, [u'_id']))
+
+        raw_games = []
+        def archived(games):
+            for g in games:
+                raw_games.append(g)
+                yield g
+
+        with tarfile.open(fileobj=rawgames_archive_contents, mode='r|bz2') as t:
+            parse_game.parse_and_insert(
+                log, archived(self.rawgames_from_archive(t, yyyy_mm_dd, loaded_ids)),
+                games_col, parse_error_col, yyyy_mm_dd, pool)
+
+        rawgames_archive_contents.close()
+
+        if not raw_games:
+            log.info("Raw games for %s have already been loaded", yyyy_mm_dd)
+            return 0
+
+        return self.store_rawgames(raw_games)
@@ -4,6 +4,9 @@ DECKS = 'D'
 GAME_END = 'G'
 RESIGNED = 'R'
 VETO = 'X'
+PARSER_VERSION = 'Y'
+RAW_HASH = 'H'
+INGEST_SEQ = 'Q'
 
 VP_TOKENS = 'V'
 WIN_POINTS = 'W'
@@ -6,44 +6,58 @@ import os
 import os.path
 import pymongo
 import re
+import simplejson as json
 import sys
 
+import ingest_sequence
 import utils
 
 from keys import *
 
 parser = utils.incremental_date_range_cmd_line_parser()
-find_id = re.compile('game-.*.html')
+
+def all_games_loaded(games, games_table):
+    """ Return True if games_table already holds every game in games, as
+    stamped with the same parser version and raw text hash. """
+    stamps = dict((g['_id'], (g.get(PARSER_VERSION), g.get(RAW_HASH)))
+                  for g in games)
+    loaded = games_table.find({'_id': {'$in': stamps.keys()}},
+                              [PARSER_VERSION, RAW_HASH])
+    num_loaded = 0
+    for g in loaded:
+        if stamps[g['_id']] == (g.get(PARSER_VERSION), g.get(RAW_HASH)):
+            num_loaded += 1
+    return num_loaded == len(stamps)
+
 
 def process_file(filename, incremental, games_table, log):
     yyyymmdd = filename[:8]
+    games = json.load(open('parsed_out/' + filename, 'r'))
 
     if incremental:
-        contents = open('parsed_out/' + filename, 'r').read()
-        if contents.strip() == '[]':
+        if not games:
             log.warning("empty contents in %s (make parser not dump empty files?)", filename)
             return
 
-        assert find_id.search(contents), (
-            'could not get id from %s in file %s' % (contents[:100], filename))
-
-        found_all = True
-        for match in find_id.finditer(contents):
-            g_id = match.group(0)
-            query = {'_id': g_id}
-            if games_table.find(query).count():
-                continue
-            else:
-                found_all = False
-        if found_all:
+        if all_games_loaded(games, games_table):
             log.info("Found all games in DB, deleting file %s", filename)
             os.system('rm parsed_out/%s'%filename)
             return
     
-    cmd = ('mongoimport -h localhost parsed_out/%s -c '
-           'games --jsonArray' % filename)
-    print(cmd)
-    os.system(cmd)
+    # Number the games as they are loaded, keeping the numbers of the ones
+    # already loaded.
+    first_seq = ingest_sequence.stamp_games(games_table, games)
+    try:
+        json.dump(games, open('parsed_out/' + filename, 'w'))
+
+        # Upsert, so that games reparsed by a newer parser version replace
+        # the ones already loaded.
+        cmd = ('mongoimport -h localhost parsed_out/%s -c '
+               'games --jsonArray --upsert' % filename)
+        print(cmd)
+        os.system(cmd)
+    finally:
+        ingest_sequence.release(games_table.database, first_seq)
 
 
 def main(args, log):
@@ -56,6 +70,7 @@ def main(args, log):
     games_table = pymongo.MongoClient().test.games
     games_table.ensure_index(PLAYERS)
     games_table.ensure_index(SUPPLY)
+    games_table.ensure_index(INGEST_SEQ)
     data_files_to_load = os.listdir('parsed_out')
     data_files_to_load.sort()
 
@@ -2,14 +2,13 @@
 # -*- coding: utf-8 -*-
 
 import logging
-import time
 
-from game import Game
 from primitive_util import PrimitiveConversion, ConvertibleDefaultDict
 from stats import MeanVarStat
 import dominioncards
 import dominionstats.utils.log
-import incremental_scanner
+import game
+import scan_engine
 import utils
 
 # Module-level logging instance
@@ -61,11 +60,11 @@ class DBCardRatioTrackerManager:
                 ratio = str(ratio[0]) + ':' + str(ratio[1])
                 tracker.add_outcome(tracker_type, ratio, win_points)
 
-    def save(self):
+    def save(self, checkpoint):
         if not self.incremental:
             self.collection.drop()
         for key, tracker in self.trackers.iteritems():
-            utils.write_object_to_db(tracker, self.collection, key)
+            checkpoint.save_object(tracker, self.collection, key)
 
 class CardRatioTracker:
     """ Base class for the final and progressive card ratio trackers.
@@ -164,48 +163,44 @@ def process_game(game):
                        name_to_win_points[name]])
     return retval
 
-def main(args):
-    commit_after = 25000
-    database = utils.get_mongo_database()
-    games = database.games
-    collection = database.optimal_card_ratios
-    db_tracker = None
+class CardRatiosPlugin(scan_engine.AnalyzerPlugin):
+    """ Keeps the optimal_card_ratios collection up to date. """
+    scan_name = 'optimal_card_ratios'
+    fields = game.GAME_FIELDS
 
-    scanner = incremental_scanner.IncrementalScanner('optimal_card_ratios', database)
+    def __init__(self, db):
+        scan_engine.AnalyzerPlugin.__init__(self, db)
+        self.collection = db.optimal_card_ratios
+        self.db_tracker = None
 
-    if not args.incremental:
-        log.warning('resetting scanner and db')
-        scanner.reset()
+    def reset(self):
+        scan_engine.AnalyzerPlugin.reset(self)
+        self.collection.drop()
 
-    log.info("Starting run: %s", scanner.status_msg())
-
-    for ind, game in enumerate(
-        utils.progress_meter(scanner.scan(games, {}))):
-        if not db_tracker:
+    def analyze_game(self, game_obj):
+        if not self.db_tracker:
             log.debug("Initializing db tracker manager")
-            db_tracker = DBCardRatioTrackerManager(collection, args.incremental)
+            self.db_tracker = DBCardRatioTrackerManager(self.collection)
             log.debug("DB tracker manager initialized")
 
-        result = process_game(Game(game))
+        result = process_game(game_obj)
         for final_ratio_dict, progressive_ratio_dict, win_points in result:
-            db_tracker.integrate_results('final', final_ratio_dict, win_points)
-            db_tracker.integrate_results('progressive', progressive_ratio_dict, win_points)
-
-        if args.max_games >= 0 and ind >= args.max_games:
-            log.info("Reached max_games of %d", args.max_games)
-            break
+            self.db_tracker.integrate_results('final', final_ratio_dict,
+                                              win_points)
+            self.db_tracker.integrate_results('progressive',
+                                              progressive_ratio_dict,
+                                              win_points)
+
+    def commit(self):
+        checkpoint = self.scanner.checkpoint()
+        if self.db_tracker:
+            self.db_tracker.save(checkpoint)
+        checkpoint.write()
 
-        if ind % commit_after == 0 and ind > 0:
-            start = time.time()
-            db_tracker.save()
-            scanner.save()
-            log.info("Committed calculations to the DB in %5.2fs", time.time() - start)
-
-    log.info("Ending run: %s", scanner.status_msg())
+def main(args):
+    database = utils.get_mongo_database()
+    scan_engine.run_plugins(database, [CardRatiosPlugin(database)], args)
 
-    if db_tracker:
-        db_tracker.save()
-    scanner.save()
 
 if __name__ == '__main__':
     parser = utils.incremental_max_parser()
@@ -3,10 +3,14 @@
 
 """Parse raw game data from isotropic into JSON list of game documents."""
 
+import bisect
+import bson
 import bz2
 import codecs
 import collections
 import datetime
+import glob
+import hashlib
 import itertools
 import logging
 import logging.handlers
@@ -18,12 +22,14 @@ import pymongo
 import re
 import sys
 
+from pymongo.errors import BulkWriteError
+
 from dominioncards import get_card, CardEncoder, indexes, index_to_card
 from game import Game
 from keys import *
-from utils import segments
 import dominioncards
 import game
+import ingest_sequence
 import name_merger
 import simplejson as json
 import utils
@@ -80,6 +86,58 @@ KW_INSTEAD = ' instead.'
 #KEYWORDS = [locals()[w] for w in dict(locals()) if w.startswith('KW_')]
 KEYWORDS = [v for k, v in dict(locals()).items() if k.startswith('KW_')]
 
+VP_TOKEN = u'▼'
+# Everything parse_turn() looks for in a line.
+LINE_KEYWORDS = KEYWORDS + [VP_TOKEN]
+
+def keyword_trie_pattern(keywords):
+    """ Return a regexp source matching any of keywords, factored into a
+    trie so that the regexp engine steps through it a character at a time
+    instead of trying every keyword at every position.  At any position the
+    longest keyword that starts there is matched.
+    """
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def _node_pattern(node):
+        branches = [re.escape(char) + _node_pattern(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        if len(branches) == 1 and '' not in node:
+            return branches[0]
+        pattern = '(?:' + '|'.join(branches) + ')'
+        if '' in node:
+            pattern += '?'
+        return pattern
+
+    return _node_pattern(trie)
+
+KEYWORD_RE = re.compile(keyword_trie_pattern(LINE_KEYWORDS), re.UNICODE)
+# A match also implies every keyword that is a prefix of it, eg ' reveals a'
+# implies ' reveals '.
+KEYWORD_PREFIXES = dict(
+    (kw, frozenset(other for other in LINE_KEYWORDS if kw.startswith(other)))
+    for kw in LINE_KEYWORDS)
+NO_KEYWORDS = frozenset()
+
+# Bump whenever a change to the parser changes the games it produces, so
+# that reparsing redoes the games stamped by earlier versions.
+CURRENT_PARSER_VERSION = 1
+
+# Number of raw games handed to a parsing pool worker at a time.
+PARSE_CHUNK_SIZE = 50
+# Bound on the raw games waiting in or coming back from the parsing pool is
+# PARSE_CHUNK_SIZE * MAX_PARSE_CHUNKS_IN_FLIGHT.
+MAX_PARSE_CHUNKS_IN_FLIGHT = 64
+# Number of parsed games written to a parsed_out file or to MongoDB at once.
+GAMES_PER_SEGMENT = 4000
+INSERT_BATCH_SIZE = 100
+
 class BogusGameError(Exception):
     """ Exception for a degenerate game that should not be
     parsed. These are common, and by design, so they should not be
@@ -274,12 +332,14 @@ def canonicalize_names(turns_str, player_names):
 
     return turns_str
 
-def parse_game(game_str, dubious_check = False):
+def parse_game(game_str, dubious_check = False, deck_tracker = None):
     """ Parse game_str into game dictionary
 
     game_str: Entire contents of an isotropic log file.
     dubious_check: If true, raise a BogusGame exception if the game is
       suspicious.
+    deck_tracker: If given, a DeckTracker that is fed each turn as it is
+      parsed, for check_deck_sanity().
 
     returns a dict with the following fields:
       decks: A list of player decks, as documend in parse_deck().
@@ -306,7 +366,7 @@ def parse_game(game_str, dubious_check = False):
     turns_str = turns_str[first_index:]
     turns_str = canonicalize_names(turns_str, names_list)
 
-    turns = parse_turns(turns_str, names_list)
+    turns = parse_turns(turns_str, names_list, deck_tracker)
 
     associate_game_with_norm_names(game_dict)
     associate_turns_with_owner(game_dict, turns)
@@ -434,6 +494,34 @@ def parse_vetoes(game_dict, veto_str):
 
     return v_dict
 
+def classify_lines(lines):
+    """ Return a list holding the frozenset of LINE_KEYWORDS that occur in
+    each of lines.
+
+    Rather than testing every line for every keyword, this makes one pass of
+    KEYWORD_RE over all the lines joined together, and files each match
+    under the line it falls in.  Keywords can overlap, like ' trashes ' and
+    'trashes it.', so each search resumes one character after the start of
+    the previous match rather than after its end.
+    """
+    text = '\n'.join(lines)
+    line_starts = []
+    line_start = 0
+    for line in lines:
+        line_starts.append(line_start)
+        line_start += len(line) + 1
+
+    keywords = [NO_KEYWORDS] * len(lines)
+    search = KEYWORD_RE.search
+    match = search(text)
+    while match:
+        start = match.start()
+        line_idx = bisect.bisect_right(line_starts, start) - 1
+        keywords[line_idx] = keywords[line_idx].union(
+            KEYWORD_PREFIXES[match.group()])
+        match = search(text, start + 1)
+    return keywords
+
 def name_and_rest(line, term):
     """ Split line about term, return (before, after including term). """
     start_of_term = line.find(term)
@@ -601,6 +689,8 @@ def parse_turn(turn_blob, names_list):
                                                      BUYS: []})
     tracker = PlayerTracker()
 
+    line_keywords_list = classify_lines(lines)
+
     for line_idx, line in enumerate(lines):
         active_player = tracker.get_active_player(line)
         if active_player == tracker.current_player():
@@ -615,9 +705,13 @@ def parse_turn(turn_blob, names_list):
             # targ_obj = opp_turn_info[names_list[active_player]]
             targ_obj = opp_turn_info[str(active_player)]
 
-        has_trashing = KW_TRASHING in line
-        has_trashes = KW_TRASHES in line
-        has_gaining = KW_GAINING in line
+        kws = line_keywords_list[line_idx]
+        if not kws:
+            continue
+
+        has_trashing = KW_TRASHING in kws
+        has_trashes = KW_TRASHES in kws
+        has_gaining = KW_GAINING in kws
         orig_buys_len = len(targ_obj.get(BUYS, []))
         orig_gains_len = len(targ_obj.get(GAINS, []))
 
@@ -632,78 +726,78 @@ def parse_turn(turn_blob, names_list):
                 did_trading_post_gain = True
             else:
                 targ_obj[TRASHES].extend(capture_cards(line))
-        if KW_WITH_A in line:
-            if KW_REPLACING in line:
+        if KW_WITH_A in kws:
+            if KW_REPLACING in kws:
                 new_gained_portion = line[line.find(KW_WITH_A):]
                 targ_obj[GAINS].extend(capture_cards(new_gained_portion))
-        if KW_PLAYS in line or KW_PLAYING in line:
+        if KW_PLAYS in kws or KW_PLAYING in kws:
             plays.extend(capture_cards(line))
         if has_gaining and not did_trading_post_gain:
-            if KW_ANOTHER_ONE in line: # mints a gold gaining another one
+            if KW_ANOTHER_ONE in kws: # mints a gold gaining another one
                 targ_obj[GAINS].extend(capture_cards(line))
             else:
                 # gaining always associated with current player?
                 targ_obj[GAINS].extend(
                     capture_cards(line[line.find(KW_GAINING):]))
-        if KW_BUYS in line:
+        if KW_BUYS in kws:
             targ_obj[BUYS].extend(capture_cards(line))
-        if KW_GAINS_THE in line:
+        if KW_GAINS_THE in kws:
             targ_obj[GAINS].extend(capture_cards(line))
         if has_trashing:
-            if KW_REVEALS in lines[line_idx - 1] and not KW_DRAWS in line:
+            if KW_REVEALS in line_keywords_list[line_idx - 1] and not KW_DRAWS in kws:
                 targ_obj[TRASHES].extend(capture_cards(lines[line_idx - 1]))
-            if KW_REVEALING in line or KW_REVEALS in line:
+            if KW_REVEALING in kws or KW_REVEALS in kws:
                 # reveals watchtower trashing ... python update_loop.py                # noble brigand reveals xx, yy and trashes yy
                 trashed = capture_cards(line[line.find(KW_TRASHING):])
                 targ_obj[TRASHES].extend(trashed)
             else:
                 rest = line
-                if KW_GAINING in line:
+                if KW_GAINING in kws:
                     rest = line[:line.find(KW_GAINING)]
                 targ_obj[TRASHES].extend(capture_cards(rest))
-        if KW_GAINS_A in line or KW_GAMES_A in line:
-            if KW_TOKEN in line:
+        if KW_GAINS_A in kws or KW_GAMES_A in kws:
+            if KW_TOKEN in kws:
                 assert get_card('Pirate Ship') in capture_cards(line), 'Pirate ship not in line'
                 ps_tokens += 1
             else:
                 rest = line[max(line.find(KW_GAINS_A), line.find(KW_GAMES_A)):]
                 targ_obj[GAINS].extend(capture_cards(rest))
-        if KW_IS_TRASHED in line:
+        if KW_IS_TRASHED in kws:
             # Saboteur after revealing cards, name not mentioned on this line.
             cards = capture_cards(line)
             targ_obj[TRASHES].extend(cards)
-        if KW_REVEALS in line:
+        if KW_REVEALS in kws:
             card_revealed = capture_cards(line)
 
             # arg, ambassador requires looking at the next line to figure
             # out how many copies were returned
             if (card_revealed and line_idx + 1 < len(lines) and
-                KW_RETURNING in lines[line_idx + 1] and not
-                KW_REVEALING in lines[line_idx + 1]):
+                KW_RETURNING in line_keywords_list[line_idx + 1] and not
+                KW_REVEALING in line_keywords_list[line_idx + 1]):
                 next_line = lines[line_idx + 1]
                 num_copies = 1
                 num_copies_match = NUMBER_COPIES.search(next_line)
                 if num_copies_match:
                     num_copies = int(num_copies_match.group(1))
                 returns.extend(card_revealed * num_copies)
-        if KW_REVEALING in line and KW_TO_THE_SUPPLY in line:
+        if KW_REVEALING in kws and KW_TO_THE_SUPPLY in kws:
             # old style ambassador line
             returns.extend(capture_cards(line))
-        if KW_GETTING in line or KW_GETS in line or KW_GET in line:
+        if KW_GETTING in kws or KW_GETS in kws or KW_GET in kws:
             money_match = GETTING_MONEY_RE.search(line)
             if money_match:
                 turn_money += int(money_match.group(1))
-        if KW_WHICH_IS_WORTH in line:
+        if KW_WHICH_IS_WORTH in kws:
             worth_match = WHICH_IS_WORTH_RE.search(line)
             assert bool(worth_match), line
             turn_money += int(worth_match.group(1))
-        if KW_FOR_MONEY in line:
+        if KW_FOR_MONEY in kws:
             worth_match = FOR_MONEY_RE.search(line)
             assert bool(worth_match), line
             turn_money += int(worth_match.group(1))
-        if u'▼' in line:
+        if VP_TOKEN in kws:
             vp_tokens += int(VP_TOKEN_RE.search(line).group('num'))
-        if KW_INSTEAD in line and not KW_WISHING in line and 'Trader' in line:
+        if KW_INSTEAD in kws and not KW_WISHING in kws and 'Trader' in line:
             if 'buy_or_gain' in targ_obj:
                 targ_list = targ_obj[targ_obj['buy_or_gain']]
                 non_silver_ind = len(targ_list) - 1
@@ -782,54 +876,238 @@ def split_turns(turns_blob):
             turn_texts[-1] += line + '\n'
     return [t for t in turn_texts if t]
 
-def parse_turns(turns_blob, names_list):
-    """ Return a list of turn objects, as documented by parse_turn(). """
-    return [parse_turn(text, names_list) for text in split_turns(turns_blob)]
+def parse_turns(turns_blob, names_list, deck_tracker=None):
+    """ Return a list of turn objects, as documented by parse_turn().
 
+    deck_tracker: If given, a DeckTracker to apply each turn to.
+    """
+    turns = [parse_turn(text, names_list) for text in split_turns(turns_blob)]
+    if deck_tracker is not None:
+        name_to_index = dict((name, idx) for idx, name in enumerate(names_list))
+        for turn in turns:
+            deck_tracker.add_turn(name_to_index[turn[NAME]], turn)
+    return turns
 
-def save_parse_error(parse_error_col, log, game, message):
-    """ Store parsing errors with the game ID so we can reflow them later """
-    parse_error = {'game_id': game['_id'],
-                   'game_date': game['game_date'],
-                   'message': message,
-                   'inserted': datetime.datetime.isoformat(datetime.datetime.now()),
-                   }
+
+class DeckTracker(object):
+    """ Keeps running card counts for each player of a game as its turns are
+    parsed, applying the turns' deck changes the way game.GameState does.
+
+    Decks are keyed by the player's index in the game's deck section, and
+    count cards by index.
+    """
+
+    def __init__(self):
+        self.decks = collections.defaultdict(self._starting_deck)
+
+    @staticmethod
+    def _starting_deck():
+        return collections.defaultdict(int, {dominioncards.Copper.index: 7,
+                                             dominioncards.Estate.index: 3})
+
+    def add_turn(self, player_index, turn):
+        """ Apply the deck changes of turn, a parse_turn() dict, taken by the
+        player at player_index. """
+        deck = self.decks[player_index]
+        for card in turn.get(BUYS, []) + turn.get(GAINS, []):
+            deck[card] += 1
+        for card in turn.get(TRASHES, []) + turn.get(RETURNS, []):
+            deck[card] -= 1
+        for opp_index, opp_info in turn.get(OPP, {}).iteritems():
+            opp_deck = self.decks[int(opp_index)]
+            for card in opp_info.get(GAINS, []):
+                opp_deck[card] += 1
+            for card in opp_info.get(TRASHES, []) + opp_info.get(RETURNS, []):
+                opp_deck[card] -= 1
+
+    def deck_composition(self, player_index):
+        """ Return the computed deck of the player at player_index, as a dict
+        of nonzero counts keyed like the DECK field of parse_deck(). """
+        return dict((str(card), count) for card, count in
+                    self.decks[player_index].iteritems() if count)
+
+
+def describe_parse_error(error):
+    """ Return a unicode description of error for the parse_error collection.
+
+    Unlike the exception itself, the description can be encoded as BSON and
+    handed back from a parsing pool worker process.
+    """
+    if isinstance(error, basestring):
+        return error
+    for attr in ['reason', 'line']:
+        if hasattr(error, attr):
+            return u'%s %s' % (error.__class__.__name__, getattr(error, attr))
+    return u'%s %s' % (error.__class__.__name__, error)
+
+
+def parse_error_record(game, message):
+    """ Return the parse_error collection document for game and message. """
+    return {'game_id': game['_id'],
+            'game_date': game['game_date'],
+            'message': describe_parse_error(message),
+            'inserted': datetime.datetime.isoformat(datetime.datetime.now()),
+            }
+
+
+def save_parse_error_record(parse_error_col, log, parse_error):
+    """ Store a record built by parse_error_record(). """
     try:
         parse_error_col.save(parse_error, safe=True, check_keys=True)
     except Exception as e:
-        log.exception("Got exception on trying to save parsing error for game %s", game['_id'])
+        log.exception("Got exception on trying to save parsing error for game %s", parse_error['game_id'])
 
 
-def parse_game_from_dict(log, parse_error_col, game):
-    """ Parse game from raw_game collection dict object. """
+def save_parse_error(parse_error_col, log, game, message):
+    """ Store parsing errors with the game ID so we can reflow them later """
+    save_parse_error_record(parse_error_col, log,
+                            parse_error_record(game, message))
+
+
+def parse_game_from_dict_with_error(log, game, deck_tracker=None):
+    """ Parse game from raw_game collection dict object.
+
+    Returns a (parsed game or None, error or None) tuple.  The error is only
+    set for failures worth storing in the parse_error collection.
+
+    deck_tracker: If given, a DeckTracker to fill in while parsing.
+    """
     contents = bz2.decompress(game['text']).decode('utf-8')
 
     if not contents:
         log.debug('%s is empty game', game['_id'])
-        return None
+        return None, None
     if '<b>game aborted' in contents:
         log.debug('%s is aborted game', game['_id'])
-        return None
+        return None, None
     try:
-        parsed = parse_game(contents, dubious_check = True)
+        parsed = parse_game(contents, dubious_check = True,
+                            deck_tracker = deck_tracker)
         parsed['_id'] = game['_id']
         parsed['game_date'] = game['game_date']
-        return parsed
+        parsed[PARSER_VERSION] = CURRENT_PARSER_VERSION
+        parsed[RAW_HASH] = raw_game_hash(game)
+        return parsed, None
     except BogusGameError as bogus_game_exception:
         log.debug('%s got BogusGameError: %s', game['_id'], bogus_game_exception.reason)
-        return None
+        return None, None
     except ParsingError as pe:
         log.warning('%s got ParsingError: %s', game['_id'], pe.reason)
-        save_parse_error(parse_error_col, log, game, pe)
-        return None
+        return None, pe
     except ParseTurnHeaderError as p:
         log.warning('%s got ParseTurnHeaderError: %s', game['_id'], p)
-        save_parse_error(parse_error_col, log, game, p)
-        return None
+        return None, p
     except AssertionError as e:
         log.warning('%s got AssertionError: %s', game['_id'], e)
-        save_parse_error(parse_error_col, log, game, e)
-        return None
+        return None, e
+
+
+def raw_game_hash(game):
+    """ Return a hash of the stored text of game, a raw_games collection
+    dict. """
+    return hashlib.sha1(game['text']).hexdigest()
+
+
+def changed_raw_games(log, raw_games, games_col):
+    """ Yield the games from raw_games that need parsing, skipping those that
+    games_col already holds a game for, stamped with CURRENT_PARSER_VERSION
+    and the same raw_game_hash().
+
+    games_col is queried once per PARSE_CHUNK_SIZE raw games.
+    """
+    num_skipped = 0
+    for chunk in utils.chunks(raw_games, PARSE_CHUNK_SIZE):
+        parsed_hashes = {}
+        for parsed in games_col.find(
+            {'_id': {'$in': [raw_game['_id'] for raw_game in chunk]},
+             PARSER_VERSION: CURRENT_PARSER_VERSION}, [RAW_HASH]):
+            parsed_hashes[parsed['_id']] = parsed.get(RAW_HASH)
+        for raw_game in chunk:
+            if parsed_hashes.get(raw_game['_id']) == raw_game_hash(raw_game):
+                num_skipped += 1
+            else:
+                yield raw_game
+    log.info('Skipped %d games already parsed by parser version %d',
+             num_skipped, CURRENT_PARSER_VERSION)
+
+
+def parse_game_from_dict(log, parse_error_col, game):
+    """ Parse game from raw_game collection dict object. """
+    parsed, error = parse_game_from_dict_with_error(log, game)
+    if error is not None:
+        save_parse_error(parse_error_col, log, game, error)
+    return parsed
+
+
+def parse_raw_games_chunk(raw_games, log=None, strict_sanity=False):
+    """ Parse and sanity check an iterable of raw_game collection dicts.
+
+    This is the unit of work for a parsing pool worker, so it does not touch
+    the database.  Returns a tuple of (parsed games, parse_error records,
+    BrokennessTracker) for the caller to store.
+
+    strict_sanity: If true, sanity check games with check_game_sanity(),
+      which replays them through game.GameState, rather than with the deck
+      counts kept while parsing.
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+    parsed_games = []
+    parse_errors = []
+    tracker = BrokennessTracker()
+    for raw_game in raw_games:
+        deck_tracker = None if strict_sanity else DeckTracker()
+        parsed, error = parse_game_from_dict_with_error(log, raw_game,
+                                                        deck_tracker)
+        if error is not None:
+            parse_errors.append(parse_error_record(raw_game, error))
+        if not parsed:
+            continue
+        if not tracker.check(log, parsed, deck_tracker):
+            parse_errors.append(
+                parse_error_record(parsed, 'check_game_sanity failed'))
+        parsed_games.append(parsed)
+    return parsed_games, parse_errors, tracker
+
+
+def parse_raw_games(log, raw_games, pool=None, strict_sanity=False):
+    """ Yield parse_raw_games_chunk() results for chunks of PARSE_CHUNK_SIZE
+    games from raw_games, in order.
+
+    pool: if given, a multiprocessing.Pool across which the chunks are
+      spread.  Pool.imap() would read all of raw_games up front, so at most
+      MAX_PARSE_CHUNKS_IN_FLIGHT chunks are handed out at a time instead.
+    """
+    raw_chunks = utils.chunks(raw_games, PARSE_CHUNK_SIZE)
+    if pool is None:
+        for chunk in raw_chunks:
+            yield parse_raw_games_chunk(chunk, log, strict_sanity)
+        return
+
+    in_flight = collections.deque()
+    for chunk in raw_chunks:
+        in_flight.append(pool.apply_async(parse_raw_games_chunk,
+                                          (chunk, None, strict_sanity)))
+        if len(in_flight) >= MAX_PARSE_CHUNKS_IN_FLIGHT:
+            yield in_flight.popleft().get()
+    while in_flight:
+        yield in_flight.popleft().get()
+
+
+def parsed_game_stream(log, raw_games, parse_error_col, tracker, pool=None,
+                       strict_sanity=False):
+    """ Yield the successfully parsed games from raw_games one at a time.
+
+    Parse errors are stored in parse_error_col as they are found, and sanity
+    check results are merged into tracker, a BrokennessTracker.
+    """
+    for chunk_games, chunk_errors, chunk_tracker in parse_raw_games(
+        log, raw_games, pool, strict_sanity):
+        for parse_error in chunk_errors:
+            save_parse_error_record(parse_error_col, log, parse_error)
+        tracker.merge(chunk_tracker)
+        for parsed_game in chunk_games:
+            yield parsed_game
 
 def outer_parse_game(filename):
     """ Parse game from filename. """
@@ -864,40 +1142,127 @@ def dump_segment(arg_tuple):
     json.dump(segment, open(out_name, 'w'), sort_keys=True, cls=CardEncoder, skipkeys=True)
 
 
-def parse_and_insert(log, raw_games, games_col, parse_error_col, year_month_day):
-    """ Parse the list of games and insert them into the MongoDB.
+def remove_segments(year_month_day):
+    """ Remove the parsed_out files of an earlier parse of year_month_day,
+    so that none are left behind when this parse writes fewer of them. """
+    for out_name in glob.glob('parsed_out/%s-*.json' % year_month_day):
+        os.remove(out_name)
 
-    log: Logging object
-    raw_games: List of games to parse, each in dict format
-    games_col: Destination MongoDB collection
-    parse_error_col: MongoDB collection for parse errors (for potential reflow later)
-    year_month_day: string in yyyymmdd format encoding date
+
+def record_insert_failure(log, parse_error_col, game, message):
+    """ Log a parsed game that could not be inserted, and store its ID in
+    parse_error_col so it gets reflowed later.
+
+    Call this from the except block that caught the failure, so the log
+    carries the traceback as it did when games were saved one at a time.
     """
-    log.debug('Beginning to parse %d games for %s', len(raw_games), year_month_day)
-    parsed_games = map(lambda x: parse_game_from_dict(log, parse_error_col, x), raw_games)
+    log.exception("Got exception on trying to insert parsed game %s", game['_id'])
+    save_parse_error(parse_error_col, log, game,
+                     u'Insert failed: %s' % describe_parse_error(message))
 
-    log.debug('Beginning to filter %d games for %s', len(parsed_games), year_month_day)
-    parsed_games = [x for x in parsed_games if x]
-    track_brokenness(log, parse_error_col, parsed_games)
 
-    log.debug('Beginning to insert %d games for %s', len(parsed_games), year_month_day)
+def save_games(log, games_col, parse_error_col, games):
+    """ Upsert a batch of parsed games into games_col as one unordered bulk
+    write, so the batch costs a single acknowledged round trip rather than
+    one per game.
 
-    for game in parsed_games:
+    A game that fails to write does not stop the rest of the batch; it is
+    logged and recorded in parse_error_col.  Returns the number of games
+    written.
+    """
+    first_seq = ingest_sequence.stamp_games(games_col, games)
+    try:
+        return write_games(log, games_col, parse_error_col, games)
+    finally:
+        ingest_sequence.release(games_col.database, first_seq)
+
+
+def write_games(log, games_col, parse_error_col, games):
+    """ The bulk write of save_games(), of games already stamped with their
+    INGEST_SEQ. """
+    bulk = games_col.initialize_unordered_bulk_op()
+    queued = []
+    for game in games:
+        # Bulk writes don't check keys the way save(check_keys=True) did.
+        # This encodes each game to BSON a second time, which costs about
+        # 1% of the time it took to parse it.
         try:
-            games_col.save(game, safe=True, check_keys=True)
+            bson.BSON.encode(game, check_keys=True)
         except Exception as e:
-            log.exception("Got exception on trying to insert parsed game %s", game['_id'])
+            record_insert_failure(log, parse_error_col, game, e)
+            continue
+        bulk.find({'_id': game['_id']}).upsert().replace_one(game)
+        queued.append(game)
 
-    return len(parsed_games)
+    if not queued:
+        return 0
+
+    try:
+        bulk.execute()
+    except BulkWriteError as bwe:
+        write_errors = bwe.details['writeErrors']
+        for write_error in write_errors:
+            record_insert_failure(log, parse_error_col,
+                                  queued[write_error['index']],
+                                  write_error['errmsg'])
+        return len(queued) - len(write_errors)
+    except Exception as e:
+        log.exception("Got exception on trying to insert %d parsed games",
+                      len(queued))
+        for game in queued:
+            record_insert_failure(log, parse_error_col, game, e)
+        return 0
+
+    return len(queued)
 
 
-def convert_to_json(log, raw_games, year_month_day, game_list=None):
+def parse_and_insert(log, raw_games, games_col, parse_error_col, year_month_day,
+                     pool=None, strict_sanity=False):
+    """ Parse the games and insert them into the MongoDB.
+
+    log: Logging object
+    raw_games: Iterable of games to parse, each in dict format
+    games_col: Destination MongoDB collection
+    parse_error_col: MongoDB collection for parse errors (for potential reflow later)
+    year_month_day: string in yyyymmdd format encoding date
+    pool: if given, a multiprocessing.Pool to parse the games with.
+    strict_sanity: sanity check games with check_game_sanity().
+
+    Games are upserted with one bulk write per INSERT_BATCH_SIZE games as
+    they are parsed; see save_games().  Returns the number of parsed games.
+    """
+    log.debug('Beginning to parse games for %s', year_month_day)
+
+    tracker = BrokennessTracker()
+    parsed_games = parsed_game_stream(log, raw_games, parse_error_col,
+                                      tracker, pool, strict_sanity)
+    num_parsed = 0
+    for batch in utils.chunks(parsed_games, INSERT_BATCH_SIZE):
+        log.debug('Inserting %d games for %s', len(batch), year_month_day)
+        save_games(log, games_col, parse_error_col, batch)
+        num_parsed += len(batch)
+    tracker.log_summary(log)
+
+    return num_parsed
+
+
+def convert_to_json(log, raw_games, parse_error_col, year_month_day,
+                    game_list=None, pool=None, strict_sanity=False,
+                    games_col=None):
     """ Parse the games in for given year_month_day and output them
     into split local files.  Each local file should contain 4000 games or
     less, and be smaller than 16 MB, for easy import into mongodb.
 
     year_month_day: string in yyyymmdd format encoding date
     games_to_parse: if given, use these games rather than all files in dir.
+    pool: if given, a multiprocessing.Pool to parse the games with.
+    strict_sanity: sanity check games with check_game_sanity().
+    games_col: if given, skip the games that are unchanged in games_col, as
+      determined by changed_raw_games().  load_parsed_data.py upserts the
+      games that are written, so reparsed games replace their old versions.
+
+    Each file is written as soon as its games are parsed, so at most one
+    segment of parsed games is held in memory.
     """
     if game_list is None:
         games_to_parse = raw_games.find({'game_date': year_month_day})
@@ -912,49 +1277,90 @@ def convert_to_json(log, raw_games, year_month_day, game_list=None):
     else:
         log.info('%s games to parse in %s', games_to_parse.count(), year_month_day)
 
-    # TODO: Temporarily commented out the Pool-based implementation
-    #pool = multiprocessing.Pool()
-    #parsed_games = pool.map(outer_parse_game, games_to_parse, chunksize=50)
-    parsed_games = map(lambda x: parse_game_from_dict(log, x), games_to_parse)
-    log.debug('%s before filtering %s', year_month_day, len(parsed_games))
-    parsed_games = [x for x in parsed_games if x]
+    if games_col is not None:
+        games_to_parse = changed_raw_games(log, games_to_parse, games_col)
+
+    remove_segments(year_month_day)
+    tracker = BrokennessTracker()
+    parsed_games = parsed_game_stream(log, games_to_parse, parse_error_col,
+                                      tracker, pool, strict_sanity)
+    num_parsed = 0
+    for idx, segment in enumerate(utils.chunks(parsed_games,
+                                               GAMES_PER_SEGMENT)):
+        dump_segment((idx, year_month_day, segment))
+        num_parsed += len(segment)
+    tracker.log_summary(log)
 
-    track_brokenness(log, parsed_games)
+    log.debug('%s after filtering %s', year_month_day, num_parsed)
+
+
+class BrokennessTracker(object):
+    """ Keeps count of the supply cards in games that fail the sanity check,
+    to point at the cards that cause bad parses.
+
+    Trackers filled in by separate parsing workers can be merged.
+    """
+
+    def __init__(self):
+        self.num_games = 0
+        self.failures = 0
+        self.wrongness = collections.defaultdict(int)
+        self.overall = collections.defaultdict(int)
+
+    def check(self, log, parsed_game, deck_tracker=None):
+        """ Sanity check parsed_game, record and return the outcome.
+
+        If the DeckTracker filled in while parsing the game is given, use
+        check_deck_sanity(), otherwise check_game_sanity().
+        """
+        if deck_tracker is not None:
+            accurately_parsed = check_deck_sanity(parsed_game, deck_tracker,
+                                                  log)
+        else:
+            accurately_parsed = check_game_sanity(game.Game(parsed_game), log)
+        if not accurately_parsed:
+            log.warning('Failed to accurately parse game %s', parsed_game['_id'])
+        self.record(parsed_game, accurately_parsed)
+        return accurately_parsed
 
-    log.debug('%s after filtering %s', year_month_day, len(parsed_games))
+    def record(self, parsed_game, accurately_parsed):
+        self.num_games += 1
+        if not accurately_parsed:
+            self.failures += 1
+        for card in parsed_game[SUPPLY]:
+            if not accurately_parsed:
+                self.wrongness[card] += 1
+            self.overall[card] += 1
+
+    def merge(self, other):
+        self.num_games += other.num_games
+        self.failures += other.failures
+        for card, count in other.wrongness.iteritems():
+            self.wrongness[card] += count
+        for card, count in other.overall.iteritems():
+            self.overall[card] += count
+
+    def log_summary(self, log):
+        """Print some summary statistics about cards that cause bad parses."""
+        ratios = []
+        for card in self.overall:
+            ratios.append(((float(self.wrongness[card]) / self.overall[card]),
+                           index_to_card(card)))
+        ratios.sort()
+        if ratios and ratios[-1][0] > 0:
+            log.warning("Ratios for problem cards %s, %d failures out of %d games", ratios[-10:],
+                        self.failures, self.num_games)
+        else:
+            log.debug('Perfect parsing, %d games!', self.num_games)
 
-    game_segments = list(segments(parsed_games, 4000))
-    labelled_segments = [(i, year_month_day, c) for i, c in
-                         enumerate(game_segments)]
-    #pool.map(dump_segment, labelled_segments)
-    map(dump_segment, labelled_segments)
-    #pool.close()
 
 def track_brokenness(log, parse_error_col, parsed_games):
     """Print some summary statistics about cards that cause bad parses."""
-    failures = 0
-    wrongness = collections.defaultdict(int)
-    overall = collections.defaultdict(int)
+    tracker = BrokennessTracker()
     for raw_game in parsed_games:
-        accurately_parsed = check_game_sanity(game.Game(raw_game), log)
-        if not accurately_parsed:
-            log.warning('Failed to accurately parse game %s', raw_game['_id'])
+        if not tracker.check(log, raw_game):
             save_parse_error(parse_error_col, log, raw_game, 'check_game_sanity failed')
-            failures += 1
-        for card in raw_game[SUPPLY]:
-            if not accurately_parsed:
-                wrongness[card] += 1
-            overall[card] += 1
-
-    ratios = []
-    for card in overall:
-        ratios.append(((float(wrongness[card]) / overall[card]), index_to_card(card)))
-    ratios.sort()
-    if ratios and ratios[-1][0] > 0:
-        log.warning("Ratios for problem cards %s, %d failures out of %d games", ratios[-10:],
-                    failures, len(parsed_games))
-    else:
-        log.debug('Perfect parsing, %d games!', len(parsed_games))
+    tracker.log_summary(log)
 
 def parse_game_from_file(filename):
     """ Return a parsed version of a given filename. """
@@ -962,17 +1368,63 @@ def parse_game_from_file(filename):
     return parse_game(contents, dubious_check = True)
 
 __problem_deck_index__ = 0
+
+# Cards whose deck interactions aren't all captured by the parser.
+SANITY_SKIP_CARDS = [get_card('Masquerade'), get_card('Black Market'),
+                     get_card('Trader')]
+
+def log_deck_mismatch(log, parsed_deck_comp, computed_deck_comp):
+    """ Log the cards on which parsed_deck_comp and computed_deck_comp
+    disagree, returning True if there are any. """
+    global __problem_deck_index__
+
+    found_something_wrong = False
+    for card in set(parsed_deck_comp.keys() + computed_deck_comp.keys()):
+        if parsed_deck_comp.get(card, 0) != computed_deck_comp.get(card, 0):
+            if not found_something_wrong:
+                __problem_deck_index__ += 1
+                log.debug('[%d] %18s %9s %9s', __problem_deck_index__, 'card', 'from-data', 'from-sim')
+            log.debug('[%d] %-18s %9d %9d', __problem_deck_index__, card, parsed_deck_comp.get(card, 0),
+                      computed_deck_comp.get(card, 0))
+            found_something_wrong = True
+    return found_something_wrong
+
+def check_deck_sanity(game_dict, deck_tracker, log):
+    """ Check that the decks in the deck section of game_dict match the
+    decks computed by deck_tracker while its turns were parsed.
+
+    This is the same check as check_game_sanity(), without building a
+    game.Game and replaying it."""
+    if set(game_dict[SUPPLY]).intersection(
+            card.index for card in SANITY_SKIP_CARDS):
+        return True
+
+    for idx, deck in enumerate(game_dict[DECKS]):
+        parsed_deck_comp = dict((card, count) for card, count in
+                                deck[DECK].iteritems() if count)
+        computed_deck_comp = deck_tracker.deck_composition(idx)
+        if parsed_deck_comp != computed_deck_comp:
+            named = lambda comp: dict((index_to_card(int(card)), count)
+                                      for card, count in comp.iteritems())
+            if log_deck_mismatch(log, named(parsed_deck_comp),
+                                 named(computed_deck_comp)):
+                try:
+                    log.debug('[%d] insane game for %s %s: %s', __problem_deck_index__, deck[NAME], game_dict.get('_id', ''),
+                              ' '.join(str(index_to_card(card)) for card in game_dict[SUPPLY]))
+                except UnicodeEncodeError as e:
+                    None
+                return False
+    return True
+
 def check_game_sanity(game_val, log):
     """ Check if if game_val is self consistent.
 
     In particular, check that the end game player decks match the result of
     simulating deck interactions saved in game val."""
 
-    global __problem_deck_index__
-
     supply = game_val.get_supply()
     # ignore known bugs.
-    if set(supply).intersection([get_card('Masquerade'), get_card('Black Market'), get_card('Trader')]):
+    if set(supply).intersection(SANITY_SKIP_CARDS):
         return True
 
     # TODO: add score sanity checking here
@@ -990,18 +1442,7 @@ def check_game_sanity(game_val, log):
         delete_keys_with_empty_vals(computed_dict_comp)
 
         if parsed_deck_comp != computed_deck_comp:
-            found_something_wrong = False
-            for card in set(parsed_deck_comp.keys() +
-                            computed_deck_comp.keys()):
-                if parsed_deck_comp.get(card, 0) != \
-                        computed_deck_comp.get(card, 0):
-                    if not found_something_wrong:
-                        __problem_deck_index__ += 1
-                        log.debug('[%d] %18s %9s %9s', __problem_deck_index__, 'card', 'from-data', 'from-sim')
-                    log.debug('[%d] %-18s %9d %9d', __problem_deck_index__, card, parsed_deck_comp.get(card, 0),
-                              computed_deck_comp.get(card, 0))
-                    found_something_wrong = True
-            if found_something_wrong:
+            if log_deck_mismatch(log, parsed_deck_comp, computed_deck_comp):
                 try:
                     log.debug('[%d] insane game for %s %s: %s', __problem_deck_index__, player_deck.name(), game_val.get_id(),
                               ' '.join(map(str, game_val.get_supply())))
@@ -1010,18 +1451,73 @@ def check_game_sanity(game_val, log):
                 return False
     return True
 
+def count_parser_versions(parsed_games):
+    """ Return a dict mapping game_date to a (number of games stamped with
+    CURRENT_PARSER_VERSION, number of games stamped with an older version
+    or not at all) tuple. """
+    counts = collections.defaultdict(lambda: [0, 0])
+    for parsed in parsed_games:
+        stale = parsed.get(PARSER_VERSION) != CURRENT_PARSER_VERSION
+        counts[parsed['game_date']][stale] += 1
+    return dict((day, tuple(day_counts))
+                for day, day_counts in counts.iteritems())
+
+
+def report_parser_versions(args, log):
+    """ Log how many parsed games in the date range a bump of
+    CURRENT_PARSER_VERSION would invalidate, and how many are already due
+    for reparsing. """
+    connection = pymongo.MongoClient()
+    games_col = connection.test.games
+    parsed_games = games_col.find(
+        {'game_date': {'$gte': args.startdate, '$lte': args.enddate}},
+        ['game_date', PARSER_VERSION])
+    counts = count_parser_versions(parsed_games)
+
+    total_current, total_stale = 0, 0
+    for day in sorted(counts):
+        current, stale = counts[day]
+        log.info('%s: %d games at parser version %d, %d at older versions',
+                 day, current, CURRENT_PARSER_VERSION, stale)
+        total_current += current
+        total_stale += stale
+    log.info('Bumping the parser version would invalidate %d games; %d more '
+             'are already due for reparsing', total_current, total_stale)
+
+
 def main(args, log):
-    BEEN_PARSED_KEY = 'day_analyzed'
+    if args.report_invalidated:
+        report_parser_versions(args, log)
+        return
 
     if args.incremental:
         log.info("Performing incremental parsing from %s to %s", args.startdate, args.enddate)
     else:
         log.info("Performing non-incremental (re)parsing from %s to %s", args.startdate, args.enddate)
 
+    # Start the workers before connecting, so they don't inherit the socket.
+    pool = None
+    if args.workers > 1:
+        log.info("Parsing with a pool of %d workers", args.workers)
+        pool = multiprocessing.Pool(args.workers)
+
+    try:
+        parse_available_days(args, log, pool)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def parse_available_days(args, log, pool=None):
+    BEEN_PARSED_KEY = 'day_analyzed'
+
     connection = pymongo.MongoClient()
     db = connection.test # RT: changed.
     raw_games = db.raw_games
     raw_games.ensure_index('game_date')
+    parse_error_col = db.parse_error
+    games_col = None if args.reparse_unchanged else db.games
 
     utils.ensure_exists('parsed_out')
 
@@ -1045,7 +1541,9 @@ def main(args, log):
 
         try:
             log.info("Parsing %s", year_month_day)
-            convert_to_json(log, raw_games, year_month_day)
+            convert_to_json(log, raw_games, parse_error_col, year_month_day,
+                            pool=pool, strict_sanity=args.strict_sanity,
+                            games_col=games_col)
             continue
             day[BEEN_PARSED_KEY] = True
             day_status_col.save(day)
@@ -1058,7 +1556,20 @@ def main(args, log):
 
 
 if __name__ == '__main__':
-    args = utils.incremental_date_range_cmd_line_parser().parse_args()
+    parser = utils.incremental_date_range_cmd_line_parser()
+    parser.add_argument('--workers', default=1, type=int,
+                        help='Number of processes to parse games with')
+    parser.add_argument('--strict-sanity', action='store_true',
+                        help='Sanity check games by replaying them through '
+                        'game.GameState, instead of with the deck counts '
+                        'kept while parsing')
+    parser.add_argument('--reparse_unchanged', action='store_true',
+                        help='Reparse games even if they were already parsed '
+                        'from the same raw text by this parser version')
+    parser.add_argument('--report_invalidated', action='store_true',
+                        help='Only report how many parsed games a parser '
+                        'version bump would invalidate')
+    args = parser.parse_args()
 
     script_root = os.path.splitext(sys.argv[0])[0]
 
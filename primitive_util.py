@@ -12,12 +12,77 @@ import collections
 
 PRIMITIVES = [dict, str, int, list, float, str]
 
-def to_primitive(val):
-    if hasattr(val, 'to_primitive_object'):
-        return val.to_primitive_object()
-    assert type(val) in PRIMITIVES, (val, type(val))
+# Encoders and decoders are generated per class on first use, and cached in
+# these.  Dict encoders and decoders are keyed by the class and its instance's
+# member names, slot ones by the class.  A class's members are assumed to keep
+# the kind, PrimitiveConversion or primitive, they had in the instance that
+# the encoder or decoder was generated from.
+_TYPE_ENCODERS = {}
+_DICT_ENCODERS = {}
+_DICT_DECODERS = {}
+_SLOT_LAYOUTS = {}
+
+def _identity(val):
     return val
 
+for _primitive_type in PRIMITIVES:
+    _TYPE_ENCODERS[_primitive_type] = _identity
+
+def to_primitive(val):
+    try:
+        return _TYPE_ENCODERS[type(val)](val)
+    except KeyError:
+        if hasattr(val, 'to_primitive_object'):
+            encoder = type(val).to_primitive_object
+            if encoder == ListSlotPrimitiveConversion.to_primitive_object:
+                encoder = _slot_layout(val).encode
+            _TYPE_ENCODERS[type(val)] = encoder
+            return encoder(val)
+        assert type(val) in PRIMITIVES, (val, type(val))
+        return val
+
+def _compile(func_name, lines, namespace):
+    """ Define the function func_name from its source lines in namespace,
+    and return it. """
+    source = '\n    '.join(lines)
+    exec compile(source, '<%s>' % func_name, 'exec') in namespace
+    return namespace[func_name]
+
+def _dict_encoder(inst):
+    key = (type(inst), tuple(inst.__dict__))
+    try:
+        return _DICT_ENCODERS[key]
+    except KeyError:
+        pass
+    lines = ['def encode(self):', 'd = self.__dict__', 'ret = {}']
+    for k, v in inst.__dict__.iteritems():
+        if hasattr(v, 'to_primitive_object'):
+            lines.append('ret[%r] = d[%r].to_primitive_object()' % (k, k))
+        else:
+            lines.append('ret[%r] = to_primitive(d[%r])' % (k, k))
+    lines.append('return ret')
+    encoder = _compile('encode', lines, {'to_primitive': to_primitive})
+    _DICT_ENCODERS[key] = encoder
+    return encoder
+
+def _dict_decoder(inst):
+    key = (type(inst), tuple(inst.__dict__))
+    try:
+        return _DICT_DECODERS[key]
+    except KeyError:
+        pass
+    lines = ['def decode(self, obj):', 'd = self.__dict__']
+    for k, v in inst.__dict__.iteritems():
+        if hasattr(v, 'from_primitive_object'):
+            lines.append('d[%r].from_primitive_object(obj[%r])' % (k, k))
+        else:
+            lines.extend(['v = obj[%r]' % k,
+                          'assert type(v) in PRIMITIVES, v',
+                          'd[%r] = v' % k])
+    decoder = _compile('decode', lines, {'PRIMITIVES': PRIMITIVES})
+    _DICT_DECODERS[key] = decoder
+    return decoder
+
 class PrimitiveConversion(object):
     """ An object that supports the PrimitiveConversion operation can be
     serialized to and deserialized from a possibly nested collection of native
@@ -31,14 +96,18 @@ class PrimitiveConversion(object):
     into a python dict whose keys are the member names."""
     
     def to_primitive_object(self):
-        ret = {}
-        for k, v in self.__dict__.iteritems():
-            ret[k] = to_primitive(v)
-        return ret
+        return _dict_encoder(self)(self)
 
     def from_primitive_object(self, obj):
         # Get rid of _id because it's something that mongo injects into our
         # objects, and it's not really natural to the objects themselves.
+        num_keys = len(obj) - ('_id' in obj)
+        if num_keys == len(self.__dict__):
+            try:
+                _dict_decoder(self)(self, obj)
+                return
+            except KeyError:
+                pass
         obj_keys_except_id = set(obj.keys()) - set(['_id'])
         unicoded_keys = set(map(unicode, self.__dict__.keys()))
         assert unicoded_keys == obj_keys_except_id, (
@@ -56,10 +125,53 @@ def _slot_members(inst):
 
 def slot_index_count(obj):
     if isinstance(obj, ListSlotPrimitiveConversion):
-        return sum(slot_index_count(member) for member in _slot_members(obj))
+        return _slot_layout(obj).count
     else:
         return 1
 
+class _SlotLayout(object):
+    """ The generated encode and decode functions of a
+    ListSlotPrimitiveConversion class, which (de)serialize the primitive
+    members of its instances and their nested slot members, in order. """
+
+    def __init__(self, inst):
+        self.count = 0
+        self.encode_lines = ['def encode(self):']
+        self.decode_lines = ['def decode(self, l):']
+        self.num_vars = 0
+        leaves = self.add_members('self', inst)
+        self.encode_lines.append('return [%s]' % ', '.join(leaves))
+        self.decode_lines.append('return')
+        self.encode = _compile('encode', self.encode_lines, {})
+        self.decode = _compile('decode', self.decode_lines, {})
+
+    def add_members(self, var, inst):
+        leaves = []
+        for member_name in inst.__slots__:
+            member = getattr(inst, member_name)
+            if isinstance(member, ListSlotPrimitiveConversion):
+                member_var = 'm%d' % self.num_vars
+                self.num_vars += 1
+                line = '%s = %s.%s' % (member_var, var, member_name)
+                self.encode_lines.append(line)
+                self.decode_lines.append(line)
+                leaves.extend(self.add_members(member_var, member))
+            else:
+                assert type(member) in PRIMITIVES
+                leaves.append('%s.%s' % (var, member_name))
+                self.decode_lines.append('%s.%s = l[%d]' % (
+                        var, member_name, self.count))
+                self.count += 1
+        return leaves
+
+def _slot_layout(inst):
+    try:
+        return _SLOT_LAYOUTS[type(inst)]
+    except KeyError:
+        layout = _SlotLayout(inst)
+        _SLOT_LAYOUTS[type(inst)] = layout
+        return layout
+
 class ListSlotPrimitiveConversion(PrimitiveConversion):
     """ A more restrictive, but more compact when serialized version of 
     PrimitiveConversion.  This serializes to/from flat lists.  This
@@ -72,36 +184,20 @@ class ListSlotPrimitiveConversion(PrimitiveConversion):
     """
     
     def to_primitive_object(self):
-        ret = [None] * slot_index_count(self)
-        self.serialize_to_list(ret, 0)
-        return ret
+        return _slot_layout(self).encode(self)
 
     def from_primitive_object(self, obj):
+        layout = _slot_layout(self)
         assert type(obj) == list, '%s is not a list' % str(obj)
-        assert len(obj) == slot_index_count(self), '%d != %d' % (
-            len(obj), slot_index_count(self))
-                                                                
-        self.deserialize_from_list(obj, 0)
+        assert len(obj) == layout.count, '%d != %d' % (len(obj), layout.count)
+        layout.decode(self, obj)
 
     def serialize_to_list(self, l, start):
-        for member in _slot_members(self):
-            if isinstance(member, ListSlotPrimitiveConversion):
-                member.serialize_to_list(l, start)
-            else:
-                assert type(member) in PRIMITIVES
-                l[start] = member
-            start += slot_index_count(member)
+        l[start:start + slot_index_count(self)] = self.to_primitive_object()
 
     def deserialize_from_list(self, l, start):
-        for member_name in self.__slots__:
-            member_val = getattr(self, member_name)
-            if isinstance(member_val, ListSlotPrimitiveConversion):
-                member_val.deserialize_from_list(l, start)
-            else:
-                assert type(member_val) in PRIMITIVES
-                setattr(self, member_name, l[start])
-            start += slot_index_count(member_val)
-                
+        _slot_layout(self).decode(self, l[start:start + slot_index_count(self)])
+
 
 class ConvertibleDefaultDict(collections.defaultdict, PrimitiveConversion):
     def __init__(self, value_type, key_type = str):
@@ -111,21 +207,27 @@ class ConvertibleDefaultDict(collections.defaultdict, PrimitiveConversion):
 
     def to_primitive_object(self):
         ret = {}
+        encoders = _TYPE_ENCODERS
         for key, val in self.iteritems():
             if type(key) == unicode:
                 key = key.encode('utf-8')
             else:
                 key = str(key)
-            ret[key] = to_primitive(val)
+            if type(val) in encoders:
+                ret[key] = encoders[type(val)](val)
+            else:
+                ret[key] = to_primitive(val)
         return ret
 
     def from_primitive_object(self, obj):
+        value_type = self.value_type
+        key_type = self.key_type
         for k, v in obj.iteritems():
             if k == '_id': continue
-            val = self.value_type()
+            val = value_type()
             if hasattr(val, 'from_primitive_object'):
                 val.from_primitive_object(v)
             else: 
                 val = v
-            self[self.key_type(k)] = val
+            self[key_type(k)] = val
 
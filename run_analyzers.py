@@ -0,0 +1,63 @@
+#!/usr/bin/python
+
+""" Update the incremental analyses with one scan over the games.
+
+Runs the analyzers named by --analyzers (all of them by default) together
+through scan_engine, rather than running analyze.py, count_buys.py, etc.
+one after another.  With --archive, the games are read from an archive
+written by game_archive.py instead of from the games collection.
+"""
+
+import logging
+
+import analyze
+import analyze2
+import count_buys
+import dominionstats.utils.log
+import game_archive
+import optimal_card_ratios
+import run_trueskill
+import scan_engine
+import utils
+
+# Module-level logging instance
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+ANALYZERS = [analyze.AnalysisPlugin,
+             count_buys.BuyStatsPlugin,
+             analyze2.EventStatsPlugin,
+             optimal_card_ratios.CardRatiosPlugin,
+             run_trueskill.TrueskillPlugin]
+
+ANALYZERS_BY_NAME = dict((plugin.scan_name, plugin) for plugin in ANALYZERS)
+
+
+def main(args, analyzer_names=None):
+    """ Run the analyzers in analyzer_names, or in args.analyzers if that
+    isn't given."""
+    db = utils.get_mongo_database()
+    names = analyzer_names or args.analyzers.split(',')
+    plugins = [ANALYZERS_BY_NAME[name](db) for name in names]
+    log.info("Running analyzers %s", ', '.join(names))
+    games_col = None
+    if getattr(args, 'archive', None):
+        log.info("Reading games from archive %s", args.archive)
+        games_col = game_archive.GameView(args.archive)
+    scan_engine.run_plugins(db, plugins, args,
+                            getattr(args, 'processes', 1), games_col)
+
+
+if __name__ == '__main__':
+    parser = utils.incremental_max_parser()
+    parser.add_argument('--analyzers',
+                        default=','.join(p.scan_name for p in ANALYZERS),
+                        help='comma separated analyzers to run, out of %s' %
+                        ', '.join(p.scan_name for p in ANALYZERS))
+    parser.add_argument('--archive',
+                        help='read the games from this game_archive.py '
+                        'directory rather than from the database')
+    scan_engine.add_processes_argument(parser)
+    args = parser.parse_args()
+    dominionstats.utils.log.initialize_logging(args.debug)
+    main(args)
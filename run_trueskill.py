@@ -1,13 +1,11 @@
 """ Update trueskill ratings for openings."""
 
 import logging
-import time
 
-from game import Game
 from keys import *
 import dominionstats.utils.log
-import incremental_scanner
 import primitive_util
+import scan_engine
 import trueskill.trueskill as ts
 import utils
 
@@ -53,14 +51,14 @@ class DbBackedSkillTable(ts.SkillTable):
         self.skill_infos[name] = skill_info
         return self.skill_infos[name]
         
-    def save(self):
+    def save(self, checkpoint):
         for key, val in self.skill_infos.iteritems():
-            utils.write_object_to_db(val, self.coll, key)
+            checkpoint.save_object(val, self.coll, key)
 
 def setup_openings_collection(coll):
     coll.ensure_index('_id')
 
-def update_skills_for_game(game_dict, opening_skill_table, 
+def update_skills_for_game(game, opening_skill_table, 
                            #player_skill_table
                            ):
     teams = []
@@ -68,8 +66,6 @@ def update_skills_for_game(game_dict, opening_skill_table,
     openings = []
     dups = False
 
-    game = Game(game_dict)
-
     for deck in game.player_decks:
         opening = game.get_opening(deck)
         open_name = 'open:' + '+'.join(map(str, opening))
@@ -100,52 +96,47 @@ def update_skills_for_game(game_dict, opening_skill_table,
     # ts.update_trueskill_team(player_results, player_skill_table)
 
 
-def run_trueskill_openings(args, db, log, commit_after=25000):
-    games = db.games
-
+class TrueskillPlugin(scan_engine.AnalyzerPlugin):
+    """ Keeps the trueskill ratings of openings up to date. """
+    scan_name = 'trueskill'
+    # Openings need just the buys of each turn, and the turn numbers need
+    # the possession and outpost flags.
+    fields = [DECKS + '.' + key for key in [NAME, POINTS, ORDER, RESIGNED]] + [
+        DECKS + '.' + TURNS + '.' + key for key in [BUYS, POSSESSION, OUTPOST]]
 
-    collection = db.trueskill_openings
-    player_collection = db.trueskill_players
-    # player_collection.remove()
-    # collection.remove()
-    setup_openings_collection(collection)
-    # setup_openings_collection(player_collection)
+    def __init__(self, db):
+        scan_engine.AnalyzerPlugin.__init__(self, db)
+        self.collection = db.trueskill_openings
+        # self.player_collection = db.trueskill_players
+        self.opening_skill_table = None
 
-    opening_skill_table = DbBackedSkillTable(collection)
-    # player_skill_table = DbBackedSkillTable(player_collection)
+    def reset(self):
+        scan_engine.AnalyzerPlugin.reset(self)
+        self.collection.drop()
 
-    scanner = incremental_scanner.IncrementalScanner('trueskill', db)
-    log.info("Starting run: %s", scanner.status_msg())
-    if not args.incremental:
-        log.warning('resetting scanner and db')
-        scanner.reset()
-        collection.drop()
+    def start(self):
+        setup_openings_collection(self.collection)
+        # setup_openings_collection(self.player_collection)
+        self.opening_skill_table = DbBackedSkillTable(self.collection)
+        # self.player_skill_table = DbBackedSkillTable(self.player_collection)
 
-    for ind, game in enumerate(
-        utils.progress_meter(scanner.scan(db.games, {}))):
-        if len(game[DECKS]) >= 2 and len(game[DECKS][1][TURNS]) >= 5:
-            update_skills_for_game(game, opening_skill_table)
-                                   
-        if ind == args.max_games:
-            break
+    def wants_game(self, raw_game):
+        return len(raw_game[DECKS]) >= 2 and len(raw_game[DECKS][1][TURNS]) >= 5
 
-        if ind % commit_after == 0 and ind > 0:
-            start = time.time()
-            #player_skill_table.save()
-            opening_skill_table.save()
-            scanner.save()
-            log.info("Committed calculations to the DB in %5.2fs", time.time() - start)
+    def analyze_game(self, game_obj):
+        update_skills_for_game(game_obj, self.opening_skill_table)
 
-    #player_skill_table.save()
-    opening_skill_table.save()
-    scanner.save()
-    log.info("Ending run: %s", scanner.status_msg())
+    def commit(self):
+        checkpoint = self.scanner.checkpoint()
+        #self.player_skill_table.save(checkpoint)
+        self.opening_skill_table.save(checkpoint)
+        checkpoint.write()
 
 
 def main(args):
     db = utils.get_mongo_database()
+    scan_engine.run_plugins(db, [TrueskillPlugin(db)], args)
 
-    run_trueskill_openings(args, db, log)
 
 if __name__ == '__main__':
     parser = utils.incremental_max_parser()
@@ -0,0 +1,326 @@
+#!/usr/bin/python
+
+""" Run several incremental analyzers over a single scan of the games.
+
+Each analyzer keeps its own IncrementalScanner checkpoint and its own output
+collection, but rather than each one reading db.games and building Game
+objects for itself, ScanEngine reads every game once, builds its Game once,
+and hands it to each analyzer that has not seen it yet.  The scan starts at
+the oldest checkpoint of the analyzers being run, so one that is behind the
+others catches up in the same pass.
+
+Analyzers whose output is a sum over games can also be run by run_parallel(),
+which splits the games into ranges of ingest sequence numbers, analyzes the
+ranges in a pool of processes, and merges the partial results.
+"""
+
+import logging
+import multiprocessing
+import time
+
+from keys import *
+import game
+import incremental_scanner
+import ingest_sequence
+import utils
+
+# Module-level logging instance
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+COMMIT_AFTER = 25000
+
+# run_parallel() makes this many shards per process, so that processes that
+# finish early (the shards don't all cost the same) pick up more work.
+SHARDS_PER_PROCESS = 4
+
+# And makes shards of at most this many games, since each is committed as
+# a whole once it is merged.
+MAX_SHARD_GAMES = COMMIT_AFTER
+
+
+class AnalyzerPlugin(object):
+    """ Base class for the analyzers that ScanEngine runs.
+
+    Subclasses set scan_name, the name of their scanner checkpoint, and
+    implement analyze_game(game_obj), which adds a game.Game to their
+    output, and commit(), which writes that output along with the scanner
+    in a checkpoint (the default writes just the scanner).  Mergeable subclasses also implement partial_result(),
+    which returns the output accumulated so far as primitives, and
+    merge_partial_result(partial), which adds the partial_result() of a
+    plugin in another process into their own output.
+    """
+    scan_name = None
+
+    # The fields of the game documents that the plugin reads, as a list for
+    # a projection, or None for all of them.  Game() needs game.GAME_FIELDS,
+    # less any the plugin's use of it never reads.
+    fields = None
+
+    # Set by plugins whose output is a sum over games, which implement
+    # partial_result() and merge_partial_result() for run_parallel().
+    mergeable = False
+
+    # The sequence number of the last game the plugin analyzes, or None for
+    # all of them.  Games after it don't count as scanned.
+    last_seq = None
+
+    def __init__(self, db):
+        self.db = db
+        self.scanner = incremental_scanner.IncrementalScanner(self.scan_name,
+                                                              db)
+
+    def init_args(self):
+        """ Return the arguments after db that make a copy of this plugin,
+        for run_parallel()'s pool processes. """
+        return ()
+
+    def reset(self):
+        """ Forget everything analyzed so far, for a full rebuild. """
+        self.scanner.reset()
+
+    def start(self):
+        """ Called once before the scan, e.g. to load existing output. """
+        pass
+
+    def wants_game(self, raw_game):
+        """ Return False for games that count as scanned but that the
+        analyzer skips."""
+        return True
+
+    def commit(self):
+        """ Write the output accumulated so far, then the scanner. """
+        self.scanner.checkpoint().write()
+
+    def finish(self):
+        """ Called once after the scan. """
+        self.commit()
+
+
+def scan_fields(plugins):
+    """ Return the projection that has the fields every plugin reads. """
+    if any(plugin.fields is None for plugin in plugins):
+        return None
+    fields = set()
+    for plugin in plugins:
+        fields.update(plugin.fields)
+    fields.add(INGEST_SEQ)
+    # Leave out fields inside other fields, which MongoDB won't accept.
+    return sorted(field for field in fields
+                  if not any(field.startswith(other + '.')
+                             for other in fields))
+
+
+def scan_max_seq(db, plugins):
+    """ Return the sequence number that a scan for plugins goes up to, or
+    None if it goes to the end: the last settled one in db, or the last
+    that any of the plugins analyzes if that is lower. """
+    limits = [ingest_sequence.settled_seq(db)]
+    if all(plugin.last_seq is not None for plugin in plugins):
+        limits.append(max(plugin.last_seq for plugin in plugins))
+    limits = [limit for limit in limits if limit is not None]
+    return min(limits) if limits else None
+
+
+def find_games(games_col, query, plugins):
+    """ Return a cursor over the games matching query, with only the fields
+    plugins read, in sequence order so that a commit partway through the
+    scan covers just the games before it. """
+    return games_col.find(query, scan_fields(plugins)).sort(
+        INGEST_SEQ, 1).batch_size(incremental_scanner.SCAN_BATCH_SIZE)
+
+
+def feed_game(starts, raw_game):
+    """ Pass raw_game to each plugin in the (plugin, starting sequence
+    number) list starts that has not seen it, building its Game at most
+    once. """
+    game_obj = None
+    seq = raw_game[INGEST_SEQ]
+    for plugin, start_seq in starts:
+        if seq <= start_seq or (plugin.last_seq is not None and
+                                seq > plugin.last_seq):
+            continue
+        plugin.scanner.record(raw_game['_id'], seq)
+        if not plugin.wants_game(raw_game):
+            continue
+        if game_obj is None:
+            game_obj = game.Game(raw_game)
+        try:
+            plugin.analyze_game(game_obj)
+        except:
+            log.exception('Exception occurred in %s for %s',
+                          plugin.scan_name, game_obj.isotropic_url())
+            raise
+
+
+class ScanEngine(object):
+    def __init__(self, games_col, plugins, commit_after=COMMIT_AFTER):
+        self.games_col = games_col
+        self.plugins = plugins
+        self.commit_after = commit_after
+
+    def run(self, max_games=-1):
+        """ Feed the games none of the plugins have seen to them, then
+        finish each plugin.  Stops after max_games games if it is not -1.
+        """
+        # Take each plugin's starting point before the scan moves it, since
+        # the plugins that are ahead skip the games before it.
+        starts = [(plugin, plugin.scanner.get_max_seq())
+                  for plugin in self.plugins]
+        for plugin in self.plugins:
+            log.info("Starting %s: %s", plugin.scan_name,
+                     plugin.scanner.status_msg())
+            plugin.start()
+
+        min_seq = min(start_seq for _, start_seq in starts)
+        max_seq = scan_max_seq(self.plugins[0].db, self.plugins)
+        raw_games = find_games(
+            self.games_col,
+            {INGEST_SEQ: incremental_scanner.seq_range(min_seq, max_seq)},
+            self.plugins)
+        for ind, raw_game in enumerate(utils.progress_meter(raw_games)):
+            if ind == max_games:
+                log.info("Reached max_games of %d", max_games)
+                break
+
+            feed_game(starts, raw_game)
+
+            if ind % self.commit_after == 0 and ind > 0:
+                start = time.time()
+                for plugin in self.plugins:
+                    plugin.commit()
+                log.info("Committed calculations to the DB in %5.2fs",
+                         time.time() - start)
+
+        for plugin in self.plugins:
+            plugin.finish()
+            log.info("Ending %s: %s", plugin.scan_name,
+                     plugin.scanner.status_msg())
+
+
+def shard_bounds(games_col, num_shards, min_seq=0, max_seq=None,
+                 max_shard_games=None):
+    """ Return a list of sequence numbers bounds that splits the games after
+    min_seq, up to max_seq unless it is None, into the ranges (bounds[i],
+    bounds[i + 1]], which have about the same number of games.  There are at
+    most num_shards ranges, or more if that is what it takes to keep them
+    to max_shard_games games. """
+    query = {INGEST_SEQ: incremental_scanner.seq_range(min_seq, max_seq)}
+    num_games = games_col.find(query).count()
+    if max_shard_games:
+        num_shards = max(num_shards, -(-num_games // max_shard_games))
+    last_in_shards = set(num_games * shard // num_shards - 1
+                         for shard in range(1, num_shards + 1))
+    bounds = [min_seq]
+    if not num_games:
+        return bounds
+    for ind, doc in enumerate(games_col.find(query, [INGEST_SEQ]).sort(
+            INGEST_SEQ, 1).batch_size(incremental_scanner.SCAN_BATCH_SIZE)):
+        if ind in last_in_shards and doc[INGEST_SEQ] > bounds[-1]:
+            bounds.append(doc[INGEST_SEQ])
+        if ind == num_games - 1:
+            break
+    return bounds
+
+
+def analyze_shard(shard):
+    """ Run plugins over the games in one range, in a pool process.
+
+    shard is a tuple of the function that connects to the database, a list
+    of (plugin class, init_args(), starting sequence number) and the range's
+    bounds.
+    Returns a list of (games counted, max _id, max sequence number, partial
+    result) per plugin.
+    """
+    connect, plugin_starts, min_seq, max_seq = shard
+    db = connect()
+    starts = [(plugin_class(db, *init_args), start_seq)
+              for plugin_class, init_args, start_seq in plugin_starts]
+    counts_before = [plugin.scanner.get_num_games() for plugin, _ in starts]
+    for raw_game in find_games(db.games,
+                               {INGEST_SEQ: {'$gt': min_seq, '$lte': max_seq}},
+                               [plugin for plugin, _ in starts]):
+        feed_game(starts, raw_game)
+    return [(plugin.scanner.get_num_games() - count_before,
+             plugin.scanner.get_max_game_id(), plugin.scanner.get_max_seq(),
+             plugin.partial_result())
+            for (plugin, _), count_before in zip(starts, counts_before)]
+
+
+def run_parallel(db, plugins, processes, connect=utils.get_mongo_database):
+    """ Like ScanEngine(db.games, plugins).run(), but analyze ranges of the
+    games in a pool of processes and merge their results.
+
+    Every plugin must be mergeable.  The ranges are merged in order, and
+    the plugins commit after each one, so that a crash only loses the
+    ranges not yet merged.  connect is called in each pool process to get
+    its own connection to db.
+    """
+    assert all(plugin.mergeable for plugin in plugins)
+    starts = [(plugin, plugin.scanner.get_max_seq())
+              for plugin in plugins]
+    for plugin in plugins:
+        log.info("Starting %s: %s", plugin.scan_name,
+                 plugin.scanner.status_msg())
+        plugin.start()
+
+    min_seq = min(start_seq for _, start_seq in starts)
+    bounds = shard_bounds(db.games, processes * SHARDS_PER_PROCESS, min_seq,
+                          scan_max_seq(db, plugins), MAX_SHARD_GAMES)
+    plugin_starts = [(type(plugin), plugin.init_args(), start_seq)
+                     for plugin, start_seq in starts]
+    shards = [(connect, plugin_starts, shard_min, shard_max)
+              for shard_min, shard_max in zip(bounds, bounds[1:])]
+    log.info("Analyzing %d ranges of games in %d processes", len(shards),
+             processes)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for ind, results in enumerate(pool.imap(analyze_shard, shards)):
+            for plugin, (num_games, max_game_id, max_seq, partial) in zip(
+                plugins, results):
+                plugin.merge_partial_result(partial)
+                if num_games:
+                    plugin.scanner.record(max_game_id, max_seq, num_games)
+                plugin.commit()
+            log.info("Merged and committed %d of %d ranges", ind + 1,
+                     len(shards))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    for plugin in plugins:
+        plugin.finish()
+        log.info("Ending %s: %s", plugin.scan_name,
+                 plugin.scanner.status_msg())
+
+
+def run_plugins(db, plugins, args, processes=1, games_col=None):
+    """ Run plugins over db.games, or over games_col if it is given, as
+    directed by the command line args of utils.incremental_max_parser().
+
+    With more than one process, the mergeable plugins are run by
+    run_parallel() and the others by a ScanEngine afterwards.  The pool
+    processes read db.games, so games_col is always scanned in this one.
+    """
+    if not args.incremental:
+        for plugin in plugins:
+            log.warning('resetting scanner and db for %s', plugin.scan_name)
+            plugin.reset()
+
+    if processes > 1 and args.max_games < 0 and games_col is None:
+        parallel = [plugin for plugin in plugins if plugin.mergeable]
+        plugins = [plugin for plugin in plugins if not plugin.mergeable]
+        if parallel:
+            run_parallel(db, parallel, processes)
+    if plugins:
+        ScanEngine(games_col or db.games, plugins).run(args.max_games)
+
+
+def add_processes_argument(parser):
+    parser.add_argument('--processes', default=1, type=int,
+                        help='number of processes for the analyzers that '
+                        'can be run in parallel')
@@ -24,12 +24,31 @@ class SmallGainStat(ListSlotPrimitiveConversion):
                                          self.win_given_no_gain,
                                          self.win_weighted_gain)
 
+    def to_flat_dict(self):
+        """ Return a dict of the numbers in this stat, keyed by FLAT_FIELDS,
+        which MongoDB can $inc field by field. """
+        ret = {}
+        for name in self.__slots__:
+            mvs = getattr(self, name)
+            for member in MeanVarStat.__slots__:
+                ret[name + '_' + member] = getattr(mvs, member)
+        return ret
+
+    def from_flat_dict(self, flat_dict):
+        for name in self.__slots__:
+            mvs = getattr(self, name)
+            for member in MeanVarStat.__slots__:
+                setattr(mvs, member, flat_dict.get(name + '_' + member, 0))
+
     def to_readable_primitive_object(self):
         ret = {}
         for name in self.__slots__:
             ret[name] = getattr(self, name).to_primitive_object()
         return ret
 
+FLAT_FIELDS = [name + '_' + member for name in SmallGainStat.__slots__
+               for member in MeanVarStat.__slots__]
+
 def from_raw_stats_dict(raw_stats_dict):
     ret = SmallGainStat()
     ret.win_given_any_gain = raw_stats_dict['win_given_any_gain']
@@ -7,10 +7,16 @@ The MeanVarStat keeps a running total of frequence, mean, and variance of
 a random variable.
 
 DiffStat supports finding the difference between two MeanVarStat objects.
+
+MeanVarStatTable keeps many MeanVarStats in one NumPy array, as frequency,
+mean and sum of squared deviations from the mean (M2), so that outcomes can
+be added to them in batches.
 """
 
 import math
 
+import numpy
+
 import primitive_util
 import mergeable
 
@@ -125,3 +131,114 @@ class DiffStat(object):
     def mean_diff(self, o):
         return DiffStat(self, o)
 
+
+MEAN_VAR_DTYPE = numpy.dtype([('freq', numpy.float64),
+                              ('mean', numpy.float64),
+                              ('m2', numpy.float64)])
+
+class MeanVarStatTable(object):
+    """ A fixed number of MeanVarStats, indexed by row, in a structured
+    array of (freq, mean, m2).
+
+    Unlike sum_sq, m2 doesn't grow with the square of the mean, so the
+    variance doesn't lose its precision to cancellation once the counts
+    get large.  Batches are combined into the rows with the pairwise
+    update of Chan et al., the batch form of Welford's method.
+    """
+
+    def __init__(self, size):
+        self.rows = numpy.zeros(size, dtype=MEAN_VAR_DTYPE)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add_outcomes(self, rows, vals, freqs=None):
+        """ Add outcome vals[i] to the stat of row rows[i], freqs[i] times
+        (once by default), for each i. """
+        rows = numpy.asarray(rows, dtype=numpy.intp)
+        vals = numpy.asarray(vals, dtype=numpy.float64)
+        if freqs is None:
+            freqs = numpy.ones(len(vals))
+        else:
+            freqs = numpy.asarray(freqs, dtype=numpy.float64)
+        size = len(self.rows)
+        freq = numpy.bincount(rows, weights=freqs, minlength=size)
+        mean = _safe_divide(
+            numpy.bincount(rows, weights=vals * freqs, minlength=size), freq)
+        m2 = numpy.bincount(rows, weights=freqs * (vals - mean[rows]) ** 2,
+                            minlength=size)
+        self._combine(freq, mean, m2)
+
+    def merge(self, other):
+        """ Add the outcomes of the rows of other to the same rows here. """
+        assert len(other) == len(self), '%d != %d' % (len(other), len(self))
+        self._combine(other.rows['freq'], other.rows['mean'],
+                      other.rows['m2'])
+
+    def _combine(self, freq_b, mean_b, m2_b):
+        freq_a = self.rows['freq']
+        mean_a = self.rows['mean']
+        freq = freq_a + freq_b
+        delta = mean_b - mean_a
+        self.rows['mean'] = mean_a + _safe_divide(delta * freq_b, freq)
+        self.rows['m2'] += m2_b + _safe_divide(delta * delta * freq_a * freq_b,
+                                               freq)
+        self.rows['freq'] = freq
+
+    def frequency(self):
+        return self.rows['freq'].copy()
+
+    def mean(self):
+        """ The means of the rows, inf for the empty ones. """
+        freq = self.rows['freq']
+        return numpy.where(freq > 0, self.rows['mean'], float('inf'))
+
+    def variance(self):
+        """ The variances of the rows, inf for those with less than two
+        outcomes. """
+        freq = self.rows['freq']
+        return numpy.where(freq > 1,
+                           self.rows['m2'] / numpy.maximum(freq - 1, 1),
+                           float('inf'))
+
+    def stat(self, ind):
+        """ Return the MeanVarStat of row ind. """
+        freq, mean, m2 = [float(val) for val in self.rows[ind]]
+        return MeanVarStat(_int_if_whole(freq), mean * freq,
+                           m2 + freq * mean * mean)
+
+    def set_stat(self, ind, mvs):
+        """ Set row ind to the outcomes of the MeanVarStat mvs. """
+        freq = float(mvs.freq)
+        if freq:
+            mean = mvs.sum / freq
+            m2 = max(mvs.sum_sq - mvs.sum * mean, 0.)
+        else:
+            mean = m2 = 0.
+        self.rows[ind] = (freq, mean, m2)
+
+    def to_stat_lists(self):
+        """ Return the rows in the list serialization of MeanVarStat. """
+        return [self.stat(ind).to_primitive_object()
+                for ind in xrange(len(self.rows))]
+
+    @staticmethod
+    def from_stat_lists(stat_lists):
+        """ Return a table of MeanVarStats in their list serialization. """
+        table = MeanVarStatTable(len(stat_lists))
+        for ind, stat_list in enumerate(stat_lists):
+            mvs = MeanVarStat()
+            mvs.from_primitive_object(stat_list)
+            table.set_stat(ind, mvs)
+        return table
+
+
+def _safe_divide(num, denom):
+    """ num / denom elementwise, with 0 where denom is 0. """
+    return num / numpy.where(denom == 0, 1, denom)
+
+
+def _int_if_whole(val):
+    if val == int(val):
+        return int(val)
+    return val
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+try:
+    import unittest2 as unittest
+except ImportError, e:
+    import unittest
+
+import os.path
+import shutil
+import tempfile
+
+import analyze
+import dominioncards
+import fake_mongo
+import game
+import incremental_scanner
+import scan_engine
+import test_scan_engine
+import utils
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.db = fake_mongo.FakeDatabase()
+        self.db.games.docs = test_scan_engine.parsed_test_games()
+        self.games = [game.Game(g) for g in self.db.games.docs]
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def plugin(self):
+        plugin = analyze.AnalysisPlugin(self.db)
+        plugin.output_file_name = os.path.join(self.output_dir, 'stats.js')
+        return plugin
+
+    def test_card_round_trip(self):
+        analysis = analyze.GamesAnalysis()
+        for game_obj in self.games:
+            analysis.analyze_game(game_obj)
+        for card_stat in analysis.card_stats.values():
+            returned = analyze.CardStatistic()
+            returned.from_snapshot(card_stat.to_snapshot())
+            self.assertEquals(returned.to_primitive_object(),
+                              card_stat.to_primitive_object())
+
+    def test_commit_writes_changed_cards(self):
+        plugin = self.plugin()
+        plugin.start()
+        plugin.scanner.record(self.games[0].get_id(), 1)
+        plugin.analyze_game(self.games[0])
+        plugin.commit()
+        first_game_cards = set(self.db.analysis.ids())
+
+        applied = []
+        real_apply_ops = incremental_scanner.apply_ops
+        def recording_apply_ops(db, version, ops, recovering=False):
+            applied.extend(op['key'] for op in ops)
+            real_apply_ops(db, version, ops, recovering)
+        incremental_scanner.apply_ops = recording_apply_ops
+        try:
+            plugin.scanner.record(self.games[1].get_id(), 2)
+            plugin.analyze_game(self.games[1])
+            plugin.commit()
+        finally:
+            incremental_scanner.apply_ops = real_apply_ops
+
+        second_game_cards = set(
+            str(card) for card in self.games[1].get_supply() +
+            dominioncards.EVERY_SET_CARDS)
+        self.assertTrue(second_game_cards <= set(applied))
+        self.assertTrue(first_game_cards - set(applied))
+
+        # The snapshot reads back as the whole analysis.
+        reread = analyze.GamesAnalysis()
+        reread.read_snapshot(self.db.analysis)
+        self.assertEquals(reread.to_primitive_object(),
+                          plugin.game_analysis.to_primitive_object())
+        self.assertEquals(reread.num_games, 2)
+
+    def test_partial_read(self):
+        plugin = self.plugin()
+        scan_engine.ScanEngine(self.db.games, [plugin]).run()
+        cards = [dominioncards.Gold, dominioncards.Curse]
+        partial = analyze.GamesAnalysis()
+        partial.read_snapshot(self.db.analysis, cards)
+        self.assertEquals(set(partial.card_stats), set(cards))
+        for card in cards:
+            self.assertEquals(
+                partial.card_stats[card].to_primitive_object(),
+                plugin.game_analysis.card_stats[card].to_primitive_object())
+
+    def test_converts_whole_document(self):
+        old = analyze.GamesAnalysis()
+        old.analyze_game(self.games[0])
+        utils.write_object_to_db(old, self.db.analysis, '')
+
+        plugin = self.plugin()
+        plugin.start()
+        plugin.commit()
+        reread = analyze.GamesAnalysis()
+        reread.read_snapshot(self.db.analysis)
+        self.assertEquals(reread.to_primitive_object()['card_stats'],
+                          old.to_primitive_object()['card_stats'])
+        self.assertFalse('card_stats' in self.db.analysis.find_one({'_id': ''}))
+
+
+if __name__ == '__main__':
+    unittest.main()
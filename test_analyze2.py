@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+try:
+    import unittest2 as unittest
+except ImportError, e:
+    import unittest
+
+import analysis_util
+import analyze2
+import fake_mongo
+import game
+import small_gain_stat
+import test_scan_engine
+
+
+def test_games():
+    return [game.Game(g) for g in test_scan_engine.parsed_test_games()]
+
+
+class SmallGainStatTest(unittest.TestCase):
+    def test_flat_dict_round_trip(self):
+        stat = small_gain_stat.SmallGainStat()
+        stat.win_given_any_gain.add_outcome(2)
+        stat.win_weighted_gain.add_many_outcomes(0.5, 3)
+        flat = stat.to_flat_dict()
+        self.assertEquals(sorted(flat), sorted(small_gain_stat.FLAT_FIELDS))
+
+        restored = small_gain_stat.SmallGainStat()
+        restored.from_flat_dict(flat)
+        self.assertEquals(restored.to_primitive_object(),
+                          stat.to_primitive_object())
+
+
+class UpdateDbTest(unittest.TestCase):
+    def test_increments_match_one_update(self):
+        games = test_games()
+        whole_db = fake_mongo.FakeDatabase()
+        accumulator = analyze2.EventAccumulator()
+        analyze2.accumulate_card_stats(games, accumulator)
+        accumulator.update_db(whole_db)
+
+        parts_db = fake_mongo.FakeDatabase()
+        for part in [games[:1], games[1:]]:
+            accumulator = analyze2.EventAccumulator()
+            analyze2.accumulate_card_stats(part, accumulator)
+            accumulator.update_db(parts_db)
+
+        for name, _ in analyze2.event_detectors:
+            self.assertTrue(whole_db[name].docs)
+            self.assertEquals(parts_db[name].num_bulk_writes, 2)
+            self.assertEquals(sorted(whole_db[name].docs),
+                              sorted(parts_db[name].docs))
+
+    def test_card_supply_matches_event_stats(self):
+        # Accumulate the card_supply events the way the other events are,
+        # one SmallGainStat per key.
+        expected = analyze2.EventAccumulator()
+        for game_obj in test_games():
+            events = analyze2.detect_events(game_obj, analyze2.event_detectors)
+            per_player_accum = game_obj.cards_gained_per_player()[game.BOUGHT]
+            for player, accum_dict in per_player_accum.iteritems():
+                win_points = game_obj.get_player_deck(player).WinPoints()
+                for card in analysis_util.available_cards(game_obj,
+                                                          accum_dict.keys()):
+                    count = accum_dict.get(card, 0)
+                    stat = small_gain_stat.SmallGainStat()
+                    if count:
+                        stat.win_given_any_gain.add_outcome(win_points)
+                    else:
+                        stat.win_given_no_gain.add_outcome(win_points)
+                    stat.win_weighted_gain.add_many_outcomes(win_points, count)
+                    expected.merge_stats(events, str(card.index), stat)
+
+        db = fake_mongo.FakeDatabase()
+        accumulator = analyze2.EventAccumulator()
+        analyze2.accumulate_card_stats(test_games(), accumulator)
+        accumulator.update_db(db)
+
+        expected_stats = expected.event_stats['card_supply']
+        self.assertTrue(expected_stats)
+        self.assertEquals(
+            sorted(doc['_id'] for doc in db.card_supply.docs),
+            sorted(expected_stats))
+        for doc in db.card_supply.docs:
+            stored = small_gain_stat.SmallGainStat()
+            stored.from_flat_dict(doc)
+            self.assertEquals(stored.to_primitive_object(),
+                              expected_stats[doc['_id']].to_primitive_object())
+
+    def test_partial_results_merge(self):
+        games = test_games()
+        whole = analyze2.EventAccumulator()
+        analyze2.accumulate_card_stats(games, whole)
+
+        merged = analyze2.EventAccumulator()
+        for part in [games[:2], games[2:]]:
+            accumulator = analyze2.EventAccumulator()
+            analyze2.accumulate_card_stats(part, accumulator)
+            merged.merge_partial_result(accumulator.partial_result())
+
+        self.assertTrue((merged.card_supply.stats ==
+                         whole.card_supply.stats).all())
+        self.assertEquals(merged.partial_result()['events'],
+                          whole.partial_result()['events'])
+
+    def test_old_layout_needs_rebuild(self):
+        db = fake_mongo.FakeDatabase()
+        analyze2.check_layout(db)
+        db.month.save({'_id': '1;201010', 'vals': [0] * 9})
+        self.assertRaises(analyze2.OldLayoutError, analyze2.check_layout, db)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+try:
+    import unittest2 as unittest
+except ImportError, e:
+    import unittest
+
+from keys import *
+import count_plays
+import dominioncards
+import fake_mongo
+import incremental_scanner
+import test_scan_engine
+
+
+def count_test_games(max_pending):
+    db = fake_mongo.FakeDatabase()
+    db.games.docs = test_scan_engine.parsed_test_games()
+    scanner = incremental_scanner.IncrementalScanner('count_plays', db)
+    counter = count_plays.PlayCounter(db.plays, scanner, max_pending)
+    count_plays.analyze_plays(scanner, db.games, counter)
+    return db, scanner, counter
+
+
+class PlayCounterTest(unittest.TestCase):
+    def test_repeated_combos(self):
+        db = fake_mongo.FakeDatabase()
+        scanner = incremental_scanner.IncrementalScanner('count_plays', db)
+        counter = count_plays.PlayCounter(db.plays, scanner)
+        festival = dominioncards.Festival.index
+        smithy = dominioncards.Smithy.index
+        deck = {WIN_POINTS: 1.0, POINTS: 30,
+                TURNS: [{PLAYS: [festival, smithy, festival, smithy,
+                                 dominioncards.Copper.index], MONEY: 5},
+                        {PLAYS: [festival, smithy, smithy]}]}
+        count_plays.analyze_deck(deck, counter)
+        self.assertEquals(counter.pending, {
+                ('Festival',): [3, 3.0, 90, 10],
+                ('Smithy',): [4, 4.0, 120, 10],
+                ('Festival', 'Smithy'): [3, 3.0, 90, 10]})
+
+        counter.flush()
+        self.assertEquals(counter.pending, {})
+        combo = db.plays.find_one({'key': 'Festival+Smithy'})
+        self.assertEquals(combo['cards'], ['Festival', 'Smithy'])
+        self.assertEquals(combo['ncards'], 2)
+        self.assertEquals(combo['freq'], 3)
+        self.assertEquals(combo['money'], 10)
+
+    def test_flushing_keeps_totals(self):
+        whole_db, _, whole_counter = count_test_games(10 ** 6)
+        table = whole_counter.pending
+        whole_counter.flush()
+
+        capped_db, scanner, capped_counter = count_test_games(1)
+        capped_counter.flush()
+        self.assertEquals(capped_counter.num_flushes,
+                          len(fake_mongo.TEST_GAME_IDS))
+        saved = incremental_scanner.IncrementalScanner('count_plays',
+                                                       capped_db)
+        self.assertEquals(saved.get_num_games(), len(fake_mongo.TEST_GAME_IDS))
+
+        self.assertTrue(table)
+        self.assertEquals(count_plays.load_table(capped_db.plays), table)
+        self.assertEquals(count_plays.load_table(whole_db.plays), table)
+
+    def test_compute_all_stats(self):
+        db, _, counter = count_test_games(10 ** 6)
+        table = counter.pending
+        counter.flush()
+        count_plays.compute_all_stats(db.plays, table)
+
+        total_singles = float(sum(counts[0] for cards, counts
+                                  in table.iteritems() if len(cards) == 1))
+        for combo in db.plays.docs:
+            freq = float(combo['freq'])
+            self.assertEquals(combo['win_rate'], combo['win_points'] / freq)
+            self.assertEquals(combo['money_rate'], combo['money'] / freq)
+            self.assertEquals(combo['combo_score'],
+                              combo['interestingness'] * combo['win_rate'])
+            if combo['ncards'] == 1:
+                self.assertEquals(combo['rate'], freq / total_singles)
+                self.assertEquals(combo['interestingness'], combo['rate'])
+
+
+if __name__ == '__main__':
+    unittest.main()
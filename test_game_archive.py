@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+try:
+    import unittest2 as unittest
+except ImportError, e:
+    import unittest
+
+import shutil
+import tempfile
+
+import numpy
+
+from keys import *
+import count_buys
+import fake_mongo
+import game_archive
+import scan_engine
+import test_scan_engine
+
+
+class GameArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db = fake_mongo.FakeDatabase()
+        self.db.games.docs = test_scan_engine.parsed_test_games()
+        self.assertEquals(game_archive.export_games(self.db.games, self.path),
+                          len(fake_mongo.TEST_GAME_IDS))
+        self.view = game_archive.GameView(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_round_trip(self):
+        self.assertEquals(len(self.view), len(fake_mongo.TEST_GAME_IDS))
+        self.assertEquals(list(self.view.find()),
+                          test_scan_engine.parsed_test_games())
+
+    def test_find_seq_range(self):
+        ids = fake_mongo.TEST_GAME_IDS
+        self.assertEquals(
+            [g['_id'] for g in self.view.find({INGEST_SEQ: {'$gt': 1,
+                                                            '$lte': 3}})],
+            ids[1:3])
+        self.assertEquals(list(self.view.find({INGEST_SEQ: {'$gt': 4}})), [])
+
+    def test_columns(self):
+        buys = numpy.bincount(self.view.column('turn_buys'))
+        expected = numpy.zeros(len(buys), dtype=int)
+        for game_dict in self.db.games.docs:
+            for deck in game_dict[DECKS]:
+                for turn in deck[TURNS]:
+                    for card in turn.get(BUYS, []):
+                        expected[card] += 1
+        self.assertEquals(buys.tolist(), expected.tolist())
+
+    def test_scan_matches_database(self):
+        scan_engine.ScanEngine(self.db.games, [
+                count_buys.BuyStatsPlugin(self.db)]).run()
+        archive_db = fake_mongo.FakeDatabase()
+        scan_engine.ScanEngine(self.view, [
+                count_buys.BuyStatsPlugin(archive_db)]).run()
+        for name in [count_buys.BUYS_COL_NAME, 'scanner']:
+            self.assertEquals(archive_db[name].docs, self.db[name].docs)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,9 +3,17 @@
 import codecs
 import unittest
 
+from keys import *
+import backfill_goals
+import fake_mongo
 import game
+import goal_stats
 import goals
+import incremental_scanner
+import ingest_sequence
 import parse_game
+import scan_engine
+import test_scan_engine
 
 
 def goals_for(game_id, player=None, goal_name=None):
@@ -116,5 +124,208 @@ class GoalTest(unittest.TestCase):
                                'TriplePileDriver')
 
 
+class GoalSummaryTest(unittest.TestCase):
+    def test_matches_game(self):
+        test_game = game.Game(parse_game.parse_game(codecs.open(
+                    'testing/testdata/game-20130111-164348-84fd128e.html',
+                    encoding='utf-8').read()))
+        summary = goals.goal_summary(test_game)
+        self.assertTrue(goals.goal_summary(test_game) is summary)
+
+        gained_per_player = test_game.cards_gained_per_player()
+        self.assertEquals(summary.bought, gained_per_player[game.BOUGHT])
+        self.assertEquals(summary.gained, gained_per_player[game.GAINED])
+        self.assertEquals(len(summary.turns), len(test_game.get_turns()))
+
+        # The first player's score changes add up from the starting three
+        # Estates to their final score.
+        for state in test_game.game_state_iterator():
+            pass
+        self.assertEquals(
+            3 + sum(summary.vp_gains[0]),
+            state.player_score(test_game.all_player_names()[0]))
+
+
+class CalculateGoalsTest(unittest.TestCase):
+    def setUp(self):
+        self.db = fake_mongo.FakeDatabase()
+        self.games = test_scan_engine.parsed_test_games()
+        self.real_batch_size = goals.GOALS_BATCH_SIZE
+        goals.GOALS_BATCH_SIZE = 3
+
+    def tearDown(self):
+        goals.GOALS_BATCH_SIZE = self.real_batch_size
+
+    def expected_goals(self, game_dict, goal_names=None):
+        return goals.check_goals(game.Game(game_dict), goal_names)
+
+    def test_writes_goals_in_batches(self):
+        self.assertEquals(goals.calculate_goals(
+                self.games, self.db.goals, self.db.goals_error, '20130111'),
+                          len(self.games))
+        self.assertEquals(self.db.goals.num_bulk_writes, 2)
+        stored = self.db.goals.index('_id')
+        for game_dict in self.games:
+            self.assertEquals(stored[game_dict['_id']]['goals'],
+                              self.expected_goals(game_dict))
+
+    def test_rechecks_named_goals(self):
+        game_dict = self.games[-1]
+        other_goal = {'player': 'x', 'reason': 'y', 'goal_name': 'Other'}
+        stale_goal = {'player': 'x', 'reason': 'y',
+                      'goal_name': 'PurplePileDriver'}
+        self.db.goals.save({'_id': game_dict['_id'],
+                            'goals': [other_goal, stale_goal]})
+        goals.calculate_goals([game_dict], self.db.goals, self.db.goals_error,
+                              '20130111', ['PurplePileDriver'])
+        self.assertEquals(
+            self.db.goals.find_one({'_id': game_dict['_id']})['goals'],
+            [other_goal] + self.expected_goals(game_dict,
+                                               ['PurplePileDriver']))
+
+
+class BackfillGoalsTest(unittest.TestCase):
+    def setUp(self):
+        self.db = test_scan_engine.PARALLEL_DB
+        self.db.collections.clear()
+        self.games = test_scan_engine.parsed_test_games()
+        self.db.games.docs = self.games
+        self.other_goal = {'player': 'x', 'reason': 'y', 'goal_name': 'Other'}
+        for game_dict in self.games:
+            self.db.goals.save({'_id': game_dict['_id'],
+                                'goals': [self.other_goal]})
+        self.goal_names = ['DoublePileDriver', 'PurplePileDriver']
+
+    def plugin(self, last_seq):
+        return backfill_goals.GoalBackfillPlugin(self.db, self.goal_names,
+                                                 last_seq)
+
+    def assertBackfilled(self, last_seq):
+        for game_dict in self.games:
+            expected = [self.other_goal]
+            if game_dict[INGEST_SEQ] <= last_seq:
+                expected += goals.check_goals(game.Game(game_dict),
+                                              self.goal_names)
+            self.assertEquals(
+                self.db.goals.find_one({'_id': game_dict['_id']})['goals'],
+                expected)
+
+    def test_backfills_in_parallel(self):
+        scan_engine.run_parallel(
+            self.db, [self.plugin(4)], 2,
+            connect=test_scan_engine.connect_parallel_db)
+        self.assertBackfilled(4)
+        self.assertEquals(self.db.scanner.find_one(
+                {'_id': self.plugin(4).scan_name})['max_seq'], 4)
+
+    def test_checkpoints_each_range_up_to_last_seq(self):
+        plugin = self.plugin(2)
+        committed = []
+        real_commit = plugin.commit
+        def recording_commit():
+            real_commit()
+            committed.append(self.db.scanner.find_one(
+                    {'_id': plugin.scan_name})['max_seq'])
+        plugin.commit = recording_commit
+        scan_engine.run_parallel(
+            self.db, [plugin], 2,
+            connect=test_scan_engine.connect_parallel_db)
+        self.assertBackfilled(2)
+        self.assertEquals(committed, [1, 2, 2])
+        self.assertEquals(plugin.scanner.get_num_games(), 2)
+
+    def test_writes_only_goals_found(self):
+        scan_engine.ScanEngine(self.db.games, [self.plugin(3)]).run()
+        self.assertBackfilled(3)
+
+        # Running again over the same games doesn't add their goals twice.
+        plugin = self.plugin(4)
+        plugin.scanner.reset()
+        scan_engine.ScanEngine(self.db.games, [plugin]).run()
+        self.assertBackfilled(4)
+        self.assertEquals(plugin.num_found, 2)
+
+
+class GoalStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.db = fake_mongo.FakeDatabase()
+        self.games = test_scan_engine.parsed_test_games()
+        goals.calculate_goals(self.games[:3], self.db.goals,
+                              self.db.goals_error, '20130111')
+        self.db.goals.save({'_id': 'shared', 'goals': [
+                    {'player': 'a', 'reason': 'y', 'goal_name': 'Shared'},
+                    {'player': 'b', 'reason': 'y', 'goal_name': 'Shared'}]})
+
+    def assertCounted(self):
+        """ Check the goal stats against a count of every goal document. """
+        pcounts = dict((goal_name, {}) for goal_name in goals.goal_check_funcs)
+        for goal_doc in self.db.goals.docs:
+            for goal_name, player in goal_stats.counted_goals(goal_doc):
+                pcount = pcounts.setdefault(goal_name, {})
+                pcount[player] = pcount.get(player, 0) + 1
+        self.assertEquals(
+            dict((doc['_id'], (doc['count'], doc['top']))
+                 for doc in self.db.goal_stats.docs),
+            dict((goal_name, (sum(pcount.values()),
+                              goal_stats.top_players(pcount)))
+                 for goal_name, pcount in pcounts.iteritems()))
+
+    def test_counts_first_player_of_each_goal(self):
+        self.assertEquals(
+            goal_stats.counted_goals(self.db.goals.find_one({'_id': 'shared'})),
+            [['Shared', 'a']])
+        self.assertEquals(goal_stats.top_players(
+                {'a': 2, 'b': 5, 'c': 2, 'd': 1, 'e': 0}),
+                          [(['b'], 5), (['a', 'c'], 2)])
+
+    def test_counts_all_goals(self):
+        goal_stats.count_goals(self.db)
+        self.assertCounted()
+        self.assertEquals(
+            self.db.goal_stats.find_one({'_id': 'Shared'})['top'],
+            [(['a'], 1)])
+
+    def test_counts_only_new_documents(self):
+        goal_stats.count_goals(self.db)
+        scanner = incremental_scanner.IncrementalScanner('goal_counts',
+                                                         self.db)
+        self.assertEquals(scanner.get_num_games(), 4)
+
+        # A rechecked game and a new one are counted, and the goals the
+        # rechecked game no longer has are taken back out.
+        self.db.goals.save({'_id': self.games[0]['_id'], 'goals': [
+                    {'player': 'b', 'reason': 'y', 'goal_name': 'Shared'}]})
+        goals.calculate_goals(self.games[3:], self.db.goals,
+                              self.db.goals_error, '20130111')
+        goal_stats.count_goals(self.db)
+        self.assertCounted()
+        scanner = incremental_scanner.IncrementalScanner('goal_counts',
+                                                         self.db)
+        self.assertEquals(scanner.get_num_games(), 6)
+        self.assertEquals(
+            self.db.goal_stats.find_one({'_id': 'Shared'})['top'],
+            [(['a', 'b'], 1)])
+
+        # A goal document written while another writer's numbers are
+        # still open waits for them.
+        open_seq = ingest_sequence.reserve(self.db, 1,
+                                           ingest_sequence.GOALS_SEQUENCE)
+        goals.calculate_goals(self.games[:1], self.db.goals,
+                              self.db.goals_error, '20130111')
+        goal_stats.count_goals(self.db)
+        scanner = incremental_scanner.IncrementalScanner('goal_counts',
+                                                         self.db)
+        self.assertEquals(scanner.get_num_games(), 6)
+        ingest_sequence.release(self.db, open_seq,
+                                ingest_sequence.GOALS_SEQUENCE)
+        goal_stats.count_goals(self.db)
+        self.assertCounted()
+
+        # Counting everything again comes to the same stats.
+        counted = self.db.goal_stats.index('_id')
+        goal_stats.count_goals(self.db, incremental=False)
+        self.assertEquals(self.db.goal_stats.index('_id'), counted)
+
+
 if __name__ == '__main__':
     unittest.main()
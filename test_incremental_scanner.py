@@ -0,0 +1,188 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+try:
+    import unittest2 as unittest
+except ImportError, e:
+    import unittest
+
+from keys import *
+import fake_mongo
+import incremental_scanner
+import ingest_sequence
+
+
+class Crash(Exception):
+    pass
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.db = fake_mongo.FakeDatabase()
+        self.real_apply_ops = incremental_scanner.apply_ops
+
+    def tearDown(self):
+        incremental_scanner.apply_ops = self.real_apply_ops
+
+    def checkpoint(self, scanner, game_id, amount):
+        scanner.record(game_id, int(game_id.split('-')[1]))
+        checkpoint = scanner.checkpoint()
+        for key in ['a', 'b', 'c']:
+            checkpoint.increment(self.db.stats, '_id', key, {'n': amount})
+        checkpoint.replace(self.db.totals, {'_id': '', 'n': amount})
+        return checkpoint
+
+    def crash_applying(self, num_ops):
+        """ Make checkpoints stop after applying num_ops of their writes. """
+        def apply_some(db, version, ops, recovering=False):
+            self.real_apply_ops(db, version, ops[:num_ops], recovering)
+            raise Crash()
+        incremental_scanner.apply_ops = apply_some
+
+    def assertStats(self, values, total):
+        self.assertEquals(
+            dict((doc['_id'], doc['n']) for doc in self.db.stats.docs), values)
+        self.assertEquals(self.db.totals.find_one({'_id': ''})['n'], total)
+
+    def test_write(self):
+        scanner = incremental_scanner.IncrementalScanner('test', self.db)
+        self.checkpoint(scanner, 'game-1', 1).write()
+        self.checkpoint(scanner, 'game-2', 2).write()
+        self.assertStats({'a': 3, 'b': 3, 'c': 3}, 2)
+        self.assertEquals(self.db[incremental_scanner.JOURNAL_COL_NAME].docs,
+                          [])
+
+        saved = incremental_scanner.IncrementalScanner('test', self.db)
+        self.assertEquals(saved.version, 2)
+        self.assertEquals(saved.get_num_games(), 2)
+        self.assertEquals(saved.get_max_game_id(), 'game-2')
+        self.assertEquals(saved.get_max_seq(), 2)
+
+    def test_recovers_half_applied_checkpoint(self):
+        scanner = incremental_scanner.IncrementalScanner('test', self.db)
+        self.checkpoint(scanner, 'game-1', 1).write()
+        self.crash_applying(2)
+        self.assertRaises(Crash, self.checkpoint(scanner, 'game-2', 2).write)
+        self.assertStats({'a': 3, 'b': 3, 'c': 1}, 1)
+
+        # The next scanner finishes the checkpoint, without adding to the
+        # stats it already reached twice.
+        incremental_scanner.apply_ops = self.real_apply_ops
+        recovered = incremental_scanner.IncrementalScanner('test', self.db)
+        self.assertStats({'a': 3, 'b': 3, 'c': 3}, 2)
+        self.assertEquals(recovered.version, 2)
+        self.assertEquals(recovered.get_max_game_id(), 'game-2')
+        self.assertEquals(recovered.get_num_games(), 2)
+        self.assertFalse(self.db.scanner.find_one({'_id': 'test'}).get(
+                'pending'))
+
+    def test_discards_checkpoint_before_scanner_save(self):
+        scanner = incremental_scanner.IncrementalScanner('test', self.db)
+        self.checkpoint(scanner, 'game-1', 1).write()
+        checkpoint = self.checkpoint(scanner, 'game-2', 2)
+        def crash_saving(pending=None):
+            raise Crash()
+        scanner.save = crash_saving
+        self.assertRaises(Crash, checkpoint.write)
+        self.assertTrue(self.db[incremental_scanner.JOURNAL_COL_NAME].docs)
+
+        # The games of the lost checkpoint get scanned again.
+        restarted = incremental_scanner.IncrementalScanner('test', self.db)
+        self.assertEquals(restarted.get_max_game_id(), 'game-1')
+        self.assertStats({'a': 1, 'b': 1, 'c': 1}, 1)
+        self.checkpoint(restarted, 'game-2', 2).write()
+        self.assertStats({'a': 3, 'b': 3, 'c': 3}, 2)
+
+    def test_recovers_added_array_values(self):
+        scanner = incremental_scanner.IncrementalScanner('test', self.db)
+        scanner.record('game-1', 1)
+        checkpoint = scanner.checkpoint()
+        checkpoint.add_to_set(self.db.goals, 'game-1', 'goals', ['a', 'b'])
+        checkpoint.add_to_set(self.db.goals, 'game-2', 'goals', ['c'])
+        self.crash_applying(1)
+        self.assertRaises(Crash, checkpoint.write)
+
+        incremental_scanner.apply_ops = self.real_apply_ops
+        incremental_scanner.IncrementalScanner('test', self.db)
+        self.assertEquals(self.db.goals.docs,
+                          [{'_id': 'game-1', 'goals': ['a', 'b']},
+                           {'_id': 'game-2', 'goals': ['c']}])
+
+
+class ScanTest(unittest.TestCase):
+    def test_scans_in_sequence_order(self):
+        db = fake_mongo.FakeDatabase()
+        db.games.docs = [{'_id': _id, INGEST_SEQ: seq}
+                         for _id, seq in [('c', 3), ('a', 1), ('d', 4),
+                                          ('b', 2)]]
+        scanner = incremental_scanner.IncrementalScanner('test', db)
+        scanned = scanner.scan(db.games, {})
+        self.assertEquals([scanned.next()['_id'], scanned.next()['_id']],
+                          ['a', 'b'])
+        scanner.checkpoint().write()
+
+        # Stopping partway leaves the scanner after just the games scanned.
+        saved = incremental_scanner.IncrementalScanner('test', db)
+        self.assertEquals(saved.get_max_seq(), 2)
+        self.assertEquals([g['_id'] for g in saved.scan(db.games, {})],
+                          ['c', 'd'])
+
+    def test_converts_old_games_and_scanners(self):
+        db = fake_mongo.FakeDatabase()
+        db.games.docs = [{'_id': _id} for _id in ['c', 'a', 'd', 'b']]
+        db.scanner.save({'_id': 'old', 'num_games': 2, 'max_game_id': 'b'})
+        db.scanner.save({'_id': 'new', 'num_games': 0, 'max_game_id': ''})
+        self.assertRaises(incremental_scanner.UnconvertedScannerError,
+                          incremental_scanner.IncrementalScanner, 'old', db)
+
+        self.assertEquals(ingest_sequence.stamp_unsequenced_games(db.games),
+                          4)
+        ingest_sequence.convert_scanners(db, db.games)
+        self.assertEquals(
+            dict((g['_id'], g[INGEST_SEQ]) for g in db.games.docs),
+            {'a': 1, 'b': 2, 'c': 3, 'd': 4})
+        self.assertEquals(
+            incremental_scanner.IncrementalScanner('old', db).get_max_seq(), 2)
+        self.assertEquals(
+            incremental_scanner.IncrementalScanner('new', db).get_max_seq(), 0)
+
+        # Games loaded from now on are numbered after the old ones.
+        new_games = [{'_id': 'e'}, {'_id': 'a'}]
+        ingest_sequence.stamp_games(db.games, new_games)
+        self.assertEquals([g[INGEST_SEQ] for g in new_games], [5, 1])
+
+    def test_scanners_stop_at_unwritten_games(self):
+        db = fake_mongo.FakeDatabase()
+        first = ingest_sequence.reserve(db, 2)
+        second = ingest_sequence.reserve(db, 2)
+        self.assertEquals((first, second), (1, 3))
+
+        # The second writer finishes first.
+        db.games.docs = [{'_id': 'c', INGEST_SEQ: 3},
+                         {'_id': 'd', INGEST_SEQ: 4}]
+        ingest_sequence.release(db, second)
+        self.assertEquals(ingest_sequence.settled_seq(db), 0)
+        scanner = incremental_scanner.IncrementalScanner('test', db)
+        self.assertEquals(list(scanner.scan(db.games, {})), [])
+
+        db.games.docs += [{'_id': 'a', INGEST_SEQ: 1},
+                          {'_id': 'b', INGEST_SEQ: 2}]
+        ingest_sequence.release(db, first)
+        self.assertEquals(ingest_sequence.settled_seq(db), 4)
+        self.assertEquals([g['_id'] for g in scanner.scan(db.games, {})],
+                          ['a', 'b', 'c', 'd'])
+
+    def test_unreleased_reservations_expire(self):
+        db = fake_mongo.FakeDatabase()
+        ingest_sequence.reserve(db, 2)
+        self.assertEquals(ingest_sequence.settled_seq(db), 0)
+        real_timeout = ingest_sequence.RESERVATION_TIMEOUT
+        ingest_sequence.RESERVATION_TIMEOUT = -1
+        try:
+            self.assertEquals(ingest_sequence.settled_seq(db), 2)
+        finally:
+            ingest_sequence.RESERVATION_TIMEOUT = real_timeout
+        self.assertEquals(ingest_sequence.settled_seq(db), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,9 +6,18 @@
 
 from urllib2 import HTTPError
 import datetime
+import hashlib
+import io
 import logging
+import os
+import shutil
+import tarfile
+import tempfile
 import unittest
 
+from fake_mongo import FakeCollection, TEST_GAME_IDS
+from keys import *
+import archive_cache
 import isotropic
 import utils
 
@@ -74,6 +83,250 @@ class IsotropicScraper(unittest.TestCase):
             self.assertEquals(count, 9999, "Inserted expected number of rawgames")
 
 
+# The test games played on 2010-10-15.
+DAY_GAME_IDS = TEST_GAME_IDS[:2]
+
+
+def test_archive():
+    """Return a tar.bz2 archive of the test games, like isotropic's."""
+    contents = io.BytesIO()
+    with tarfile.open(fileobj=contents, mode='w:bz2') as t:
+        for game_id in DAY_GAME_IDS:
+            text = open('testing/testdata/' + game_id, 'rb').read()
+            tarinfo = tarfile.TarInfo(game_id)
+            tarinfo.size = len(text)
+            t.addfile(tarinfo, io.BytesIO(text))
+    contents.seek(0)
+    return contents
+
+
+class LocalArchiveScraper(isotropic.IsotropicScraper):
+    """Scraper that reads its archive from memory instead of S3."""
+
+    def is_rawgames_in_s3(self, date):
+        return True
+
+    def get_rawgames_from_s3_as_filelike(self, date):
+        return test_archive()
+
+
+class IsotropicIngest(unittest.TestCase):
+    def test_scrape_and_ingest_rawgames(self):
+        raw_games_col = FakeCollection()
+        games_col = FakeCollection()
+        parse_error_col = FakeCollection()
+        iso = LocalArchiveScraper({'raw_games': raw_games_col})
+
+        count = iso.scrape_and_ingest_rawgames(datetime.date(2010, 10, 15),
+                                               games_col, parse_error_col)
+        self.assertEquals(count, len(DAY_GAME_IDS))
+        self.assertEquals(raw_games_col.ids(), DAY_GAME_IDS)
+        self.assertEquals(raw_games_col.num_bulk_writes, 1)
+        self.assertEquals(games_col.ids(), DAY_GAME_IDS)
+        self.assertEquals(games_col.docs[0]['game_date'], '20101015')
+        self.assertTrue(games_col.docs[0][DECKS])
+        self.assertEquals(parse_error_col.docs, [])
+
+        # Loading the same day again is a noop.
+        games_col.docs = []
+        count = iso.scrape_and_ingest_rawgames(datetime.date(2010, 10, 15),
+                                               games_col, parse_error_col)
+        self.assertEquals(count, 0)
+        self.assertEquals(games_col.docs, [])
+
+
+
+class FakeS3Key(object):
+    """A key of FakeS3Bucket.  Like a boto Key, it can only be read
+    through once after open_read(), without seeking."""
+
+    def __init__(self, name, contents):
+        self.name = name
+        self.contents = contents
+        self.etag = '"%s"' % hashlib.md5(contents).hexdigest()
+        self.stream = None
+
+    def get_contents_as_string(self):
+        return self.contents
+
+    def open_read(self):
+        self.stream = io.BytesIO(self.contents)
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def close(self):
+        self.stream = None
+
+
+class FakeMultiPartUpload(object):
+    def __init__(self, bucket, key_name):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.parts = {}
+
+    def upload_part_from_file(self, fp, part_num):
+        self.parts[part_num] = fp.read()
+
+    def complete_upload(self):
+        parts = [self.parts[num] for num in sorted(self.parts)]
+        # S3 refuses uploads with a short part anywhere but at the end.
+        for part in parts[:-1]:
+            if len(part) < isotropic.S3_UPLOAD_PART_SIZE:
+                raise ValueError('part too small')
+        self.bucket.part_sizes = [len(part) for part in parts]
+        self.bucket.keys[self.key_name] = FakeS3Key(self.key_name,
+                                                   ''.join(parts))
+
+    def cancel_upload(self):
+        self.parts = {}
+
+
+class FakeS3Bucket(object):
+    """Local S3 stand-in, holding the keys of the one bucket we use."""
+
+    def __init__(self):
+        self.keys = {}
+        self.part_sizes = None
+
+    def get_bucket(self, name):
+        return self
+
+    def get_key(self, key_name):
+        return self.keys.get(key_name)
+
+    def initiate_multipart_upload(self, key_name, policy=None):
+        return FakeMultiPartUpload(self, key_name)
+
+
+class LocalS3Scraper(isotropic.IsotropicScraper):
+    """Scraper that fetches archives from a local file and keeps them in
+    a FakeS3Bucket."""
+
+    def __init__(self, db, archive_path, archive_cache=None):
+        isotropic.IsotropicScraper.__init__(self, db,
+                                            archive_cache=archive_cache)
+        self.archive_path = archive_path
+        self.s3conn = FakeS3Bucket()
+
+    def isotropic_rawgame_url(self, gamedate):
+        return 'file://' + self.archive_path
+
+
+class IsotropicStreaming(unittest.TestCase):
+    date = datetime.date(2010, 10, 15)
+
+    def setUp(self):
+        self.part_size = isotropic.S3_UPLOAD_PART_SIZE
+        isotropic.S3_UPLOAD_PART_SIZE = 1000
+        fd, self.archive_path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        isotropic.S3_UPLOAD_PART_SIZE = self.part_size
+        os.remove(self.archive_path)
+
+    def copy_to_s3(self, contents):
+        """Copy an archive holding contents into S3, and return the
+        scraper and the sizes of the parts it was uploaded in."""
+        open(self.archive_path, 'wb').write(contents)
+        iso = LocalS3Scraper(None, self.archive_path)
+        iso.copy_rawgames_to_s3(self.date)
+        self.assertEquals(iso.get_rawgames_from_s3(self.date), contents)
+        return iso, iso.s3conn.part_sizes
+
+    def test_upload_in_parts(self):
+        _, part_sizes = self.copy_to_s3('x' * 2500)
+        self.assertEquals(part_sizes, [1000, 1000, 500])
+
+    def test_upload_exact_multiple_of_part_size(self):
+        _, part_sizes = self.copy_to_s3('x' * 3000)
+        self.assertEquals(part_sizes, [1000, 1000, 1000])
+
+    def test_upload_empty_archive(self):
+        _, part_sizes = self.copy_to_s3('')
+        self.assertEquals(part_sizes, [0])
+
+    def test_scrape_and_store_streams_archive(self):
+        raw_games_col = FakeCollection()
+        iso, _ = self.copy_to_s3(test_archive().getvalue())
+        iso.rawgames_col = raw_games_col
+
+        archive = iso.get_rawgames_from_s3_as_filelike(self.date)
+        self.assertFalse(hasattr(archive, 'seek'))
+        archive.close()
+
+        self.assertEquals(iso.scrape_and_store_rawgames(self.date),
+                          len(DAY_GAME_IDS))
+        self.assertEquals(raw_games_col.ids(), DAY_GAME_IDS)
+        self.assertEquals(iso.scrape_and_store_rawgames(self.date), 0)
+
+
+class IsotropicArchiveCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_hits_and_misses(self):
+        cache = archive_cache.ArchiveCache(self.cache_dir, 10000)
+        key = FakeS3Key('20101015.all.tar.bz2', 'archive')
+        for _ in range(3):
+            self.assertEquals(cache.open('20101015', key).read(), 'archive')
+        self.assertEquals((cache.hits, cache.misses), (2, 1))
+
+        # A replaced archive has a new checksum, so it is fetched again.
+        key = FakeS3Key('20101015.all.tar.bz2', 'new archive')
+        self.assertEquals(cache.open('20101015', key).read(), 'new archive')
+        self.assertEquals((cache.hits, cache.misses), (2, 2))
+
+    def test_bad_checksum(self):
+        cache = archive_cache.ArchiveCache(self.cache_dir, 10000)
+        key = FakeS3Key('20101015.all.tar.bz2', 'archive')
+        key.contents = 'truncated'
+        self.assertRaises(archive_cache.ArchiveCacheError,
+                          cache.open, '20101015', key)
+        self.assertEquals(os.listdir(self.cache_dir), [])
+
+    def test_lru_eviction(self):
+        cache = archive_cache.ArchiveCache(self.cache_dir, 2500)
+        keys = [FakeS3Key('%d.all.tar.bz2' % day, str(day) * 1000)
+                for day in range(3)]
+        for day, key in enumerate(keys):
+            cache.open('2010101%d' % day, key).close()
+            # Modification times can be too coarse to order the uses.
+            filename = cache.cache_filename('2010101%d' % day,
+                                            archive_cache.key_checksum(key))
+            os.utime(filename, (day * 10, day * 10))
+        self.assertEquals(len(cache.cached_files()), 2)
+
+        # Day 1 is now the least recently used, so day 3 evicts it.
+        cache.open('20101012', keys[2]).close()
+        cache.open('20101013', FakeS3Key('3.all.tar.bz2', '3' * 1000)).close()
+        self.assertEquals(sorted(os.path.basename(f)[:8] for _, _, f in
+                                 cache.cached_files()),
+                          ['20101012', '20101013'])
+
+    def test_scraper_reads_through_cache(self):
+        fd, archive_path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            open(archive_path, 'wb').write(test_archive().getvalue())
+            cache = archive_cache.ArchiveCache(self.cache_dir, 10 ** 8)
+            iso = LocalS3Scraper(None, archive_path, cache)
+            date = datetime.date(2010, 10, 15)
+            iso.copy_rawgames_to_s3(date)
+
+            iso.rawgames_col = FakeCollection()
+            self.assertEquals(iso.scrape_and_store_rawgames(date),
+                              len(DAY_GAME_IDS))
+            self.assertEquals(iso.get_rawgames_from_s3(date),
+                              test_archive().getvalue())
+            self.assertEquals((cache.hits, cache.misses), (1, 1))
+        finally:
+            os.remove(archive_path)
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     unittest.main()
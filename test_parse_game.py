@@ -7,7 +7,17 @@ except ImportError, e:
 import parse_game
 from keys import *
 import dominioncards
+import bz2
 import codecs
+import logging
+import game
+import ingest_sequence
+import multiprocessing
+import os
+import shutil
+import tempfile
+from fake_mongo import (FakeCollection, TEST_GAME_IDS, raw_game_doc,
+                        sample_raw_game_docs, test_game_contents)
 
 DEF_NAME_LIST = ['p' + str(x) for x in range(15)]
 
@@ -832,6 +842,33 @@ player0 plays 3 <span class=card-treasure>Coppers</span>.""")
     player0 buys a <span class=card-none>Masquerade</span>.
     (player0 reshuffles.)""")
 
+class ClassifyLinesTest(unittest.TestCase):
+    def assert_matches_substring_tests(self, lines):
+        expected = [set(kw for kw in parse_game.LINE_KEYWORDS if kw in line)
+                    for line in lines]
+        self.assertEquals(parse_game.classify_lines(lines), expected)
+
+    def test_overlapping_keywords(self):
+        self.assert_matches_substring_tests([
+            u'player0 trashes it.',
+            u'... player1 reveals a <span class=card-none>Moat</span>.',
+            u'... player0 gains another one.',
+            u'',
+            u'player0 gets +1 ▼.',
+            u'player0 plays a <span class=card-none>Village</span>.'])
+
+    def test_test_data(self):
+        for game_id in TEST_GAME_IDS:
+            contents = test_game_contents(game_id)
+            self.assert_matches_substring_tests(contents.split('\n'))
+
+    def test_single_line(self):
+        self.assertEquals(parse_game.classify_lines(
+                [u'player0 buys a <span class=card-none>Smithy</span>.']),
+                          [set([parse_game.KW_BUYS])])
+        self.assertEquals(parse_game.classify_lines([u'player0 passes.']),
+                          [set()])
+
 class SplitTurnsTest(unittest.TestCase):
     def test_split_simple(self):
         split_turns = parse_game.split_turns(
@@ -1417,5 +1454,198 @@ Arsenic03 wins!
         self.assertEquals(parsed_game[DECKS][1][NAME], u'tafkal')
 
 
+class ParseRawGamesTest(unittest.TestCase):
+    log = logging.getLogger(__name__)
+
+    def test_chunk_matches_parse_game(self):
+        parsed, errors, tracker = parse_game.parse_raw_games_chunk(
+            sample_raw_game_docs(), self.log)
+        self.assertEquals([g['_id'] for g in parsed], TEST_GAME_IDS)
+        self.assertEquals(errors, [])
+        self.assertEquals(tracker.num_games, len(TEST_GAME_IDS))
+        self.assertEquals(tracker.failures, 0)
+
+        expected = parse_game.parse_game_from_file(
+            'testing/testdata/' + TEST_GAME_IDS[0])
+        self.assertEquals(parsed[0][DECKS], expected[DECKS])
+        self.assertEquals(parsed[0]['game_date'], '20101015')
+        self.assertEquals(parsed[0][PARSER_VERSION],
+                          parse_game.CURRENT_PARSER_VERSION)
+        self.assertEquals(parsed[0][RAW_HASH], parse_game.raw_game_hash(
+                sample_raw_game_docs()[0]))
+
+    def test_chunk_records_errors(self):
+        raw_games = [raw_game_doc('game-20101015-000000-broken.html',
+                                  u'a\n----------------------\nb'),
+                     raw_game_doc('game-20101015-000000-aborted.html',
+                                  u'<b>game aborted</b>')]
+        parsed, errors, tracker = parse_game.parse_raw_games_chunk(
+            raw_games, self.log)
+        self.assertEquals(parsed, [])
+        self.assertEquals(len(errors), 1)
+        self.assertEquals(errors[0]['game_id'],
+                          'game-20101015-000000-broken.html')
+        self.assertEquals(errors[0]['message'],
+                          u'ParsingError Failed to split sections')
+        self.assertEquals(tracker.num_games, 0)
+
+    def test_pool_matches_serial(self):
+        raw_games = sample_raw_game_docs()
+        serial = list(parse_game.parse_raw_games(self.log, raw_games))
+        pool = multiprocessing.Pool(2)
+        try:
+            pooled = list(parse_game.parse_raw_games(self.log, raw_games,
+                                                     pool))
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEquals([g for chunk in serial for g in chunk[0]],
+                          [g for chunk in pooled for g in chunk[0]])
+
+        serial_tracker = parse_game.BrokennessTracker()
+        for chunk in serial:
+            serial_tracker.merge(chunk[2])
+        pooled_tracker = parse_game.BrokennessTracker()
+        for chunk in pooled:
+            pooled_tracker.merge(chunk[2])
+        self.assertEquals(pooled_tracker.overall, serial_tracker.overall)
+
+    def test_parse_and_insert_batches(self):
+        games_col = FakeCollection()
+        parse_error_col = FakeCollection()
+        num_parsed = parse_game.parse_and_insert(
+            self.log, iter(sample_raw_game_docs()), games_col,
+            parse_error_col, '20101015')
+        self.assertEquals(num_parsed, len(TEST_GAME_IDS))
+        self.assertEquals(games_col.ids(), TEST_GAME_IDS)
+        self.assertEquals(games_col.num_bulk_writes, 1)
+        self.assertEquals(parse_error_col.docs, [])
+        self.assertEquals([g[INGEST_SEQ] for g in games_col.docs],
+                          range(1, len(TEST_GAME_IDS) + 1))
+
+    def test_save_games_numbers_new_games(self):
+        games_col = FakeCollection()
+        parse_error_col = FakeCollection()
+        parse_game.save_games(self.log, games_col, parse_error_col,
+                              [{'_id': _id} for _id in 'cd'])
+        # A late game gets the next number, and a reparsed one keeps its own.
+        parse_game.save_games(self.log, games_col, parse_error_col,
+                              [{'_id': _id} for _id in 'ad'])
+        self.assertEquals(
+            dict((g['_id'], g[INGEST_SEQ]) for g in games_col.docs),
+            {'a': 3, 'c': 1, 'd': 2})
+        # Once written, the games are settled for the scanners.
+        self.assertEquals(ingest_sequence.settled_seq(games_col.database), 3)
+
+    def test_save_games_records_write_errors(self):
+        games_col = FakeCollection(failing_ids=['b'])
+        parse_error_col = FakeCollection()
+        games = [{'_id': _id, 'game_date': '20101015'} for _id in 'abc']
+        games.append({'_id': 'd', 'game_date': '20101015', 'bad.key': 1})
+        num_saved = parse_game.save_games(self.log, games_col,
+                                          parse_error_col, games)
+        self.assertEquals(num_saved, 2)
+        self.assertEquals(games_col.ids(), ['a', 'c'])
+        self.assertEquals(sorted(e['game_id'] for e in parse_error_col.docs),
+                          ['b', 'd'])
+
+
+class ParseCacheTest(unittest.TestCase):
+    log = logging.getLogger(__name__)
+
+    def test_changed_raw_games(self):
+        raw_games = sample_raw_game_docs()
+        stamps = [(parse_game.CURRENT_PARSER_VERSION,
+                   parse_game.raw_game_hash(raw_games[0])),
+                  (parse_game.CURRENT_PARSER_VERSION - 1,
+                   parse_game.raw_game_hash(raw_games[1])),
+                  (parse_game.CURRENT_PARSER_VERSION, 'stale hash')]
+        games_col = FakeCollection(
+            [{'_id': raw_game['_id'], PARSER_VERSION: version, RAW_HASH: h}
+             for raw_game, (version, h) in zip(raw_games, stamps)])
+        changed = parse_game.changed_raw_games(self.log, iter(raw_games),
+                                               games_col)
+        self.assertEquals([raw_game['_id'] for raw_game in changed],
+                          TEST_GAME_IDS[1:])
+
+    def test_remove_segments(self):
+        cwd = os.getcwd()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            os.chdir(tmp_dir)
+            os.mkdir('parsed_out')
+            for name in ['20101015-0.json', '20101015-1.json',
+                         '20101016-0.json']:
+                open(os.path.join('parsed_out', name), 'w').write('[]')
+            parse_game.remove_segments('20101015')
+            self.assertEquals(os.listdir('parsed_out'), ['20101016-0.json'])
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp_dir)
+
+    def test_count_parser_versions(self):
+        current = parse_game.CURRENT_PARSER_VERSION
+        parsed_games = [{'game_date': '20101015', PARSER_VERSION: current},
+                        {'game_date': '20101015', PARSER_VERSION: current},
+                        {'game_date': '20101015'},
+                        {'game_date': '20101016', PARSER_VERSION: current - 1}]
+        self.assertEquals(parse_game.count_parser_versions(parsed_games),
+                          {'20101015': (2, 1), '20101016': (0, 1)})
+
+
+class DeckSanityTest(unittest.TestCase):
+    log = logging.getLogger(__name__)
+
+    def test_deck_tracker_applies_turn(self):
+        tracker = parse_game.DeckTracker()
+        tracker.add_turn(0, {BUYS: [dominioncards.Silver.index],
+                             GAINS: [dominioncards.Curse.index],
+                             TRASHES: [dominioncards.Copper.index,
+                                       dominioncards.Estate.index],
+                             OPP: {'1': {GAINS: [dominioncards.Curse.index],
+                                         TRASHES: [dominioncards.Copper.index]}}})
+        self.assertEquals(tracker.deck_composition(0),
+                          {str(dominioncards.Copper.index): 6,
+                           str(dominioncards.Estate.index): 2,
+                           str(dominioncards.Silver.index): 1,
+                           str(dominioncards.Curse.index): 1})
+        self.assertEquals(tracker.deck_composition(1),
+                          {str(dominioncards.Copper.index): 6,
+                           str(dominioncards.Estate.index): 3,
+                           str(dominioncards.Curse.index): 1})
+
+    def parse_with_tracker(self, game_id):
+        contents = test_game_contents(game_id)
+        tracker = parse_game.DeckTracker()
+        return parse_game.parse_game(contents, deck_tracker=tracker), tracker
+
+    def test_matches_check_game_sanity(self):
+        for game_id in TEST_GAME_IDS:
+            parsed, tracker = self.parse_with_tracker(game_id)
+            self.assertTrue(parse_game.check_deck_sanity(parsed, tracker,
+                                                         self.log))
+            self.assertTrue(parse_game.check_game_sanity(game.Game(parsed),
+                                                         self.log))
+
+    def test_detects_deck_mismatch(self):
+        parsed, tracker = self.parse_with_tracker(TEST_GAME_IDS[0])
+        deck = parsed[DECKS][1][DECK]
+        deck[str(dominioncards.Copper.index)] += 1
+        self.assertFalse(parse_game.check_deck_sanity(parsed, tracker,
+                                                      self.log))
+        self.assertFalse(parse_game.check_game_sanity(game.Game(parsed),
+                                                      self.log))
+
+    def test_strict_sanity_chunk(self):
+        fused = parse_game.parse_raw_games_chunk(sample_raw_game_docs(),
+                                                 self.log)
+        strict = parse_game.parse_raw_games_chunk(sample_raw_game_docs(),
+                                                  self.log, strict_sanity=True)
+        self.assertEquals(fused[0], strict[0])
+        self.assertEquals(fused[1], strict[1])
+        self.assertEquals(fused[2].overall, strict[2].overall)
+        self.assertEquals(fused[2].failures, strict[2].failures)
+
+
 if __name__ == '__main__':
     unittest.main()
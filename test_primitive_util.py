@@ -21,6 +21,28 @@ class SimpleConversion(unittest.TestCase):
         self.assertEquals(returned_a.foo, a.foo)
         self.assertEquals(returned_a.bar, a.bar)
 
+class ChangingMembersTest(unittest.TestCase):
+    def test(self):
+        class A(primitive_util.PrimitiveConversion):
+            def __init__(self):
+                self.foo = 0
+
+        a = A()
+        a.foo = 1
+        with_bar = A()
+        with_bar.bar = 'baz'
+        self.assertEquals(a.to_primitive_object(), {'foo': 1})
+        self.assertEquals(with_bar.to_primitive_object(),
+                          {'foo': 0, 'bar': 'baz'})
+
+        returned_a = A()
+        returned_a.from_primitive_object({'foo': 2, '_id': 'x'})
+        self.assertEquals(returned_a.foo, 2)
+        self.assertRaises(AssertionError, A().from_primitive_object,
+                          {'bar': 2})
+        self.assertRaises(AssertionError, A().from_primitive_object,
+                          {'foo': 2, 'bar': 3})
+
 class ConvertibleDefaultDictTest(unittest.TestCase):
     def test(self):
         a = primitive_util.ConvertibleDefaultDict(str)
@@ -97,6 +119,7 @@ class ListSlotPrimTest(unittest.TestCase):
         self.assertEquals(new_g.g1.f2, 2)
         self.assertEquals(new_g.g2.f1, 3)
         self.assertEquals(new_g.g2.f2, 5)
+        self.assertRaises(AssertionError, new_g.from_primitive_object, [1, 2])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,250 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+try:
+    import unittest2 as unittest
+except ImportError, e:
+    import unittest
+
+import os.path
+import shutil
+import tempfile
+
+from keys import *
+import analyze
+import count_buys
+import fake_mongo
+import game
+import incremental_scanner
+import ingest_sequence
+import parse_game
+import primitive_util
+import run_trueskill
+import scan_engine
+
+
+def parsed_test_games():
+    games = []
+    for seq, game_id in enumerate(fake_mongo.TEST_GAME_IDS, 1):
+        parsed = parse_game.parse_game(fake_mongo.test_game_contents(game_id))
+        parsed['_id'] = game_id
+        parsed[INGEST_SEQ] = seq
+        games.append(parsed)
+    return games
+
+
+class RecordingPlugin(scan_engine.AnalyzerPlugin):
+    def __init__(self, db, scan_name):
+        self.scan_name = scan_name
+        scan_engine.AnalyzerPlugin.__init__(self, db)
+        self.games = []
+        self.commits = 0
+
+    def analyze_game(self, game_obj):
+        self.games.append(game_obj)
+
+    def commit(self):
+        self.commits += 1
+        self.scanner.save()
+
+
+class ScanEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.db = fake_mongo.FakeDatabase()
+        self.db.games.docs = parsed_test_games()
+
+    def test_builds_each_game_once(self):
+        first = RecordingPlugin(self.db, 'first')
+        second = RecordingPlugin(self.db, 'second')
+        scan_engine.ScanEngine(self.db.games, [first, second]).run()
+
+        self.assertEquals(len(first.games), len(fake_mongo.TEST_GAME_IDS))
+        for first_game, second_game in zip(first.games, second.games):
+            self.assertTrue(first_game is second_game)
+        self.assertEquals(first.commits, 1)
+        self.assertEquals(second.commits, 1)
+
+    def test_plugins_keep_their_own_checkpoints(self):
+        ahead = RecordingPlugin(self.db, 'ahead')
+        ahead.scanner.set_max_seq(2)
+        behind = RecordingPlugin(self.db, 'behind')
+        scan_engine.ScanEngine(self.db.games, [ahead, behind]).run()
+
+        self.assertEquals([g.get_id() for g in ahead.games],
+                          fake_mongo.TEST_GAME_IDS[2:])
+        self.assertEquals([g.get_id() for g in behind.games],
+                          fake_mongo.TEST_GAME_IDS)
+        for name, num_games in [('ahead', 2), ('behind', 4)]:
+            scanner = incremental_scanner.IncrementalScanner(name, self.db)
+            self.assertEquals(scanner.get_num_games(), num_games)
+            self.assertEquals(scanner.get_max_game_id(),
+                              fake_mongo.TEST_GAME_IDS[-1])
+
+    def test_late_games_are_scanned(self):
+        games = parsed_test_games()
+        late = games.pop(2)
+        for seq, raw_game in enumerate(games, 1):
+            raw_game[INGEST_SEQ] = seq
+        self.db.games.docs = games
+        plugin = RecordingPlugin(self.db, 'recording')
+        scan_engine.ScanEngine(self.db.games, [plugin]).run()
+
+        late[INGEST_SEQ] = len(games) + 1
+        self.db.games.docs.append(late)
+        plugin = RecordingPlugin(self.db, 'recording')
+        scan_engine.ScanEngine(self.db.games, [plugin]).run()
+        self.assertEquals([g.get_id() for g in plugin.games], [late['_id']])
+        self.assertEquals(plugin.scanner.get_num_games(),
+                          len(fake_mongo.TEST_GAME_IDS))
+        self.assertEquals(plugin.scanner.get_max_game_id(),
+                          fake_mongo.TEST_GAME_IDS[-1])
+
+    def test_commits_cover_games_in_sequence_order(self):
+        self.db.games.docs.reverse()
+        plugin = RecordingPlugin(self.db, 'recording')
+        scan_engine.ScanEngine(self.db.games, [plugin],
+                               commit_after=1).run(max_games=2)
+        self.assertEquals([g.get_id() for g in plugin.games],
+                          fake_mongo.TEST_GAME_IDS[:2])
+
+        # A scan picking up from the last commit gets the rest.
+        plugin = RecordingPlugin(self.db, 'recording')
+        scan_engine.ScanEngine(self.db.games, [plugin]).run()
+        self.assertEquals([g.get_id() for g in plugin.games],
+                          fake_mongo.TEST_GAME_IDS[2:])
+
+    def test_stops_before_unwritten_games(self):
+        self.db.games.docs = parsed_test_games()[1:]
+        self.assertEquals(ingest_sequence.reserve(self.db, 4), 1)
+        ingest_sequence.release(self.db, ingest_sequence.reserve(self.db, 1))
+        plugin = RecordingPlugin(self.db, 'recording')
+        scan_engine.ScanEngine(self.db.games, [plugin]).run()
+        self.assertEquals(plugin.games, [])
+
+        # The first writer has written all of its games.
+        self.db.games.docs = parsed_test_games()
+        ingest_sequence.release(self.db, 1)
+        scan_engine.ScanEngine(self.db.games, [plugin]).run()
+        self.assertEquals([g.get_id() for g in plugin.games],
+                          fake_mongo.TEST_GAME_IDS)
+
+    def test_skipped_games_count_as_scanned(self):
+        plugin = run_trueskill.TrueskillPlugin(self.db)
+        plugin.wants_game = lambda raw_game: False
+        plugin.analyze_game = None
+        scan_engine.ScanEngine(self.db.games, [plugin]).run()
+        self.assertEquals(plugin.scanner.get_num_games(),
+                          len(fake_mongo.TEST_GAME_IDS))
+
+    def test_max_games(self):
+        plugin = RecordingPlugin(self.db, 'recording')
+        scan_engine.ScanEngine(self.db.games, [plugin]).run(max_games=3)
+        self.assertEquals(len(plugin.games), 3)
+        self.assertEquals(plugin.scanner.get_num_games(), 3)
+
+    def test_buys_match_single_scan(self):
+        expected = count_buys.DeckBuyStats()
+        count_buys.accum_buy_stats(
+            [game.Game(g) for g in parsed_test_games()], expected)
+
+        # Run incrementally over two halves, with other analyzers alongside.
+        self.db.games.docs = parsed_test_games()[:2]
+        scan_engine.ScanEngine(self.db.games, [
+                count_buys.BuyStatsPlugin(self.db),
+                run_trueskill.TrueskillPlugin(self.db)]).run()
+        self.db.games.docs = parsed_test_games()
+        scan_engine.ScanEngine(self.db.games, [
+                count_buys.BuyStatsPlugin(self.db),
+                run_trueskill.TrueskillPlugin(self.db)]).run()
+
+        stored = self.db[count_buys.BUYS_COL_NAME].find_one({'_id': ''})
+        del stored['_id']
+        self.assertEquals(stored, primitive_util.to_primitive(expected))
+        self.assertTrue(self.db.trueskill_openings.find_one())
+
+    def test_scan_fields(self):
+        buys = count_buys.BuyStatsPlugin(self.db)
+        trueskill = run_trueskill.TrueskillPlugin(self.db)
+        self.assertEquals(scan_engine.scan_fields([trueskill]),
+                          sorted(trueskill.fields + [INGEST_SEQ]))
+        self.assertEquals(scan_engine.scan_fields([buys, trueskill]),
+                          sorted(game.GAME_FIELDS + [INGEST_SEQ]))
+        self.assertEquals(scan_engine.scan_fields(
+                [buys, RecordingPlugin(self.db, 'recording')]), None)
+
+    def test_projected_trueskill_matches_whole_games(self):
+        whole_db = fake_mongo.FakeDatabase()
+        whole_db.games.docs = parsed_test_games()
+        whole = run_trueskill.TrueskillPlugin(whole_db)
+        whole.fields = None
+        scan_engine.ScanEngine(whole_db.games, [whole]).run()
+
+        scan_engine.ScanEngine(self.db.games, [
+                run_trueskill.TrueskillPlugin(self.db)]).run()
+        self.assertTrue(self.db.trueskill_openings.docs)
+        self.assertEquals(sorted(self.db.trueskill_openings.docs),
+                          sorted(whole_db.trueskill_openings.docs))
+
+
+# The pool processes of run_parallel() inherit this, and connect to it.
+PARALLEL_DB = fake_mongo.FakeDatabase()
+
+def connect_parallel_db():
+    return PARALLEL_DB
+
+
+class ParallelTest(unittest.TestCase):
+    def setUp(self):
+        PARALLEL_DB.collections.clear()
+        PARALLEL_DB.games.docs = parsed_test_games()
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def plugins(self, db):
+        analysis = analyze.AnalysisPlugin(db)
+        analysis.output_file_name = os.path.join(self.output_dir, 'stats.js')
+        return [analysis, count_buys.BuyStatsPlugin(db)]
+
+    def test_shard_bounds(self):
+        self.assertEquals(scan_engine.shard_bounds(PARALLEL_DB.games, 2),
+                          [0, 2, 4])
+        self.assertEquals(scan_engine.shard_bounds(PARALLEL_DB.games, 8),
+                          [0, 1, 2, 3, 4])
+        self.assertEquals(scan_engine.shard_bounds(PARALLEL_DB.games, 3, 4),
+                          [4])
+        self.assertEquals(
+            scan_engine.shard_bounds(PARALLEL_DB.games, 2, 0, 3), [0, 1, 3])
+        self.assertEquals(
+            scan_engine.shard_bounds(PARALLEL_DB.games, 1, 0, None, 2),
+            [0, 2, 4])
+
+    def test_matches_single_scan(self):
+        sequential_db = fake_mongo.FakeDatabase()
+        sequential_db.games.docs = parsed_test_games()
+        scan_engine.ScanEngine(sequential_db.games,
+                               self.plugins(sequential_db)).run()
+
+        # Start the buys from part of the way through, as an incremental
+        # run would.
+        buys = count_buys.BuyStatsPlugin(PARALLEL_DB)
+        buys.scanner.record(fake_mongo.TEST_GAME_IDS[0], 1)
+        buys.analyze_game(game.Game(PARALLEL_DB.games.docs[0]))
+        buys.commit()
+        scan_engine.run_parallel(PARALLEL_DB, self.plugins(PARALLEL_DB), 2,
+                                 connect=connect_parallel_db)
+
+        for name in ['analysis', count_buys.BUYS_COL_NAME]:
+            self.assertEquals(
+                sorted(PARALLEL_DB[name].docs),
+                sorted(sequential_db[name].docs))
+        # The buys took one more checkpoint to get there.
+        for db in [PARALLEL_DB, sequential_db]:
+            for doc in db.scanner.docs:
+                del doc['version']
+        self.assertEquals(sorted(PARALLEL_DB.scanner.docs),
+                          sorted(sequential_db.scanner.docs))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,10 @@
 #!/usr/bin/python
 
+import random
 import unittest
+
+import numpy
+
 import stats
 
 class RandomVariableStat(unittest.TestCase):
@@ -33,5 +37,61 @@ class EmptySets(unittest.TestCase):
         self.assertEquals(d.sample_std_dev(), float('inf'))
 
 
+class MeanVarStatTableTest(unittest.TestCase):
+    def setUp(self):
+        rand = random.Random(0)
+        self.outcomes = [(rand.randrange(4), rand.uniform(-5, 5),
+                          rand.randrange(1, 3)) for _ in xrange(100)]
+        self.expected = [stats.MeanVarStat() for _ in xrange(5)]
+        for row, val, freq in self.outcomes:
+            self.expected[row].add_many_outcomes(val, freq)
+
+    def assertMatches(self, table):
+        for row, expected in enumerate(self.expected):
+            stat = table.stat(row)
+            self.assertEquals(stat.freq, expected.freq)
+            self.assertAlmostEquals(stat.mean(), expected.mean())
+            self.assertAlmostEquals(stat.variance(), expected.variance())
+            self.assertAlmostEquals(table.mean()[row], expected.mean())
+            self.assertAlmostEquals(table.variance()[row],
+                                    expected.variance())
+
+    def test_add_outcomes(self):
+        table = stats.MeanVarStatTable(5)
+        rows, vals, freqs = zip(*self.outcomes)
+        table.add_outcomes(rows[:30], vals[:30], freqs[:30])
+        table.add_outcomes(rows[30:], vals[30:], freqs[30:])
+        self.assertMatches(table)
+        self.assertEquals(table.stat(4), stats.MeanVarStat())
+
+    def test_merge(self):
+        first = stats.MeanVarStatTable(5)
+        second = stats.MeanVarStatTable(5)
+        for row, val, freq in self.outcomes[:50]:
+            first.add_outcomes([row], [val], [freq])
+        for row, val, freq in self.outcomes[50:]:
+            second.add_outcomes([row] * freq, [val] * freq)
+        first.merge(second)
+        self.assertMatches(first)
+
+    def test_stat_lists(self):
+        lists = [stat.to_primitive_object() for stat in self.expected]
+        table = stats.MeanVarStatTable.from_stat_lists(lists)
+        self.assertMatches(table)
+        for stat_list, expected in zip(table.to_stat_lists(), lists):
+            self.assertEquals(stat_list[0], expected[0])
+            self.assertAlmostEquals(stat_list[1], expected[1])
+            self.assertAlmostEquals(stat_list[2], expected[2])
+
+    def test_large_counts_stay_precise(self):
+        table = stats.MeanVarStatTable(1)
+        for _ in xrange(100):
+            table.add_outcomes(numpy.zeros(100000, dtype=int),
+                               1e9 + numpy.tile([-1., 1.], 50000))
+        self.assertEquals(table.stat(0).freq, 10 ** 7)
+        self.assertAlmostEquals(table.mean()[0], 1e9)
+        self.assertAlmostEquals(table.variance()[0], 1., places=5)
+
+
 if __name__ == '__main__':
     unittest.main()
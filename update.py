@@ -15,6 +15,7 @@ import dominionstats.utils.log
 import goal_stats
 import load_leaderboard
 import optimal_card_ratios
+import run_analyzers
 import run_trueskill
 import scrape_leaderboard
 import utils
@@ -24,6 +25,11 @@ import utils
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
+UPDATE_ANALYZERS = [analyze.AnalysisPlugin.scan_name,
+                    count_buys.BuyStatsPlugin.scan_name,
+                    run_trueskill.TrueskillPlugin.scan_name,
+                    optimal_card_ratios.CardRatiosPlugin.scan_name]
+
 
 def summarize_task_status(c):
     """Return a string summarize the state of the task and its children"""
@@ -98,10 +104,6 @@ def main(parsed_args):
             log.info("No games inserted for %s", date)
             break
 
-    # Invoke the analyze script
-    log.info("Starting analyze")
-    analyze.main(parsed_args)
-
     # Check for goals
     log.info("Starting search for goals acheived")
     for date in utils.daterange(datetime.date(2010, 10, 15),
@@ -126,17 +128,10 @@ def main(parsed_args):
             log.info("No new games summarized on %s", date)
             break
 
-    # Invoke the count_buys script
-    log.info("Counting buys")
-    count_buys.main(parsed_args)
-
-    # Invoke the run_trueskill script
-    log.info("Calculating trueskill")
-    run_trueskill.main(parsed_args)
-
-    # Invoke the optimal_card_ratios script
-    log.info("Calculating optimal card ratios")
-    optimal_card_ratios.main(parsed_args)
+    # Invoke the analyze, count_buys, run_trueskill and optimal_card_ratios
+    # analyzers in one scan over the games
+    log.info("Running the analyzers")
+    run_analyzers.main(parsed_args, UPDATE_ANALYZERS)
 
     # Invoke the goal_stats script
     log.info("Calculating goal stats")
@@ -1,6 +1,6 @@
 #!/usr/bin/python
 
-import configparser
+import ConfigParser
 import argparse
 import datetime
 import logging
@@ -23,18 +23,43 @@ def segments(lis, chunk_size):
         yield lis[i:i + chunk_size]
 
 
+def chunks(iterable, chunk_size):
+    """ Return an iterator over lists of up to chunk_size items from
+    iterable.  Unlike segments(), iterable need not be a list. """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 def get_aws_credentials():
     """Retrieve the AWS credentials from the config file
 
     Returned in a dict, so you can make a call like:
 
         boto.s3.connection.S3Connection(**utils.get_aws_credentials())
+
+    An optional s3_host (with s3_port and s3_is_secure) in the aws
+    section points the connection at a local S3 stand-in instead.
     """
     config = ConfigParser.ConfigParser()
     config.read('conf.ini')
 
-    return {'aws_access_key_id': config.get('aws', 'aws_access_key_id'),
-            'aws_secret_access_key': config.get('aws', 'aws_secret_access_key')}
+    credentials = {'aws_access_key_id': config.get('aws', 'aws_access_key_id'),
+                   'aws_secret_access_key': config.get('aws', 'aws_secret_access_key')}
+    if config.has_option('aws', 's3_host'):
+        credentials['host'] = config.get('aws', 's3_host')
+        if config.has_option('aws', 's3_port'):
+            credentials['port'] = config.getint('aws', 's3_port')
+        if config.has_option('aws', 's3_is_secure'):
+            credentials['is_secure'] = config.getboolean('aws', 's3_is_secure')
+        # Stand-ins generally can't do virtual host style bucket names.
+        credentials['calling_format'] = 'boto.s3.connection.OrdinaryCallingFormat'
+    return credentials
 
 
 def get_mongo_connection():